@@ -0,0 +1,324 @@
+import os
+import sys
+import time
+import json
+
+import torch
+import numpy as np
+import numpy.random as rd
+
+"""Zen4Jia1Hao2, GitHub: YonV1943 ElegantRL (Pytorch model-free DRL)
+Microbenchmark for replay buffer, networks and agent.update_parameters() on synthetic data (CPU only).
+It does not need gym.
+
+python3 AgentBench.py                      # save the result in ./bench_result.json
+python3 AgentBench.py bench_baseline.json  # save the result, and compare it with a stored baseline
+
+End-to-end benchmark: the time (and env steps) to reach the target reward of (agents x envs x seeds).
+It needs gym. See run_time_to_solve() and compare_time_to_solve().
+
+python3 AgentBench.py solve                    # save the result in ./bench_solve.json
+python3 AgentBench.py solve bench_solve0.json  # save the result, and compare it with prior results
+"""
+
+
+def get_used_time(func, repeat_times=16):  # the minimum used time (second), it is less noisy than average
+    func()  # warm up
+    used_times = list()
+    for _ in range(repeat_times):
+        timer = time.perf_counter()
+        func()
+        used_times.append(time.perf_counter() - timer)
+    return float(np.min(used_times))
+
+
+def get_random_memo(size, state_dim, action_dim, is_discrete=False):  # (reward, mask, state, action, next_state)
+    reward = rd.normal(size=(size, 1))
+    mask = np.where(rd.rand(size, 1) < 0.01, 0.0, 0.99)  # done in about 1% transitions
+    state = rd.normal(size=(size, state_dim))
+    action = rd.randint(action_dim, size=(size, 1)) if is_discrete else rd.uniform(-1, 1, size=(size, action_dim))
+    next_state = rd.normal(size=(size, state_dim))
+    return np.hstack((reward, mask, state, action, next_state)).astype(np.float32)
+
+
+def bench_buffer(max_lens=(2 ** 12, 2 ** 17), state_dims=(2 ** 3, 2 ** 5, 2 ** 7), action_dim=4,
+                 batch_size=2 ** 7, extend_size=2 ** 10):
+    from AgentZoo import BufferArray
+    result = dict()
+    for max_len in max_lens:
+        for state_dim in state_dims:
+            buffer = BufferArray(max_len, state_dim, action_dim)
+            memo_array = get_random_memo(extend_size, state_dim, action_dim)
+            memo_tuple = (memo_array[0, 0], memo_array[0, 1], memo_array[0, 2:2 + state_dim],
+                          memo_array[0, 2 + state_dim:2 + state_dim + action_dim],
+                          memo_array[0, 2 + state_dim + action_dim:])
+
+            def add_memo():
+                for _ in range(extend_size):
+                    buffer.add_memo(memo_tuple)
+
+            def extend_memo():
+                buffer.extend_memo(memo_array)
+
+            def random_sample():
+                buffer.init_before_sample()
+                for _ in range(2 ** 4):
+                    buffer.random_sample(batch_size, torch.device('cpu'))
+
+            key = f'len={max_len}/state={state_dim}'
+            result[f'buffer/add_memo*{extend_size}/{key}'] = get_used_time(add_memo)
+            result[f'buffer/extend_memo*1/{key}'] = get_used_time(extend_memo)
+            result[f'buffer/random_sample*16/{key}'] = get_used_time(random_sample)
+    return result
+
+
+def bench_network(batch_sizes=(2 ** 7, 2 ** 9), state_dim=2 ** 5, action_dim=2 ** 3, net_dim=2 ** 8):
+    from AgentNet import Actor, ActorSAC, InterSPG, CriticTwinShared, QNetDuel
+
+    state = torch.randn((max(batch_sizes), state_dim))
+    action = torch.rand((max(batch_sizes), action_dim)) * 2 - 1
+
+    def forward_actor(net, s, _a):
+        return net(s)
+
+    def forward_actor_sac(net, s, _a):
+        return net.get__a__log_prob(s)[1]
+
+    def forward_critic(net, s, a):
+        return torch.min(*net.get__q1_q2(s, a))
+
+    net_dict = {  # name: (network, forward function)
+        'Actor': (Actor(state_dim, action_dim, net_dim), forward_actor),
+        'ActorSAC': (ActorSAC(state_dim, action_dim, net_dim, use_dn=False), forward_actor_sac),
+        'ActorSAC_DenseNet': (ActorSAC(state_dim, action_dim, net_dim, use_dn=True), forward_actor_sac),
+        'InterSPG_actor': (InterSPG(state_dim, action_dim, net_dim), forward_actor_sac),
+        'InterSPG_critic': (InterSPG(state_dim, action_dim, net_dim), forward_critic),
+        'CriticTwinShared': (CriticTwinShared(state_dim, action_dim, net_dim, use_dn=True), forward_critic),
+        'QNetDuel': (QNetDuel(state_dim, action_dim, net_dim), forward_actor),
+    }
+
+    result = dict()
+    for name, (net, forward) in net_dict.items():
+        for batch_size in batch_sizes:
+            s = state[:batch_size]
+            a = action[:batch_size]
+
+            def forward_only():
+                with torch.no_grad():
+                    forward(net, s, a)
+
+            def forward_backward():
+                net.zero_grad()
+                forward(net, s, a).mean().backward()
+
+            result[f'net/{name}/forward/batch={batch_size}'] = get_used_time(forward_only)
+            result[f'net/{name}/backward/batch={batch_size}'] = get_used_time(forward_backward)
+    return result
+
+
+def bench_agent(max_step=2 ** 6, batch_size=2 ** 7, net_dim=2 ** 7, state_dim=2 ** 4, action_dim=2 ** 2):
+    import AgentZoo as Zoo
+    from AgentZoo import BufferArray, BufferTupleOnline
+
+    off_policy_agents = (Zoo.AgentDDPG, Zoo.AgentBasicAC, Zoo.AgentTD3, Zoo.AgentSAC, Zoo.AgentDeepSAC,
+                         Zoo.AgentInterAC, Zoo.AgentInterSAC, )
+    discrete_agents = (Zoo.AgentDQN, Zoo.AgentDoubleDQN, Zoo.AgentDuelingDQN, )
+    on_policy_agents = (Zoo.AgentPPO, Zoo.AgentGAE, Zoo.AgentInterGAE, Zoo.AgentDiscreteGAE, )
+
+    result = dict()
+    for rl_agent in off_policy_agents + discrete_agents:
+        is_discrete = rl_agent in discrete_agents
+        torch.manual_seed(1943)
+        rd.seed(1943)
+        agent = rl_agent(state_dim, action_dim, net_dim)
+        agent.step = max_step  # AgentDDPG.update_parameters() uses self.step as update times
+
+        buffer = BufferArray(2 ** 14, state_dim, 1 if is_discrete else action_dim)
+        buffer.extend_memo(get_random_memo(2 ** 13, state_dim, action_dim, is_discrete))
+        buffer.init_before_sample()
+
+        def update_parameters():
+            agent.update_parameters(buffer, max_step, batch_size, 1)
+
+        result[f'agent/{rl_agent.__name__}/update_parameters'] = get_used_time(update_parameters, repeat_times=4)
+
+    max_memo = 2 ** 10
+    for rl_agent in on_policy_agents:
+        torch.manual_seed(1943)
+        rd.seed(1943)
+        agent = rl_agent(state_dim, action_dim, net_dim)
+
+        buffer = BufferTupleOnline(max_memo)
+        memo_array = get_random_memo(max_memo, state_dim, action_dim)
+        for memo in memo_array:  # (reward, mask, state, action, log_prob)
+            buffer.push(memo[0], memo[1], memo[2:2 + state_dim], memo[2 + state_dim:2 + state_dim + action_dim],
+                        -rd.rand() * action_dim)
+
+        def update_parameters():
+            agent.update_parameters(buffer, max_step, batch_size, 2)
+
+        result[f'agent/{rl_agent.__name__}/update_parameters'] = get_used_time(update_parameters, repeat_times=4)
+    return result
+
+
+def run_benchmark(save_path='./bench_result.json', cpu_threads=4, if_cpu_only=True):
+    if if_cpu_only:  # the microbenchmark runs on CPU. torch initializes CUDA lazily, so it works after import torch
+        if torch.cuda.is_initialized():
+            print("| run_benchmark: CUDA is initialized before, the agents may run on GPU")
+        os.environ['CUDA_VISIBLE_DEVICES'] = ''
+    torch.set_num_threads(cpu_threads)
+    torch.set_default_dtype(torch.float32)
+
+    result = dict()
+    for bench_func in (bench_buffer, bench_network, bench_agent):
+        timer = time.time()
+        result.update(bench_func())
+        print(f"| {bench_func.__name__:16} UsedTime: {time.time() - timer:8.1f}s")
+
+    bench_dict = {'meta': {'torch': torch.__version__, 'numpy': np.__version__, 'cpu_threads': cpu_threads,
+                           'time': time.strftime('%Y-%m-%d %H:%M:%S'), },
+                  'result': result, }
+    with open(save_path, 'w') as f:
+        json.dump(bench_dict, f, indent=2)
+    print(f"| Save benchmark in {save_path}")
+    return bench_dict
+
+
+def compare_benchmark(bench_dict, baseline_dict, threshold=0.2):
+    """Compare the used time with a stored baseline.
+    A case is a regression when it is slower than the baseline by more than threshold (0.2 means 20%).
+    """
+    result = bench_dict['result']
+    baseline = baseline_dict['result']
+
+    regressions = list()
+    print(f"{'Case':64}  {'Base':>10}  {'Now':>10}  {'Ratio':>6}")
+    for key in sorted(set(result) & set(baseline)):
+        ratio = result[key] / max(baseline[key], 1e-9)
+        is_regression = ratio > 1 + threshold
+        if is_regression:
+            regressions.append(key)
+        print(f"{key:64}  {baseline[key]:10.2e}  {result[key]:10.2e}  {ratio:6.2f}"
+              f"{'  REGRESSION' if is_regression else ''}")
+
+    for key in sorted(set(result) ^ set(baseline)):
+        print(f"| Not compared (only in {'now' if key in result else 'baseline'}): {key}")
+    print(f"| Regression: {len(regressions)} / {len(set(result) & set(baseline))}")
+    return regressions
+
+
+"""end-to-end benchmark"""
+
+
+def run_time_to_solve(rl_agents, env_names, random_seeds=(1943, 1944, 1945), max_total_step=2 ** 17,
+                      arg_dict=None, save_path='./bench_solve.json', cpu_threads=4):
+    """Train (agents x envs x seeds) with a fixed budget (max_total_step) using train_agent(), one by one.
+    rl_agents: [AgentSAC, (AgentGAE, {'max_memo': 2 ** 12, 'repeat_times': 2 ** 4}), ...]
+               an item could be (rl_agent, arg_dict of this agent), the arg_dict overrides Arguments.
+    Record the time and env steps to reach target_reward (detected by Recorder.check_is_solved()),
+    samples per second (env steps) and gradient steps per second.
+
+    The random seed is for torch and numpy. The gym env keeps its own random seed.
+    The results are saved after each run, so they survive an interruption.
+    """
+    from AgentRun import Arguments, train_agent
+
+    runs = list()
+    for env_name in env_names:
+        for item in rl_agents:
+            rl_agent, agent_arg_dict = item if isinstance(item, tuple) else (item, dict())
+            for random_seed in random_seeds:
+                args = Arguments(rl_agent=rl_agent, env_name=env_name, gpu_id=0)
+                args.random_seed = random_seed
+                args.max_total_step = max_total_step
+                args.update_args(arg_dict if arg_dict else dict())
+                args.update_args(agent_arg_dict)
+                args.init_for_training(cpu_threads, cwd=f'./bench_solve/{rl_agent.__name__}_{env_name}_{random_seed}')
+
+                train_info = train_agent(**vars(args))
+                used_time = max(train_info['used_time'], 1e-6)
+                runs.append(dict(train_info, agent=rl_agent.__name__, env=env_name, seed=random_seed,
+                                 sample_per_s=train_info['total_step'] / used_time,
+                                 grad_step_per_s=train_info['grad_step'] / used_time, ))
+
+                with open(save_path, 'w') as f:
+                    json.dump({'meta': {'torch': torch.__version__, 'max_total_step': max_total_step,
+                                        'time': time.strftime('%Y-%m-%d %H:%M:%S'), },
+                               'runs': runs, }, f, indent=2)
+    print_time_to_solve(runs)
+    return runs
+
+
+def get_time_to_solve_table(runs):  # {(agent, env): info}, the time of unsolved run is inf
+    table = dict()
+    for run in runs:
+        table.setdefault((run['agent'], run['env']), list()).append(run)
+
+    for key, group in table.items():
+        solved_time = [run['solved_time'] if run['is_solved'] else np.inf for run in group]
+        solved_step = [run['solved_step'] if run['is_solved'] else np.inf for run in group]
+        table[key] = {'solved': sum([run['is_solved'] for run in group]), 'runs': len(group),
+                      'time': float(np.median(solved_time)), 'step': float(np.median(solved_step)),
+                      'sample_per_s': float(np.mean([run['sample_per_s'] for run in group])),
+                      'grad_step_per_s': float(np.mean([run['grad_step_per_s'] for run in group])), }
+    return table
+
+
+def print_time_to_solve(runs):
+    print(f"{'Agent':20}  {'Env':28}  {'Solved':>6}  {'Time(s)':>8}  {'Step':>8}  {'Sample/s':>8}  {'Grad/s':>8}")
+    for (agent_name, env_name), info in get_time_to_solve_table(runs).items():
+        print(f"{agent_name:20}  {env_name:28}  {info['solved']:>3}/{info['runs']:<2}  "
+              f"{info['time']:8.0f}  {info['step']:8.2e}  {info['sample_per_s']:8.1f}  {info['grad_step_per_s']:8.1f}")
+
+
+def compare_time_to_solve(runs, baseline_runs):
+    """Compare the median time to solve of each (agent, env) with prior results.
+    The overall ratio is the geometric mean of the ratios that both are solved (ratio < 1 means faster).
+    """
+    table = get_time_to_solve_table(runs)
+    baseline = get_time_to_solve_table(baseline_runs)
+
+    ratios = list()
+    print(f"{'Agent':20}  {'Env':28}  {'BaseTime':>8}  {'NowTime':>8}  {'Ratio':>6}  "
+          f"{'BaseSolved':>10}  {'NowSolved':>10}")
+    for key in sorted(set(table) & set(baseline)):
+        now, base = table[key], baseline[key]
+        if np.isfinite(now['time']) and np.isfinite(base['time']):
+            ratio = now['time'] / max(base['time'], 1.0)
+            ratios.append(ratio)
+        else:
+            ratio = np.nan  # more than half of the runs are unsolved
+        print(f"{key[0]:20}  {key[1]:28}  {base['time']:8.0f}  {now['time']:8.0f}  {ratio:6.2f}  "
+              f"{base['solved']:>6}/{base['runs']:<3}  {now['solved']:>6}/{now['runs']:<3}")
+
+    if len(ratios) == 0:
+        print("| Overall: no (agent, env) is solved in both results.")
+        return np.nan
+    overall_ratio = float(np.exp(np.mean(np.log(ratios))))
+    print(f"| Overall time to solve: {overall_ratio:.2f}x of baseline, "
+          f"{'faster' if overall_ratio < 1 else 'slower'} ({len(ratios)} compared)")
+    return overall_ratio
+
+
+def run_time_to_solve_demo():
+    import AgentZoo as Zoo
+    rl_agents = (Zoo.AgentTD3, Zoo.AgentSAC, Zoo.AgentInterSAC,
+                 (Zoo.AgentGAE, {'max_memo': 2 ** 12, 'batch_size': 2 ** 9, 'repeat_times': 2 ** 4}), )
+    return run_time_to_solve(rl_agents, env_names=('Pendulum-v0',), max_total_step=int(1e5 * 4),
+                             arg_dict={'reward_scale': 2 ** -2, 'show_gap': 2 ** 6})
+
+
+if __name__ == '__main__':
+    bench_baseline = None
+    if len(sys.argv) > 1 and sys.argv[-1].endswith('.json'):
+        with open(sys.argv[-1], 'r') as file:  # load it before the benchmark overwrites it
+            bench_baseline = json.load(file)
+
+    if 'solve' in sys.argv[1:]:
+        solve_runs = run_time_to_solve_demo()
+        if bench_baseline is not None:
+            compare_time_to_solve(solve_runs, bench_baseline['runs'])
+    else:
+        bench_result = run_benchmark()
+        if bench_baseline is not None and compare_benchmark(bench_result, bench_baseline):
+            sys.exit(1)
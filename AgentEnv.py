@@ -0,0 +1,280 @@
+import time
+
+import numpy as np
+import numpy.random as rd
+
+"""Zen4Jia1Hao2, GitHub: YonV1943 ElegantRL (Pytorch model-free DRL)
+Synthetic environments in pure NumPy, for the throughput test of explorer, replay buffer and learner.
+They do not need gym, Box2D or other simulators.
+
+Each env runs env_num instances in a batch:
+batched API:    states = env.reset_vec()                  # states.shape == (env_num, state_dim)
+                states, rewards, dones, info = env.step_vec(actions)  # reset the instances which are done
+gym single-env API (env_num == 1), the API that get_env_info() and agent.update_buffer() use:
+                state = env.reset()
+                state, reward, done, info = env.step(action)
+
+build_vec_env('VecPendulum-v0')       # Pendulum-v0 in NumPy
+build_vec_env('VecCartPole-v0')       # CartPole-v0 in NumPy
+build_vec_env('VecLQR-v0')            # linear-quadratic control, state_dim=8, action_dim=2
+build_vec_env('VecLQR-s64a16-v0')     # linear-quadratic control, state_dim=64, action_dim=16
+VecGymEnv([gym.make(env_name) for _ in range(env_num)])  # gym envs with the batched API
+"""
+
+try:
+    from gym.spaces import Box, Discrete  # get_env_info() checks isinstance(env.action_space, gym.spaces.Box)
+except ImportError:
+    class Box:  # a minimal gym.spaces.Box
+        def __init__(self, low, high, shape, dtype=np.float32):
+            self.low = np.full(shape, low, dtype=dtype)
+            self.high = np.full(shape, high, dtype=dtype)
+            self.shape = shape
+            self.dtype = dtype
+
+
+    class Discrete:  # a minimal gym.spaces.Discrete
+        def __init__(self, n):
+            self.n = n
+            self.shape = ()
+            self.dtype = np.int64
+
+
+class EnvSpec:  # env.spec of gym, get_env_info() read env.spec.id and env.spec.reward_threshold
+    def __init__(self, env_id, reward_threshold, max_episode_steps):
+        self.id = env_id
+        self.reward_threshold = reward_threshold
+        self.max_episode_steps = max_episode_steps
+
+
+class VecEnv:
+    def __init__(self, env_name, env_num, state_dim, action_dim, max_action, target_reward, max_step, is_discrete,
+                 random_seed=None):
+        self.env_num = env_num
+        self.max_step = max_step  # TimeLimit of gym
+        self.spec = EnvSpec(env_name, target_reward, max_step)
+        self.observation_space = Box(-np.inf, np.inf, shape=(state_dim,), dtype=np.float32)
+        if is_discrete:
+            self.action_space = Discrete(action_dim)
+        else:
+            self.action_space = Box(-max_action, max_action, shape=(action_dim,), dtype=np.float32)
+
+        self.np_random = None
+        self.seed(random_seed)
+
+        self.states = None  # the inner states of env_num instances
+        self.step_counts = np.zeros(env_num, dtype=np.int64)
+
+    @property
+    def unwrapped(self):
+        return self
+
+    def seed(self, random_seed=None):  # None: use the global random state, which Arguments.init_for_training() set
+        self.np_random = rd if random_seed is None else rd.RandomState(random_seed)
+        return [random_seed, ]
+
+    def reset_states(self, n):  # return the inner states of n new instances
+        raise NotImplementedError
+
+    def transit(self, actions):  # update self.states, return rewards and dones (terminal, not TimeLimit)
+        raise NotImplementedError
+
+    def get_observations(self):
+        raise NotImplementedError
+
+    def reset_vec(self):
+        self.states = self.reset_states(self.env_num)
+        self.step_counts[:] = 0
+        return self.get_observations()
+
+    def step_vec(self, actions):
+        rewards, dones = self.transit(actions)
+        self.step_counts += 1
+        dones |= self.step_counts >= self.max_step
+
+        if dones.any():  # the next_state of a done instance is the reset state, mask == 0 ignores it.
+            self.states[dones] = self.reset_states(int(dones.sum()))
+            self.step_counts[dones] = 0
+        return self.get_observations(), rewards.astype(np.float32), dones, {}
+
+    def reset(self):
+        assert self.env_num == 1
+        return self.reset_vec()[0]
+
+    def step(self, action):
+        states, rewards, dones, info = self.step_vec(np.array((action,)))
+        return states[0], float(rewards[0]), bool(dones[0]), info
+
+
+class VecPendulum(VecEnv):  # the same as Pendulum-v0 of gym 0.17
+    def __init__(self, env_num=1, random_seed=None):
+        super().__init__('VecPendulum-v0', env_num, state_dim=3, action_dim=1, max_action=2.0,
+                         target_reward=-200.0, max_step=200, is_discrete=False, random_seed=random_seed)
+        self.max_speed = 8.0
+        self.max_torque = 2.0
+        self.dt = 0.05
+        self.g = 10.0
+        self.m = 1.0
+        self.l = 1.0
+
+    def reset_states(self, n):  # (theta, theta_dot)
+        return self.np_random.uniform(low=(-np.pi, -1.0), high=(np.pi, 1.0), size=(n, 2))
+
+    def transit(self, actions):
+        th, thdot = self.states[:, 0], self.states[:, 1]
+        u = np.clip(actions.reshape(self.env_num), -self.max_torque, self.max_torque)
+
+        th_norm = ((th + np.pi) % (2 * np.pi)) - np.pi
+        costs = th_norm ** 2 + 0.1 * thdot ** 2 + 0.001 * (u ** 2)
+
+        new_thdot = thdot + (-3 * self.g / (2 * self.l) * np.sin(th + np.pi) + 3. / (self.m * self.l ** 2) * u) * self.dt
+        new_th = th + new_thdot * self.dt
+        self.states[:, 0] = new_th
+        self.states[:, 1] = np.clip(new_thdot, -self.max_speed, self.max_speed)
+        return -costs, np.zeros(self.env_num, dtype=bool)
+
+    def get_observations(self):
+        th, thdot = self.states[:, 0], self.states[:, 1]
+        return np.stack((np.cos(th), np.sin(th), thdot), axis=1).astype(np.float32)
+
+
+class VecCartPole(VecEnv):  # the same as CartPole-v0 of gym 0.17
+    def __init__(self, env_num=1, random_seed=None):
+        super().__init__('VecCartPole-v0', env_num, state_dim=4, action_dim=2, max_action=1,
+                         target_reward=195.0, max_step=200, is_discrete=True, random_seed=random_seed)
+        self.gravity = 9.8
+        self.mass_cart = 1.0
+        self.mass_pole = 0.1
+        self.total_mass = self.mass_pole + self.mass_cart
+        self.length = 0.5  # actually half the pole's length
+        self.pole_mass_length = self.mass_pole * self.length
+        self.force_mag = 10.0
+        self.tau = 0.02  # seconds between state updates
+        self.theta_threshold = 12 * 2 * np.pi / 360
+        self.x_threshold = 2.4
+
+    def reset_states(self, n):  # (x, x_dot, theta, theta_dot)
+        return self.np_random.uniform(low=-0.05, high=0.05, size=(n, 4))
+
+    def transit(self, actions):
+        x, x_dot, theta, theta_dot = self.states.T
+        force = np.where(actions.reshape(self.env_num) == 1, self.force_mag, -self.force_mag)
+        cos_theta = np.cos(theta)
+        sin_theta = np.sin(theta)
+
+        temp = (force + self.pole_mass_length * theta_dot ** 2 * sin_theta) / self.total_mass
+        theta_acc = (self.gravity * sin_theta - cos_theta * temp) / (
+                self.length * (4.0 / 3.0 - self.mass_pole * cos_theta ** 2 / self.total_mass))
+        x_acc = temp - self.pole_mass_length * theta_acc * cos_theta / self.total_mass
+
+        x = x + self.tau * x_dot  # euler
+        x_dot = x_dot + self.tau * x_acc
+        theta = theta + self.tau * theta_dot
+        theta_dot = theta_dot + self.tau * theta_acc
+        self.states = np.stack((x, x_dot, theta, theta_dot), axis=1)
+
+        dones = (np.abs(x) > self.x_threshold) | (np.abs(theta) > self.theta_threshold)
+        return np.ones(self.env_num), dones
+
+    def get_observations(self):
+        return self.states.astype(np.float32)
+
+
+class VecLQR(VecEnv):  # linear-quadratic control with configurable dimension
+    def __init__(self, env_num=1, state_dim=8, action_dim=2, random_seed=None):
+        """x' = A x + B u, reward = -(x'Q x + u'R u), Q = I, R = 0.1 I, x0 ~ U(-1, 1)
+        A and B are decided by (state_dim, action_dim), not by random_seed. So the task of a env_name is fixed.
+        target_reward = 1.25 x (the return of the finite-horizon LQR controller without action clipping)
+        """
+        self.A, self.B = self.get_system(state_dim, action_dim)
+        self.Q = np.eye(state_dim)
+        self.R = np.eye(action_dim) * 0.1
+        max_step = 200
+        target_reward = -1.25 * self.get_optimal_cost(max_step)
+
+        super().__init__(f'VecLQR-s{state_dim}a{action_dim}-v0', env_num, state_dim, action_dim, max_action=1.0,
+                         target_reward=target_reward, max_step=max_step, is_discrete=False, random_seed=random_seed)
+        self.max_state = 16.0  # the open-loop system could be unstable
+
+    @staticmethod
+    def get_system(state_dim, action_dim):
+        rand = rd.RandomState(state_dim * 1943 + action_dim)
+        a = np.eye(state_dim) * 0.96 + rand.randn(state_dim, state_dim) * (0.08 / np.sqrt(state_dim))
+        b = rand.randn(state_dim, action_dim) * (0.5 / np.sqrt(action_dim))
+        return a, b
+
+    def get_optimal_cost(self, max_step):  # the expected cost of the optimal controller, Riccati recursion
+        a, b, q, r = self.A, self.B, self.Q, self.R
+        p = np.zeros_like(q)
+        for _ in range(max_step):
+            k = np.linalg.solve(r + b.T @ p @ b, b.T @ p @ a)
+            p = q + a.T @ p @ (a - b @ k)
+        return float(np.trace(p)) / 3  # E[x0' P x0], the variance of U(-1, 1) is 1/3
+
+    def reset_states(self, n):
+        return self.np_random.uniform(low=-1.0, high=1.0, size=(n, self.A.shape[0]))
+
+    def transit(self, actions):
+        u = np.clip(actions.reshape(self.env_num, -1), -1.0, 1.0)
+        x = self.states
+        costs = ((x @ self.Q) * x).sum(axis=1) + ((u @ self.R) * u).sum(axis=1)
+        self.states = np.clip(x @ self.A.T + u @ self.B.T, -self.max_state, self.max_state)
+        return -costs, np.zeros(self.env_num, dtype=bool)
+
+    def get_observations(self):
+        return self.states.astype(np.float32)
+
+
+class VecGymEnv:  # env_num gym envs with the batched API of VecEnv, for train_population() of AgentRun.py
+    def __init__(self, envs):
+        self.envs = envs
+        self.env_num = len(envs)
+        self.spec = envs[0].spec
+        self.observation_space = envs[0].observation_space
+        self.action_space = envs[0].action_space
+
+    def reset_vec(self):
+        return np.stack([env.reset() for env in self.envs]).astype(np.float32)
+
+    def step_vec(self, actions):  # reset the instances which are done, the same as VecEnv.step_vec()
+        states = list()
+        rewards = np.empty(self.env_num, dtype=np.float32)
+        dones = np.empty(self.env_num, dtype=bool)
+        for i, env in enumerate(self.envs):
+            state, rewards[i], dones[i], _ = env.step(actions[i])
+            states.append(env.reset() if dones[i] else state)
+        return np.stack(states).astype(np.float32), rewards, dones, {}
+
+
+def build_vec_env(env_name, env_num=1, random_seed=None):
+    if env_name == 'VecPendulum-v0':
+        env = VecPendulum(env_num, random_seed)
+    elif env_name == 'VecCartPole-v0':
+        env = VecCartPole(env_num, random_seed)
+    elif env_name == 'VecLQR-v0':
+        env = VecLQR(env_num, random_seed=random_seed)
+    elif env_name.startswith('VecLQR-s'):  # 'VecLQR-s{state_dim}a{action_dim}-v0'
+        state_dim, action_dim = env_name[len('VecLQR-s'):-len('-v0')].split('a')
+        env = VecLQR(env_num, int(state_dim), int(action_dim), random_seed=random_seed)
+    else:
+        raise ValueError(f"| build_vec_env: unknown env_name {env_name}")
+    return env
+
+
+def run_throughput_test(env_num=2 ** 10, step_num=2 ** 10):  # env steps per second of the batched API
+    for env_name in ('VecPendulum-v0', 'VecCartPole-v0', 'VecLQR-v0', 'VecLQR-s64a16-v0'):
+        env = build_vec_env(env_name, env_num, random_seed=1943)
+        env.reset_vec()
+        if isinstance(env.action_space, Discrete):
+            actions = rd.randint(env.action_space.n, size=(step_num, env_num))
+        else:
+            actions = rd.uniform(-1, 1, size=(step_num, env_num, env.action_space.shape[0]))
+
+        start_time = time.time()
+        for i in range(step_num):
+            env.step_vec(actions[i])
+        used_time = time.time() - start_time
+        print(f"| {env_name:20}  env_num {env_num:6}  step/s {step_num * env_num / used_time:12.0f}")
+
+
+if __name__ == '__main__':
+    run_throughput_test()
@@ -8,7 +8,7 @@ Issay, Easy Essay, EAsy esSAY 谐音: 意识
 
 
 class InterDPG(nn.Module):  # class AgentIntelAC
-    def __init__(self, state_dim, action_dim, mid_dim):
+    def __init__(self, state_dim, action_dim, mid_dim, if_recompute=False):
         super().__init__()
         self.enc_s = nn.Sequential(
             nn.Linear(state_dim, mid_dim), nn.ReLU(),
@@ -19,7 +19,7 @@ class InterDPG(nn.Module):  # class AgentIntelAC
             nn.Linear(mid_dim, mid_dim),
         )
 
-        self.net = DenseNet(mid_dim)
+        self.net = DenseNet(mid_dim, if_recompute)
         net_out_dim = mid_dim * 4
         self.dec_a = nn.Sequential(nn.Linear(net_out_dim, mid_dim), HardSwish(),
                                    nn.Linear(mid_dim, action_dim), nn.Tanh(), )
@@ -44,11 +44,16 @@ class InterDPG(nn.Module):  # class AgentIntelAC
         return a if noise_std == 0.0 else self.add_noise(a, noise_std)
 
     def critic(self, s, a):
-        s_ = self.enc_s(s)
-        a_ = self.enc_a(a)
-        q_ = self.net(s_ + a_)
-        q = self.dec_q(q_)
-        return q
+        return self.critic_(self.enc_s(s), a)
+
+    '''feature reuse: encode a state batch once, s_ = self.enc_s(s), for both actor_() and critic_()'''
+
+    def actor_(self, s_):
+        return self.dec_a(self.net(s_))
+
+    def critic_(self, s_, a):
+        q_ = self.net(s_ + self.enc_a(a))
+        return self.dec_q(q_)
 
     def next__q_a(self, s, s_next, noise_std):
         s_ = self.enc_s(s)
@@ -72,7 +77,7 @@ class InterDPG(nn.Module):  # class AgentIntelAC
 
 
 class InterSPG(nn.Module):  # class AgentIntelAC for SAC (SPG means stochastic policy gradient)
-    def __init__(self, state_dim, action_dim, mid_dim):
+    def __init__(self, state_dim, action_dim, mid_dim, if_recompute=False):
         super().__init__()
         self.log_std_min = -20
         self.log_std_max = 2
@@ -89,7 +94,7 @@ class InterSPG(nn.Module):  # class AgentIntelAC for SAC (SPG means stochastic p
             nn.Linear(mid_dim, mid_dim),
         )  # action without nn.Tanh()
 
-        self.net = DenseNet2(mid_dim)
+        self.net = DenseNet2(mid_dim, if_recompute)
         net_out_dim = self.net.out_dim
 
         # decoder
@@ -135,40 +140,40 @@ class InterSPG(nn.Module):  # class AgentIntelAC for SAC (SPG means stochastic p
         return a_mean.tanh()
 
     def get__a__log_prob(self, state):  # actor
-        s_ = self.enc_s(state)
-        a_ = self.net(s_)
-        a_mean = self.dec_a(a_)  # NOTICE! it is a_mean without .tanh()
-        a_std_log = self.dec_d(a_).clamp(self.log_std_min, self.log_std_max)
-        a_std = a_std_log.exp()
+        return self.dec__a__log_prob(self.net(self.enc_s(state)))
 
-        """add noise to action, stochastic policy"""
-        # a_noise = torch.normal(a_mean, a_std, requires_grad=True)
-        # the above is not same as below, because it needs gradient
-        a_noise = a_mean + a_std * torch.randn_like(a_mean, requires_grad=True, device=self.device)
+    def get__a__std(self, state):
+        return self.dec__a__std(self.net(self.enc_s(state)))
 
-        '''compute log_prob according to mean and std of action (stochastic policy)'''
-        # a_delta = a_noise - a_mean).pow(2) /(2* a_std.pow(2)
-        # log_prob_noise = -a_delta - a_std.log() - np.log(np.sqrt(2 * np.pi))
-        # same as:
-        a_delta = ((a_noise - a_mean) / a_std).pow(2) * 0.5
-        log_prob_noise = a_delta + a_std_log + self.constant_log_sqrt_2pi
+    def get__a__avg_std_noise_prob(self, state):  # actor
+        return self.dec__a__avg_std_noise_prob(self.net(self.enc_s(state)))
 
-        a_noise_tanh = a_noise.tanh()
-        # log_prob = log_prob_noise - (1 - a_noise_tanh.pow(2) + epsilon).log() # epsilon = 1e-6
-        # same as:
-        log_prob = log_prob_noise + (-a_noise_tanh.pow(2) + 1.000001).log()
-        return a_noise_tanh, log_prob.sum(1, keepdim=True)
+    def get__q1_q2(self, s, a):  # critic
+        return self.dec__q1_q2(self.get__q_(self.enc_s(s), a))
 
-    def get__a__std(self, state):
-        s_ = self.enc_s(state)
-        a_ = self.net(s_)
+    '''feature reuse: encode a state batch once, then reuse its features in the actor heads and critic heads
+    s_ = self.enc_s(s)  # state feature, for both actor and critic
+    a_ = self.net(s_)  # trunk feature of actor, for dec_a and dec_d
+    q_ = self.get__q_(s_, a)  # trunk feature of critic, for dec_q1 and dec_q2
+    '''
+
+    def get__q_(self, s_, a):
+        return self.net(s_ + self.enc_a(a))
+
+    def get__a__q_(self, s_, a):  # the trunk features of actor and critic in one pass of self.net
+        x_ = self.net(torch.cat((s_, s_ + self.enc_a(a)), dim=0))
+        return x_.chunk(2, dim=0)
+
+    def dec__a__std(self, a_):
         a_mean = self.dec_a(a_)  # NOTICE! it is a_mean without .tanh()
         a_std_log = self.dec_d(a_).clamp(self.log_std_min, self.log_std_max)
         return a_mean.tanh(), a_std_log
 
-    def get__a__avg_std_noise_prob(self, state):  # actor
-        s_ = self.enc_s(state)
-        a_ = self.net(s_)
+    def dec__a__log_prob(self, a_):
+        a_mean_tanh, a_std_log, a_noise_tanh, log_prob = self.dec__a__avg_std_noise_prob(a_)
+        return a_noise_tanh, log_prob
+
+    def dec__a__avg_std_noise_prob(self, a_):
         a_mean = self.dec_a(a_)  # NOTICE! it is a_mean without .tanh()
         a_std_log = self.dec_d(a_).clamp(self.log_std_min, self.log_std_max)
         a_std = a_std_log.exp()
@@ -192,17 +197,12 @@ class InterSPG(nn.Module):  # class AgentIntelAC for SAC (SPG means stochastic p
         log_prob = log_prob_noise + (-a_noise_tanh.pow(2) + 1.000001).log()
         return a_mean.tanh(), a_std_log, a_noise_tanh, log_prob.sum(1, keepdim=True)
 
-    def get__q1_q2(self, s, a):  # critic
-        s_ = self.enc_s(s)
-        a_ = self.enc_a(a)
-        q_ = self.net(s_ + a_)
-        q1 = self.dec_q1(q_)
-        q2 = self.dec_q2(q_)
-        return q1, q2
+    def dec__q1_q2(self, q_):
+        return self.dec_q1(q_), self.dec_q2(q_)
 
 
 class InterGAE(nn.Module):
-    def __init__(self, state_dim, action_dim, mid_dim):
+    def __init__(self, state_dim, action_dim, mid_dim, if_recompute=False):
         super().__init__()
         self.log_std_min = -20
         self.log_std_max = 2
@@ -215,7 +215,7 @@ class InterGAE(nn.Module):
         )  # state
 
         '''use densenet'''
-        self.net = DenseNet(mid_dim)
+        self.net = DenseNet(mid_dim, if_recompute)
         net_out_dim = self.net.out_dim
         # '''not use densenet'''
         # self.net = nn.Sequential(nn.Linear(mid_dim, mid_dim), nn.ReLU(), )
@@ -280,8 +280,21 @@ class InterGAE(nn.Module):
         return a_noise, log_prob.sum(1)
 
     def compute__log_prob(self, state, a_noise):
-        x = self.enc_s(state)
-        x = self.net(x)
+        return self.dec__log_prob(self.get__x_(state), a_noise)
+
+    def get__q1_q2(self, s):
+        return self.dec__q1_q2(self.get__x_(s))
+
+    def compute__log_prob__q1_q2(self, state, a_noise):  # actor and critic share one trunk pass
+        x = self.get__x_(state)
+        return (self.dec__log_prob(x, a_noise), *self.dec__q1_q2(x))
+
+    '''feature reuse: the actor heads and critic heads share the trunk feature x = self.get__x_(s)'''
+
+    def get__x_(self, s):
+        return self.net(self.enc_s(s))
+
+    def dec__log_prob(self, x, a_noise):
         a_mean = self.dec_a(x)
         a_log_std = self.dec_d(x).clamp(self.log_std_min, self.log_std_max)
         a_std = torch.exp(a_log_std)
@@ -291,9 +304,7 @@ class InterGAE(nn.Module):
         log_prob = log_prob.sum(1)
         return log_prob
 
-    def get__q1_q2(self, s):
-        x = self.enc_s(s)
-        x = self.net(x)
+    def dec__q1_q2(self, x):
         q1 = self.dec_q1(x)
         q2 = self.dec_q2(x)
         return q1, q2
@@ -319,13 +330,13 @@ class Actor(nn.Module):
 
 
 class ActorDN(nn.Module):  # dn: DenseNet
-    def __init__(self, state_dim, action_dim, mid_dim, use_dn):
+    def __init__(self, state_dim, action_dim, mid_dim, use_dn, if_recompute=False):
         super().__init__()
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
         if use_dn:  # use DenseNet (there are both shallow and deep network in DenseNet)
             self.net = nn.Sequential(
                 nn.Linear(state_dim, mid_dim), nn.ReLU(),
-                DenseNet(mid_dim),  # the output_dim of DenseNet is mid_dim * 4
+                DenseNet(mid_dim, if_recompute),  # the output_dim of DenseNet is mid_dim * 4
                 nn.Linear(mid_dim * 4, action_dim),
             )
         else:  # use a simple network for actor. In RL, deeper network does not mean better performance.
@@ -354,13 +365,13 @@ class ActorDN(nn.Module):  # dn: DenseNet
 
 
 class ActorSAC(nn.Module):
-    def __init__(self, state_dim, action_dim, mid_dim, use_dn):
+    def __init__(self, state_dim, action_dim, mid_dim, use_dn, if_recompute=False):
         super().__init__()
 
         if use_dn:  # use DenseNet (DenseNet has both shallow and deep linear layer)
             self.net__mid = nn.Sequential(
                 nn.Linear(state_dim, mid_dim), nn.ReLU(),
-                DenseNet(mid_dim),
+                DenseNet(mid_dim, if_recompute),
             )
             lay_dim = mid_dim * 4  # the output layer dim of DenseNet is 'mid_dim * 4'
         else:  # use a simple network for actor. Deeper network does not mean better performance in RL.
@@ -380,13 +391,13 @@ class ActorSAC(nn.Module):
         self.constant_log_sqrt_2pi = np.log(np.sqrt(2 * np.pi))
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
-    def forward(self, state, noise_std=0.0):  # in fact, noise_std is a boolean
+    def forward(self, state, noise_std=0.0):  # noise_std is the scale of the std of policy, True == 1.0
         x = self.net__mid(state)
         a_mean = self.net__mean(x)  # NOTICE! it is a_mean without .tanh()
 
         if noise_std != 0.0:
             a_std_log = self.net__std_log(x).clamp(self.log_std_min, self.log_std_max)
-            a_std = a_std_log.exp()
+            a_std = a_std_log.exp() * noise_std  # different noise levels of the explorers of build_for_apex()
             a_mean = torch.normal(a_mean, a_std)  # NOTICE! it needs .tanh()
 
         return a_mean.tanh()
@@ -463,12 +474,12 @@ class ActorPPO(nn.Module):
 
 
 class ActorGAE(nn.Module):
-    def __init__(self, state_dim, action_dim, mid_dim):
+    def __init__(self, state_dim, action_dim, mid_dim, if_recompute=False):
         super().__init__()
 
         self.net = nn.Sequential(nn.Linear(state_dim, mid_dim), nn.ReLU(),
                                  # nn.Linear(mid_dim, mid_dim), nn.ReLU(),
-                                 DenseNet(mid_dim),
+                                 DenseNet(mid_dim, if_recompute),
                                  )
         self.net__mean = nn.Linear(mid_dim * 4, action_dim)
         self.net__std_log = nn.Linear(mid_dim * 4, action_dim)
@@ -552,14 +563,190 @@ class CriticTwin(nn.Module):  # TwinSAC <- TD3(TwinDDD) <- DoubleDQN <- Double Q
         return q_value1, q_value2
 
 
+class ActorSACRNN(nn.Module):  # ActorSAC with a GRU, for sequence replay (BufferSeq) 2020-09-14
+    def __init__(self, state_dim, action_dim, mid_dim):
+        super().__init__()
+        self.enc_s = nn.Sequential(nn.Linear(state_dim, mid_dim), nn.ReLU(), )
+        self.rnn = nn.GRUCell(mid_dim, mid_dim)  # RegGRU in TutorialRNN uses nn.GRU, GRUCell resets at episode end
+        self.net__mean = nn.Linear(mid_dim, action_dim)
+        self.net__std_log = nn.Linear(mid_dim, action_dim)
+        self.hidden_dim = mid_dim
+
+        layer_norm(self.net__mean, std=0.01)  # net[-1] is output layer for action, it is no necessary.
+
+        self.log_std_min = -20
+        self.log_std_max = 2
+        self.constant_log_sqrt_2pi = np.log(np.sqrt(2 * np.pi))
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+        self.hidden = None  # the recurrent state of forward(), call reset_hidden() at the beginning of an episode
+
+    def reset_hidden(self):
+        self.hidden = None
+
+    def forward(self, state, noise_std=0.0):  # step by step with self.hidden, such as get_episode_reward()
+        x = self.enc_s(state)
+        if self.hidden is None or self.hidden.shape[0] != x.shape[0]:
+            self.hidden = torch.zeros((x.shape[0], self.hidden_dim), dtype=x.dtype, device=x.device)
+        self.hidden = self.rnn(x, self.hidden)
+        return self.get__a(self.hidden, noise_std)
+
+    def get__feature_seq(self, state_seq, hidden, reset_seq):
+        return get_rnn_feature_seq(self.rnn, self.enc_s(state_seq), hidden, reset_seq)
+
+    def get__a(self, x, noise_std=0.0):  # x is the output of self.rnn
+        a_mean = self.net__mean(x)  # NOTICE! it is a_mean without .tanh()
+        if noise_std != 0.0:
+            a_std_log = self.net__std_log(x).clamp(self.log_std_min, self.log_std_max)
+            a_std = a_std_log.exp()
+            a_mean = torch.normal(a_mean, a_std)  # NOTICE! it needs .tanh()
+        return a_mean.tanh()
+
+    def get__a__log_prob(self, x):  # x: (seq_len, batch_size, mid_dim), the same as ActorSAC.get__a__log_prob()
+        a_mean = self.net__mean(x)  # NOTICE! it needs a_mean.tanh()
+        a_std_log = self.net__std_log(x).clamp(self.log_std_min, self.log_std_max)
+        a_std = a_std_log.exp()
+
+        a_noise = a_mean + a_std * torch.randn_like(a_mean, requires_grad=True, device=self.device)
+
+        a_delta = ((a_noise - a_mean) / a_std).pow(2) * 0.5
+        log_prob_noise = a_delta + a_std_log + self.constant_log_sqrt_2pi
+
+        a_noise_tanh = a_noise.tanh()
+        log_prob = log_prob_noise + (-a_noise_tanh.pow(2) + 1.000001).log()
+        return a_noise_tanh, log_prob.sum(-1, keepdim=True)
+
+
+class CriticTwinRNN(nn.Module):  # CriticTwin with a GRU on state, for sequence replay (BufferSeq) 2020-09-14
+    def __init__(self, state_dim, action_dim, mid_dim):
+        super().__init__()
+        self.enc_s = nn.Sequential(nn.Linear(state_dim, mid_dim), nn.ReLU(), )
+        self.rnn = nn.GRUCell(mid_dim, mid_dim)
+        self.hidden_dim = mid_dim
+
+        def build_critic_network():
+            net = nn.Sequential(nn.Linear(mid_dim + action_dim, mid_dim), nn.ReLU(),
+                                nn.Linear(mid_dim, 1), )
+            layer_norm(net[-1], std=0.01)  # It is no necessary.
+            return net
+
+        self.net1 = build_critic_network()
+        self.net2 = build_critic_network()
+
+    def get__feature_seq(self, state_seq, hidden, reset_seq):
+        return get_rnn_feature_seq(self.rnn, self.enc_s(state_seq), hidden, reset_seq)
+
+    def get__q1_q2(self, x, action):  # x is the output of self.rnn
+        x = torch.cat((x, action), dim=-1)
+        q_value1 = self.net1(x)
+        q_value2 = self.net2(x)
+        return q_value1, q_value2
+
+
+def get_rnn_feature_seq(rnn_cell, x_seq, hidden, reset_seq):
+    """x_seq: (seq_len, batch_size, inp_dim), hidden: (batch_size, hidden_dim), the recurrent state before x_seq[0]
+    reset_seq: (seq_len or seq_len-1, batch_size, 1), 0.0 if the episode ends at step t, then the hidden is reset.
+    return the outputs (seq_len, batch_size, hidden_dim) and the hidden after the last step
+    """
+    y_seq = list()
+    for t in range(x_seq.shape[0]):
+        hidden = rnn_cell(x_seq[t], hidden)
+        y_seq.append(hidden)
+        if t < reset_seq.shape[0]:
+            hidden = hidden * reset_seq[t]
+    return torch.stack(y_seq), hidden
+
+
+class PopLinear(nn.Module):  # pop_num nn.Linear in one batched matmul, x: (pop_num, batch, inp_dim) 2020-09-19
+    def __init__(self, pop_num, inp_dim, out_dim):
+        super().__init__()
+        self.weight = nn.Parameter(torch.empty(pop_num, inp_dim, out_dim))
+        self.bias = nn.Parameter(torch.empty(pop_num, 1, out_dim))
+
+        bound = 1 / np.sqrt(inp_dim)  # the same as the default init of nn.Linear
+        nn.init.uniform_(self.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x):
+        return torch.baddbmm(self.bias, x, self.weight)
+
+
+class ActorSACPop(nn.Module):  # pop_num ActorSAC (use_dn=False) stacked in axis 0, for AgentPopSAC 2020-09-19
+    def __init__(self, state_dim, action_dim, mid_dim, pop_num):
+        super().__init__()
+        self.net__mid = nn.Sequential(
+            PopLinear(pop_num, state_dim, mid_dim), nn.ReLU(),
+            PopLinear(pop_num, mid_dim, mid_dim),
+        )
+        self.net__mean = PopLinear(pop_num, mid_dim, action_dim)
+        self.net__std_log = PopLinear(pop_num, mid_dim, action_dim)
+
+        layer_norm_pop(self.net__mean, std=0.01)  # net[-1] is output layer for action, it is no necessary.
+
+        self.log_std_min = -20
+        self.log_std_max = 2
+        self.constant_log_sqrt_2pi = np.log(np.sqrt(2 * np.pi))
+
+    def forward(self, state, noise_std=0.0):  # state.shape == (pop_num, batch, state_dim)
+        x = self.net__mid(state)
+        a_mean = self.net__mean(x)  # NOTICE! it is a_mean without .tanh()
+
+        if noise_std != 0.0:
+            a_std_log = self.net__std_log(x).clamp(self.log_std_min, self.log_std_max)
+            a_std = a_std_log.exp()
+            a_mean = torch.normal(a_mean, a_std)  # NOTICE! it needs .tanh()
+
+        return a_mean.tanh()
+
+    def get__a__log_prob(self, state):  # the same as ActorSAC.get__a__log_prob(), log_prob: (pop_num, batch, 1)
+        x = self.net__mid(state)
+        a_mean = self.net__mean(x)
+        a_std_log = self.net__std_log(x).clamp(self.log_std_min, self.log_std_max)
+        a_std = a_std_log.exp()
+
+        a_noise = a_mean + a_std * torch.randn_like(a_mean)
+        a_delta = ((a_noise - a_mean) / a_std).pow(2) * 0.5
+        log_prob_noise = a_delta + a_std_log + self.constant_log_sqrt_2pi
+
+        a_noise_tanh = a_noise.tanh()
+        log_prob = log_prob_noise + (-a_noise_tanh.pow(2) + 1.000001).log()
+        return a_noise_tanh, log_prob.sum(2, keepdim=True)
+
+
+class CriticTwinPop(nn.Module):  # pop_num CriticTwin stacked in axis 0, for AgentPopSAC 2020-09-19
+    def __init__(self, state_dim, action_dim, mid_dim, pop_num):
+        super().__init__()
+
+        def build_critic_network():
+            net = nn.Sequential(PopLinear(pop_num, state_dim + action_dim, mid_dim), nn.ReLU(),
+                                PopLinear(pop_num, mid_dim, mid_dim), nn.ReLU(),
+                                PopLinear(pop_num, mid_dim, 1), )
+            layer_norm_pop(net[-1], std=0.01)  # It is no necessary.
+            return net
+
+        self.net1 = build_critic_network()
+        self.net2 = build_critic_network()
+
+    def forward(self, state, action):
+        x = torch.cat((state, action), dim=2)
+        q_value = self.net1(x)
+        return q_value
+
+    def get__q1_q2(self, state, action):
+        x = torch.cat((state, action), dim=2)
+        q_value1 = self.net1(x)
+        q_value2 = self.net2(x)
+        return q_value1, q_value2
+
+
 class CriticTwinShared(nn.Module):  # 2020-06-18
-    def __init__(self, state_dim, action_dim, mid_dim, use_dn):
+    def __init__(self, state_dim, action_dim, mid_dim, use_dn, if_recompute=False):
         super().__init__()
 
         if use_dn:  # use DenseNet (DenseNet has both shallow and deep linear layer)
             self.net__mid = nn.Sequential(
                 nn.Linear(state_dim + action_dim, mid_dim), nn.ReLU(),
-                DenseNet(mid_dim),
+                DenseNet(mid_dim, if_recompute),
             )
             lay_dim = mid_dim * 4  # the output layer dim of DenseNet is 'mid_dim * 4'
         else:  # use a simple network for actor. Deeper network does not mean better performance in RL.
@@ -612,13 +799,13 @@ class CriticAdv(nn.Module):  # 2020-05-05 fix bug
 
 
 class CriticAdvTwin(nn.Module):  # 2020-05-05 fix bug
-    def __init__(self, state_dim, mid_dim):
+    def __init__(self, state_dim, mid_dim, if_recompute=False):
         super().__init__()
 
         self.net = nn.Sequential(
             nn.Linear(state_dim, mid_dim), nn.ReLU(),
             # nn.Linear(mid_dim, mid_dim), nn.ReLU(),
-            DenseNet(mid_dim),
+            DenseNet(mid_dim, if_recompute),
         )
         self.net_q1 = nn.Linear(mid_dim * 4, 1)
         self.net_q2 = nn.Linear(mid_dim * 4, 1)
@@ -651,11 +838,11 @@ class QNet(nn.Module):  # class AgentQLearning
 
 
 class QNetTwin(nn.Module):  # class AgentQLearning
-    def __init__(self, state_dim, action_dim, mid_dim, ):
+    def __init__(self, state_dim, action_dim, mid_dim, if_recompute=False):
         super().__init__()
         self.net = nn.Sequential(
             nn.Linear(state_dim, mid_dim), nn.ReLU(),
-            DenseNet(mid_dim),
+            DenseNet(mid_dim, if_recompute),
         )
         self.net_q1 = nn.Linear(mid_dim * 4, action_dim)
         self.net_q2 = nn.Linear(mid_dim * 4, action_dim)
@@ -715,11 +902,12 @@ class NnnReshape(nn.Module):
 
 
 class DenseNet(nn.Module):
-    def __init__(self, mid_dim):
+    def __init__(self, mid_dim, if_recompute=False):
         super().__init__()
         self.dense1 = nn.Sequential(nn.Linear(mid_dim * 1, mid_dim * 1), nn.ReLU(), )
         self.dense2 = nn.Sequential(nn.Linear(mid_dim * 2, mid_dim * 2), HardSwish(), )
         self.out_dim = mid_dim * 4
+        self.if_recompute = if_recompute  # recompute the activations in backward, for large mid_dim
 
         layer_norm(self.dense1[0], std=1.0)
         layer_norm(self.dense2[0], std=1.0)
@@ -727,15 +915,13 @@ class DenseNet(nn.Module):
         # self.dropout = nn.Dropout(p=0.1)
 
     def forward(self, x1):
-        x2 = torch.cat((x1, self.dense1(x1)), dim=1)
-        x3 = torch.cat((x2, self.dense2(x2)), dim=1)
+        return dense_forward(x1, (self.dense1, self.dense2), self.out_dim, self.if_recompute)
         # self.dropout.p = rd.uniform(0.0, 0.1)
         # return self.dropout(x3)
-        return x3
 
 
 class DenseNet2(nn.Module):  # plan to hyper-param: layer_number
-    def __init__(self, mid_dim):
+    def __init__(self, mid_dim, if_recompute=False):
         super().__init__()
         assert (mid_dim / (2 ** 3)) % 1 == 0
 
@@ -746,16 +932,49 @@ class DenseNet2(nn.Module):  # plan to hyper-param: layer_number
         self.dense2 = nn.Sequential(nn.Linear(id2dim(1), id2dim(1) // 2), nn.ReLU(), )
         self.dense3 = nn.Sequential(nn.Linear(id2dim(2), id2dim(2) // 2), HardSwish(), )
         self.out_dim = id2dim(3)
+        self.if_recompute = if_recompute  # recompute the activations in backward, for large mid_dim
 
         layer_norm(self.dense1[0], std=1.0)
         layer_norm(self.dense2[0], std=1.0)
         layer_norm(self.dense3[0], std=1.0)
 
     def forward(self, x1):
-        x2 = torch.cat((x1, self.dense1(x1)), dim=1)
-        x3 = torch.cat((x2, self.dense2(x2)), dim=1)
-        x4 = torch.cat((x3, self.dense3(x3)), dim=1)
-        return x4
+        return dense_forward(x1, (self.dense1, self.dense2, self.dense3), self.out_dim, self.if_recompute)
+
+
+def dense_forward(x1, dense_layers, out_dim, if_recompute=False):  # 2020-09-12
+    """x(k+1) = torch.cat((x(k), dense(x(k))), dim=1), the output of DenseNet is the last x(k).
+    no_grad (explorer, evaluator, target network): each layer writes its output into the slice of
+        one preallocated buffer, instead of allocating and copying a larger tensor by torch.cat in each layer.
+    if_recompute: autograd saves x1 only, and recomputes the activations in backward (less memory, more compute).
+        It needs PyTorch 1.11+ (use_reentrant=False), older PyTorch uses torch.cat without recomputing.
+        (the reentrant checkpoint of older PyTorch gets no gradient when x1 does not require grad, such as state)
+    The outputs are the same in all these ways.
+    """
+    if not torch.is_grad_enabled():
+        x = x1.new_empty((x1.shape[0], out_dim))
+        i = x1.shape[1]
+        x[:, :i] = x1
+        for dense in dense_layers:
+            j = i + dense[0].out_features
+            x[:, i:j] = dense(x[:, :i])
+            i = j
+        return x
+    elif if_recompute and get_torch_version() >= (1, 11):
+        from torch.utils.checkpoint import checkpoint
+        return checkpoint(dense_forward_cat, x1, dense_layers, use_reentrant=False)
+    else:
+        return dense_forward_cat(x1, dense_layers)
+
+
+def get_torch_version():  # such as (1, 6) of '1.6.0+cu101'
+    return tuple(int(''.join(c for c in v if c.isdigit()) or 0) for v in torch.__version__.split('.')[:2])
+
+
+def dense_forward_cat(x, dense_layers):  # autograd saves the input of each layer, so they are separate tensors.
+    for dense in dense_layers:
+        x = torch.cat((x, dense(x)), dim=1)
+    return x
 
 
 class HardSwish(nn.Module):
@@ -770,3 +989,9 @@ class HardSwish(nn.Module):
 def layer_norm(layer, std=1.0, bias_const=1e-6):
     torch.nn.init.orthogonal_(layer.weight, std)
     torch.nn.init.constant_(layer.bias, bias_const)
+
+
+def layer_norm_pop(layer, std=1.0, bias_const=1e-6):  # layer_norm() for each member of PopLinear
+    for weight in layer.weight.data:
+        torch.nn.init.orthogonal_(weight.t(), std)  # weight.t() is the weight of nn.Linear
+    torch.nn.init.constant_(layer.bias, bias_const)
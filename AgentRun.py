@@ -2,13 +2,15 @@ import os
 import sys
 import time  # for reward recorder
 
-import gym
 import torch
 import numpy as np
 import numpy.random as rd
 
 from AgentZoo import initial_exploration
 from AgentZoo import BufferArray, BufferArrayGPU, BufferTupleOnline
+from AgentZoo import BufferSeq
+from AgentZoo import BufferArrayPop, initial_exploration_pop
+from AgentZoo import BufferArrayPER, get_td_priority, get_n_step_memo
 
 """Zen4Jia1Hao2, GitHub: YonV1943 ElegantRL (Pytorch model-free DRL)
 I consider that Reinforcement Learning Algorithms before 2020 have not consciousness
@@ -35,6 +37,9 @@ class Arguments:  # default working setting and hyper-parameter
         self.repeat_times = 1  # Two-time Update Rule (TTUR)
         self.reward_scale = 2 ** 0  # an approximate target reward usually be closed to 256
         self.gamma = 0.99  # discount factor of future rewards
+        self.action_repeat = 1  # repeat an action for action_repeat env steps (frame skip), 1: close
+        self.n_step = 1  # n-step return of off-policy replay buffer, 1: close (1-step TD target)
+        self.if_recompute = False  # recompute the DenseNet activations in backward, less memory at large net_dim
 
         self.if_remove = True  # remove the cwd folder? (True, False, None:ask me)
         self.if_stop = True  # stop training after reaching target reward
@@ -42,15 +47,26 @@ class Arguments:  # default working setting and hyper-parameter
         self.eval_times1 = 2 ** 3  # for evaluated reward average (level 1)
         self.eval_times2 = 2 ** 4  # for evaluated reward average (level 2)
         self.random_seed = 1943  # Github: YonV 1943
+        self.telemetry_gap = 2 ** 4  # write the telemetry of build_for_mp() per telemetry_gap seconds (0: close)
+        self.save_gap = 2 ** 9  # save the checkpoint of training state per save_gap seconds (0: close)
+        self.if_resume = False  # resume from the checkpoint in cwd if its run config is the same (then cwd is kept)
+        self.dataset_dir = None  # load the offline dataset (save_dataset) into replay buffer, skip random exploration
+        self.if_save_dataset = False  # save replay buffer to f'{cwd}/dataset' after training (off-policy only)
 
-    def init_for_training(self, cpu_threads=4):
+    def init_for_training(self, cpu_threads=4, cwd=None):
         assert self.rl_agent is not None
         assert self.env_name is not None
         self.gpu_id = sys.argv[-1][-4] if self.gpu_id is None else self.gpu_id
-        self.cwd = f'./{self.rl_agent.__name__}/{self.env_name}_{self.gpu_id}'
+        self.cwd = f'./{self.rl_agent.__name__}/{self.env_name}_{self.gpu_id}' if cwd is None else cwd
 
         print('| GPU: {} | CWD: {}'.format(self.gpu_id, self.cwd))
-        whether_remove_history(self.cwd, self.if_remove)
+        import glob
+        run_config = get_run_config(**vars(self))
+        if self.if_resume and any(read_checkpoint_config(path) == run_config
+                                  for path in glob.glob(f'{self.cwd}/checkpoint_*.pkl')):
+            print("| Keep the cwd with checkpoint for resuming")
+        else:
+            whether_remove_history(self.cwd, self.if_remove)
 
         os.environ['CUDA_VISIBLE_DEVICES'] = str(self.gpu_id)
         torch.set_num_threads(cpu_threads)
@@ -67,35 +83,72 @@ class Arguments:  # default working setting and hyper-parameter
 def train_agent(
         rl_agent, net_dim, batch_size, repeat_times, gamma, reward_scale, cwd,
         env_name, max_memo, max_step, max_total_step,
-        eval_times1, eval_times2, gpu_id, show_gap, if_stop, **_kwargs):  # 2020-06-01
-    env, state_dim, action_dim, max_action, target_reward, is_discrete = build_gym_env(env_name, is_print=False)
+        eval_times1, eval_times2, gpu_id, show_gap, if_stop, action_repeat=1, n_step=1,
+        save_gap=0, if_resume=False, dataset_dir=None, if_save_dataset=False, if_recompute=False,
+        **_kwargs):  # 2020-06-01
+    env, state_dim, action_dim, max_action, target_reward, is_discrete = build_gym_env(
+        env_name, is_print=False, action_repeat=action_repeat)
 
     '''init: agent, buffer, recorder'''
     recorder = Recorder(eval_size1=eval_times1, eval_size2=eval_times2)  # todo eva_size1
-    agent = rl_agent(state_dim, action_dim, net_dim)  # training agent
+    agent = build_agent(rl_agent, state_dim, action_dim, net_dim, if_recompute)  # training agent
     agent.state = env.reset()
 
+    profiler = MarkProfiler(cwd)  # touch f'{cwd}/profile.mark' to profile the following update steps
+    checkpoint = Checkpoint(cwd, 'train', save_gap, get_run_config(
+        rl_agent, env_name, net_dim, max_memo, gamma, reward_scale, n_step, action_repeat))
+    if_resume = if_resume and checkpoint.exists()
+
     is_online_policy = bool(rl_agent.__name__ in {'AgentPPO', 'AgentGAE', 'AgentInterGAE', 'AgentDiscreteGAE'})
     if is_online_policy:
         buffer = BufferTupleOnline(max_memo)
     else:
-        buffer = BufferArray(max_memo, state_dim, 1 if is_discrete else action_dim)
-        with torch.no_grad():  # update replay buffer
-            rewards, steps = initial_exploration(env, buffer, max_step, max_action, reward_scale, gamma, action_dim)
-        recorder.update__record_explore(steps, rewards, loss_a=0, loss_c=0)
+        if rl_agent.__name__ in {'AgentRecurrentSAC', }:  # sequence replay for recurrent policy
+            buffer = BufferSeq(max_memo, state_dim, action_dim, agent.hidden_dim, agent.seq_len, agent.burn_in)
+        else:
+            buffer = BufferArray(max_memo, state_dim, 1 if is_discrete else action_dim, n_step=n_step)
+        if if_save_dataset:
+            check_dataset_buffer(buffer)
+        if if_resume:
+            pass
+        elif dataset_dir:  # warm-start by offline dataset
+            load_dataset(buffer, dataset_dir, env_name, gamma, reward_scale)
+        else:
+            raw_step = get_raw_step(env)
+            with torch.no_grad():  # update replay buffer
+                rewards, steps = initial_exploration(
+                    env, buffer, max_step, max_action, reward_scale, gamma, action_dim)
+            steps = get_raw_steps(env, steps, get_raw_step(env) - raw_step)
+            recorder.update__record_explore(steps, rewards, loss_a=0, loss_c=0)
+
+    step_counter = {'grad_step': 0}
+    if not is_online_policy:  # a batch for a gradient step
+        buffer.random_sample = count_calls(buffer.random_sample, step_counter, 'grad_step')
+
+    if if_resume:  # the env does not resume, it starts a new episode
+        checkpoint.load(agent=agent, buffer=buffer, recorder=recorder, step_counter=step_counter)
+        reset_episode_state(agent, buffer)
+        agent.state = env.reset()
+    print_memory_info(get_memory_info(agent, buffer))
 
     '''loop'''
     if_train = True
     while if_train:
         '''update replay buffer by interact with environment'''
+        raw_step = get_raw_step(env)  # the env steps of Recorder.update__record_evaluate() are not counted
         with torch.no_grad():  # for saving the GPU buffer
             rewards, steps = agent.update_buffer(
                 env, buffer, max_step, max_action, reward_scale, gamma)
+        steps = get_raw_steps(env, steps, get_raw_step(env) - raw_step)
 
         '''update network parameters by random sampling buffer for gradient descent'''
         buffer.init_before_sample()
+        profiler.check_mark()
         loss_a, loss_c = agent.update_parameters(
             buffer, max_step, batch_size, repeat_times)
+        profiler.step()
+        if is_online_policy:  # the same as sample_times in AgentPPO.update_parameters()
+            step_counter['grad_step'] += int(repeat_times * len(buffer) / batch_size)
         # if loss_c > 4:  # todo backtracking
         #     agent.save_or_load_model(cwd, if_save=False)
 
@@ -108,19 +161,120 @@ def train_agent(
             recorder.save_npy__plot_png(cwd)
 
             if_solve = recorder.check_is_solved(target_reward, gpu_id, show_gap)
+            save_memory_info(cwd, get_memory_info(agent, buffer))
+        checkpoint.check_time(agent=agent, buffer=buffer, recorder=recorder, step_counter=step_counter)
 
         '''break loop rules'''
         if_train = not ((if_stop and if_solve)
                         or recorder.total_step > max_total_step
                         or os.path.exists(f'{cwd}/stop.mark'))
+    profiler.stop()
+    checkpoint.close()
+    if if_save_dataset and not is_online_policy:
+        save_dataset(buffer, f'{cwd}/dataset', env_name, gamma, reward_scale)
     recorder.save_npy__plot_png(cwd)
 
+    train_info = {'total_step': recorder.total_step, 'used_time': time.time() - recorder.start_time,
+                  'grad_step': step_counter['grad_step'], 'eva_r_max': recorder.eva_r_max,
+                  'target_reward': target_reward, 'is_solved': recorder.is_solved,
+                  'solved_step': recorder.solved_step, 'solved_time': recorder.used_time, }
+    return train_info
+
+
+def train_population(
+        rl_agent, net_dim, batch_size, repeat_times, gamma, reward_scale, cwd,
+        env_name, max_memo, max_step, max_total_step,
+        eval_times1, show_gap, if_stop, pop_num=4, learning_rates=None, **_kwargs):  # 2020-09-19
+    """Train pop_num independent agents in one process, such as the seeds or learning rates of AgentPopSAC.
+    The networks of agents are stacked (batched matmul), the replay buffers are separate (BufferArrayPop),
+    the pop_num envs are stepped together (reset_vec, step_vec).
+    total_step is the env steps of each agent. It saves the evaluated rewards of all agents in record_population.npy
+    """
+    env = build_pop_env(env_name, pop_num)
+    eva_env = build_pop_env(env_name, pop_num)
+    state_dim, action_dim, max_action, target_reward, is_discrete = get_env_spec(env_name)
+    assert not is_discrete
+
+    agent = rl_agent(state_dim, action_dim, net_dim, pop_num, learning_rates)
+    buffer = BufferArrayPop(max_memo, state_dim, action_dim, pop_num)
+    with torch.no_grad():  # update replay buffer
+        agent.state = initial_exploration_pop(env, buffer, max_step, max_action, reward_scale, gamma, action_dim)
+    print_memory_info(get_memory_info(agent, buffer))
+
+    total_step = max_step
+    eva_r_max = np.full(pop_num, -np.inf)
+    solved_step = [None, ] * pop_num
+    record_pop = list()  # total_step, eva_r_avg of each agent
+    start_time = print_time = time.time()
+    print(f"{'Step':>8}  {'MaxR':>8}  {'avgR':>8}  {'minR':>8} |{'LossA':>8}  {'LossC':>8}  Solved")
+
+    if_train = True
+    while if_train:
+        with torch.no_grad():
+            agent.update_buffer(env, buffer, max_step, max_action, reward_scale, gamma)
+        total_step += max_step
+
+        buffer.init_before_sample()
+        loss_a, loss_c = agent.update_parameters(buffer, max_step, batch_size, repeat_times)
+
+        with torch.no_grad():
+            eva_r_avg = np.mean([get_pop_episode_rewards(eva_env, agent.act, max_action, agent.device)
+                                 for _ in range(eval_times1)], axis=0)
+        record_pop.append((total_step, *eva_r_avg))
+        if (eva_r_avg > eva_r_max).any():
+            eva_r_max = np.maximum(eva_r_max, eva_r_avg)
+            torch.save(agent.act.state_dict(), f'{cwd}/actor_pop.pth')
+        for i in np.flatnonzero(eva_r_max > target_reward):
+            solved_step[i] = total_step if solved_step[i] is None else solved_step[i]
+
+        if time.time() - print_time > show_gap:
+            print_time = time.time()
+            print(f"{total_step:8.2e}  {eva_r_max.max():8.2f}  {eva_r_avg.mean():8.2f}  {eva_r_avg.min():8.2f} |"
+                  f"{loss_a:8.2f}  {loss_c:8.2f}  {sum(step is not None for step in solved_step)}/{pop_num}")
+
+        '''break loop rules'''
+        if_train = not ((if_stop and all(step is not None for step in solved_step))
+                        or total_step > max_total_step
+                        or os.path.exists(f'{cwd}/stop.mark'))
+    np.save(f'{cwd}/record_population.npy', record_pop)
+
+    used_time = time.time() - start_time
+    train_info = {'total_step': total_step, 'used_time': used_time, 'pop_num': pop_num,
+                  'sample_per_s': total_step * pop_num / used_time,
+                  'eva_r_max': eva_r_max.tolist(), 'target_reward': target_reward, 'solved_step': solved_step, }
+    print(f"| Population: {pop_num} agents, {train_info['sample_per_s']:.0f} samples/s, "
+          f"solved {sum(step is not None for step in solved_step)}/{pop_num}")
+    return train_info
+
+
+def build_pop_env(env_name, pop_num):  # pop_num envs with the batched API (reset_vec, step_vec)
+    if env_name.startswith('Vec'):  # synthetic env in NumPy, such as 'VecPendulum-v0'
+        from AgentEnv import build_vec_env
+        return build_vec_env(env_name, env_num=pop_num)
+
+    from AgentEnv import VecGymEnv
+    return VecGymEnv([build_gym_env(env_name, is_print=False)[0] for _ in range(pop_num)])
+
+
+def get_pop_episode_rewards(env, act, max_action, device):  # the episode reward of each agent, deterministic policy
+    states = env.reset_vec()
+    reward_sums = np.zeros(env.env_num)
+    is_running = np.ones(env.env_num, dtype=bool)
+    while is_running.any():
+        s_tensor = torch.as_tensor(states[:, np.newaxis], dtype=torch.float32, device=device)
+        actions = act(s_tensor)[:, 0].cpu().numpy()
+        states, rewards, dones, _ = env.step_vec(actions * max_action)
+        reward_sums += rewards * is_running
+        is_running &= ~dones
+    return reward_sums
+
 
 """multi processing"""
 
 
 def mp__update_params(args, q_i_buf, q_o_buf, q_i_eva, q_o_eva):  # update network parameters using replay buffer
     class_agent = args.rl_agent
+    env_name = args.env_name
     max_memo = args.max_memo
     net_dim = args.net_dim
     max_step = args.max_step
@@ -129,10 +283,27 @@ def mp__update_params(args, q_i_buf, q_o_buf, q_i_eva, q_o_eva):  # update netwo
     repeat_times = args.repeat_times
     cwd = args.cwd
     if_stop = args.if_stop
+    n_step = args.n_step
+    gamma = args.gamma
+    reward_scale = args.reward_scale
+    dataset_dir = args.dataset_dir
+    if_save_dataset = args.if_save_dataset
+    telemetry = PipeTelemetry(cwd, 'params', (q_i_buf, q_o_buf, q_i_eva, q_o_eva), args.telemetry_gap)
+    checkpoint = Checkpoint(cwd, 'params', args.save_gap, get_run_config(**vars(args)))
+    if_resume = args.if_resume and checkpoint.exists()
     del args
 
-    state_dim, action_dim = q_o_buf.get()  # q_o_buf 1.
-    agent = class_agent(state_dim, action_dim, net_dim)
+    state_dim, action_dim, _, _, _ = get_env_spec(env_name)  # do not wait for the env of mp__update_buffer()
+    agent = build_agent(class_agent, state_dim, action_dim, net_dim, args.if_recompute)
+    buffer = BufferArrayGPU(max_memo, state_dim, action_dim, n_step=n_step)  # experiment replay buffer
+    if if_save_dataset:
+        check_dataset_buffer(buffer)
+    step_counter = {'total_step': 0}
+    if if_resume:  # before sending the actor to mp__update_buffer() and mp_evaluate_agent()
+        checkpoint.load(agent=agent, buffer=buffer, step_counter=step_counter)
+        reset_episode_state(None, buffer)  # the explorer does not resume, it starts a new episode
+    elif dataset_dir:  # warm-start by offline dataset
+        load_dataset(buffer, dataset_dir, env_name, gamma, reward_scale)
 
     from copy import deepcopy
     act_cpu = deepcopy(agent.act).to(torch.device("cpu"))
@@ -141,16 +312,19 @@ def mp__update_params(args, q_i_buf, q_o_buf, q_i_eva, q_o_eva):  # update netwo
     q_i_buf.put(act_cpu)  # q_i_buf 1.
     q_i_eva.put(act_cpu)  # q_i_eva 1.
 
-    buffer = BufferArrayGPU(max_memo, state_dim, action_dim)  # experiment replay buffer
+    profiler = MarkProfiler(cwd)  # touch f'{cwd}/profile.mark' to profile the following update steps
+    buffer.random_sample = telemetry.count_calls(buffer.random_sample, 'grad_step')  # a batch for a gradient step
 
     '''initial_exploration'''
     buffer_array, reward_list, step_list = q_o_buf.get()  # q_o_buf 2.
     reward_avg = np.average(reward_list)
     step_sum = sum(step_list)
-    buffer.extend_memo(buffer_array)
+    if not (if_resume or dataset_dir):  # the explorer does not resume, the random memories are not needed
+        buffer.extend_memo(buffer_array)
     q_i_eva.put((act_cpu, reward_avg, step_sum, 0, 0))  # q_i_eva 1.
+    print_memory_info(get_memory_info(agent, buffer))
 
-    total_step = step_sum
+    total_step = step_counter['total_step'] + step_sum
     if_train = True
     if_solve = False
     while if_train:
@@ -161,7 +335,9 @@ def mp__update_params(args, q_i_buf, q_o_buf, q_i_eva, q_o_eva):  # update netwo
         buffer.extend_memo(buffer_array)
 
         buffer.init_before_sample()
+        profiler.check_mark()
         loss_a_avg, loss_c_avg = agent.update_parameters(buffer, max_step, batch_size, repeat_times)
+        profiler.step()
 
         act_cpu.load_state_dict(agent.act.state_dict())
         q_i_buf.put(act_cpu)  # q_i_buf n.
@@ -169,13 +345,22 @@ def mp__update_params(args, q_i_buf, q_o_buf, q_i_eva, q_o_eva):  # update netwo
 
         if q_o_eva.qsize() > 0:
             if_solve = q_o_eva.get()  # q_o_eva n.
+        telemetry.update()
+        save_memory_info(cwd, get_memory_info(agent, buffer))
+        step_counter['total_step'] = total_step
+        checkpoint.check_time(agent=agent, buffer=buffer, step_counter=step_counter)
         '''break loop rules'''
         if_train = not ((if_stop and if_solve)
                         or total_step > max_total_step
                         or os.path.exists(f'{cwd}/stop.mark'))
 
+    profiler.stop()
+    checkpoint.close()
     q_i_buf.put('stop')
     q_i_eva.put('stop')
+    if if_save_dataset:  # after sending 'stop', the explorer and evaluator do not wait for it
+        save_dataset(buffer, f'{cwd}/dataset', env_name, gamma, reward_scale)
+    telemetry.update(if_final=True)
     while q_i_buf.qsize() > 0 or q_i_eva.qsize() > 0:
         time.sleep(1)
     time.sleep(4)
@@ -187,13 +372,14 @@ def mp__update_buffer(args, q_i_buf, q_o_buf):  # update replay buffer by intera
     max_step = args.max_step
     reward_scale = args.reward_scale
     gamma = args.gamma
+    action_repeat = args.action_repeat
+    telemetry = PipeTelemetry(args.cwd, 'buffer', (q_i_buf, q_o_buf), args.telemetry_gap)
     del args
 
     torch.set_num_threads(4)
 
-    env, state_dim, action_dim, max_action, _, is_discrete = build_gym_env(env_name, is_print=False)
-
-    q_o_buf.put((state_dim, action_dim))  # q_o_buf 1.
+    env, state_dim, action_dim, max_action, _, is_discrete = build_gym_env(
+        env_name, is_print=False, action_repeat=action_repeat)
 
     '''build evaluated only actor'''
     q_i_buf_get = q_i_buf.get()  # q_i_buf 1.
@@ -201,6 +387,7 @@ def mp__update_buffer(args, q_i_buf, q_o_buf):  # update replay buffer by intera
 
     buffer_part, reward_list, step_list = get__buffer_reward_step(
         env, max_step, max_action, reward_scale, gamma, action_dim, is_discrete)
+    step_list = get_raw_steps(env, step_list, get_raw_step(env))
 
     q_o_buf.put((buffer_part, reward_list, step_list))  # q_o_buf 2.
 
@@ -214,6 +401,7 @@ def mp__update_buffer(args, q_i_buf, q_o_buf):  # update replay buffer by intera
         step_list = list()
         step_item = 0
 
+        raw_step = get_raw_step(env)
         global_step = 0
         while global_step < max_step:
             '''select action'''
@@ -242,13 +430,17 @@ def mp__update_buffer(args, q_i_buf, q_o_buf):  # update replay buffer by intera
                 state = next_state
 
         buffer_part = np.stack([np.hstack(buf_tuple) for buf_tuple in buffer_list])
+        step_list = get_raw_steps(env, step_list, get_raw_step(env) - raw_step)
         q_o_buf.put((buffer_part, reward_list, step_list))  # q_o_buf n.
+        telemetry.add_step('explore_step', len(buffer_list))
 
         q_i_buf_get = q_i_buf.get()  # q_i_buf n.
         if q_i_buf_get == 'stop':
             is_training = False
         else:
             act = q_i_buf_get  # act == act.to(device_cpu), requires_grad=False
+        telemetry.update()
+    telemetry.update(if_final=True)
 
     while q_o_buf.qsize() > 0:
         q_o_buf.get()
@@ -265,9 +457,14 @@ def mp_evaluate_agent(args, q_i_eva, q_o_eva):  # evaluate agent and get its tot
     show_gap = args.show_gap
     eval_size1 = args.eval_times1
     eval_size2 = args.eval_times2
+    action_repeat = args.action_repeat
+    telemetry = PipeTelemetry(cwd, 'evaluate', (q_i_eva, q_o_eva), args.telemetry_gap)
+    checkpoint = Checkpoint(cwd, 'evaluate', args.save_gap, get_run_config(**vars(args)))
+    if_resume = args.if_resume and checkpoint.exists()
     del args
 
-    env, state_dim, action_dim, max_action, target_reward, is_discrete = build_gym_env(env_name, is_print=True)
+    env, state_dim, action_dim, max_action, target_reward, is_discrete = build_gym_env(
+        env_name, is_print=True, action_repeat=action_repeat)
 
     '''build evaluated only actor'''
     q_i_eva_get = q_i_eva.get()  # q_i_eva 1.
@@ -276,6 +473,8 @@ def mp_evaluate_agent(args, q_i_eva, q_o_eva):  # evaluate agent and get its tot
     torch.set_num_threads(4)
     device = torch.device('cpu')
     recorder = Recorder(eval_size1, eval_size2)
+    if if_resume:
+        checkpoint.load(recorder=recorder)
     recorder.update__record_evaluate(env, act, max_step, max_action, device, is_discrete)
 
     is_training = True
@@ -287,10 +486,12 @@ def mp_evaluate_agent(args, q_i_eva, q_o_eva):  # evaluate agent and get its tot
 
             is_solved = recorder.check_is_solved(target_reward, gpu_id, show_gap)
             q_o_eva.put(is_solved)  # q_o_eva n.
+            telemetry.add_step('eval_epoch', 1)
+            telemetry.update()
+            checkpoint.check_time(recorder=recorder)
 
             '''update actor'''
-            while q_i_eva.qsize() == 0:  # wait until q_i_eva has item
-                time.sleep(1)
+            q_i_eva.wait_for_item()  # wait until q_i_eva has item
             while q_i_eva.qsize():  # get the latest actor
                 q_i_eva_get = q_i_eva.get()  # q_i_eva n.
                 if q_i_eva_get == 'stop':
@@ -299,7 +500,9 @@ def mp_evaluate_agent(args, q_i_eva, q_o_eva):  # evaluate agent and get its tot
                 act, exp_r_avg, exp_s_sum, loss_a_avg, loss_c_avg = q_i_eva_get
                 recorder.update__record_explore(exp_s_sum, exp_r_avg, loss_a_avg, loss_c_avg)
 
+    checkpoint.close()
     recorder.save_npy__plot_png(cwd)
+    telemetry.update(if_final=True)
 
     while q_o_eva.qsize() > 0:
         q_o_eva.get()
@@ -310,10 +513,11 @@ def mp_evaluate_agent(args, q_i_eva, q_o_eva):  # evaluate agent and get its tot
 
 def build_for_mp(args):
     import multiprocessing as mp
-    q_i_buf = mp.Queue(maxsize=8)  # buffer I
-    q_o_buf = mp.Queue(maxsize=8)  # buffer O
-    q_i_eva = mp.Queue(maxsize=8)  # evaluate I
-    q_o_eva = mp.Queue(maxsize=8)  # evaluate O
+    q_i_buf = PipeQueue('q_i_buf', maxsize=8)  # buffer I
+    q_o_buf = PipeQueue('q_o_buf', maxsize=8)  # buffer O
+    q_i_eva = PipeQueue('q_i_eva', maxsize=8)  # evaluate I
+    q_o_eva = PipeQueue('q_o_eva', maxsize=8)  # evaluate O
+    get_env_spec(args.env_name)  # build the env spec cache once, before the processes read it
     process = [mp.Process(target=mp__update_params, args=(args, q_i_buf, q_o_buf, q_i_eva, q_o_eva)),
                mp.Process(target=mp__update_buffer, args=(args, q_i_buf, q_o_buf,)),
                mp.Process(target=mp_evaluate_agent, args=(args, q_i_eva, q_o_eva)), ]
@@ -322,10 +526,770 @@ def build_for_mp(args):
     print('\n')
 
 
+def mp__update_params_ddp(args, rank, learner_num, init_method, q_i_buf, q_o_buf, q_i_eva, q_o_eva, q_shards):
+    """A data-parallel learner of build_for_ddp() 2020-09-20
+    Each learner has its own replay buffer, which saves its shard of the memories from mp__update_buffer().
+    The learners all-reduce the gradients (gloo backend) before each optimizer.step(), so their parameters
+    stay the same. The learner rank 0 sends the actor to mp__update_buffer() and mp_evaluate_agent().
+    The learners should call optimizer.step() in the same order with the same learning rate. TrustRho
+    (AgentDeepSAC, AgentInterSAC, AgentInterAC) decides them by the critic loss, so it uses the average loss of learners.
+    """
+    import torch.distributed as dist
+    class_agent = args.rl_agent
+    env_name = args.env_name
+    max_memo = args.max_memo
+    net_dim = args.net_dim
+    max_step = args.max_step
+    max_total_step = args.max_total_step
+    batch_size = args.batch_size
+    repeat_times = args.repeat_times
+    cwd = args.cwd
+    if_stop = args.if_stop
+    n_step = args.n_step
+    telemetry_gap = args.telemetry_gap if rank == 0 else 0
+    telemetry = PipeTelemetry(cwd, 'params', (q_i_buf, q_o_buf, q_i_eva, q_o_eva), telemetry_gap)
+    torch.manual_seed(args.random_seed + rank)  # the learners sample different batches
+    np.random.seed(args.random_seed + rank)
+    del args
+
+    dist.init_process_group('gloo', init_method=init_method, rank=rank, world_size=learner_num)
+    torch.set_num_threads(2)
+
+    state_dim, action_dim, _, _, _ = get_env_spec(env_name)
+    agent = build_agent(class_agent, state_dim, action_dim, net_dim, args.if_recompute)
+    ddp_broadcast_agent(agent)  # the same initial parameters as the learner rank 0
+    [ddp_wrap_optimizer(item, learner_num) for item in vars(agent).values()
+     if isinstance(item, torch.optim.Optimizer)]
+    if hasattr(agent, 'trust_rho'):
+        ddp_wrap_trust_rho(agent.trust_rho, learner_num)
+
+    class_buffer = BufferArrayGPU if torch.cuda.is_available() else BufferArray
+    buffer = class_buffer(max_memo // learner_num, state_dim, action_dim, n_step=n_step)  # the shard of buffer
+    buffer.random_sample = telemetry.count_calls(buffer.random_sample, 'grad_step')  # a batch for a gradient step
+    profiler = MarkProfiler(cwd) if rank == 0 else None
+
+    from copy import deepcopy
+    act_cpu = deepcopy(agent.act).to(torch.device("cpu"))
+    act_cpu.eval()
+    [setattr(param, 'requires_grad', False) for param in act_cpu.parameters()]
+
+    def extend_buffer_shard():  # the learner rank 0 shards the memories of mp__update_buffer()
+        if rank == 0:
+            buffer_array, reward_list, step_list = q_o_buf.get()  # q_o_buf n.
+            buffer_shards = get_episode_shards(buffer_array, learner_num)  # whole episodes, in time order
+            [q_shards[i].put(buffer_shards[i]) for i in range(1, learner_num)]
+            buffer_shard = buffer_shards[0]
+        else:
+            buffer_shard = q_shards[rank].get()
+
+        if buffer_shard.shape[0] > 0:  # a shard may be empty when an episode is longer than the others
+            buffer.extend_memo(buffer_shard)
+        return (np.average(reward_list), sum(step_list)) if rank == 0 else (None, 0)
+
+    '''initial_exploration'''
+    if rank == 0:
+        q_i_buf.put(act_cpu)  # q_i_buf 1.
+        q_i_eva.put(act_cpu)  # q_i_eva 1.
+    reward_avg, step_sum = extend_buffer_shard()  # q_o_buf 2.
+    if rank == 0:
+        q_i_eva.put((act_cpu, reward_avg, step_sum, 0, 0))  # q_i_eva 1.
+
+    total_step = step_sum
+    if_train = True
+    if_solve = False
+    while if_train:
+        reward_avg, step_sum = extend_buffer_shard()  # q_o_buf n.
+        total_step += step_sum
+
+        buffer.init_before_sample()
+        ddp_sync_now_len(buffer)  # the learners should run the same number of update steps
+        profiler.check_mark() if rank == 0 else None
+        if buffer.now_len > 0:  # the same in all learners, 0: the shards of a learner are still empty
+            loss_a_avg, loss_c_avg = agent.update_parameters(buffer, max_step, batch_size, repeat_times)
+        else:
+            loss_a_avg, loss_c_avg = 0.0, 0.0
+        profiler.step() if rank == 0 else None
+
+        if rank == 0:
+            act_cpu.load_state_dict(agent.act.state_dict())
+            q_i_buf.put(act_cpu)  # q_i_buf n.
+            q_i_eva.put((act_cpu, reward_avg, step_sum, loss_a_avg, loss_c_avg))  # q_i_eva n.
+
+            if q_o_eva.qsize() > 0:
+                if_solve = q_o_eva.get()  # q_o_eva n.
+            telemetry.update()
+            save_memory_info(cwd, get_memory_info(agent, buffer))
+            '''break loop rules'''
+            if_train = not ((if_stop and if_solve)
+                            or total_step > max_total_step
+                            or os.path.exists(f'{cwd}/stop.mark'))
+        if_train_tensor = torch.tensor((int(if_train),))
+        dist.broadcast(if_train_tensor, src=0)
+        if_train = bool(if_train_tensor.item())
+
+    dist.destroy_process_group()
+    if rank != 0:
+        return
+
+    profiler.stop()
+    q_i_buf.put('stop')
+    q_i_eva.put('stop')
+    telemetry.update(if_final=True)
+    while q_i_buf.qsize() > 0 or q_i_eva.qsize() > 0:
+        time.sleep(1)
+    time.sleep(4)
+
+
+def ddp_broadcast_agent(agent):  # the networks and tensors (such as log_alpha) of the learner rank 0
+    import torch.distributed as dist
+    with torch.no_grad():
+        for item in vars(agent).values():
+            if isinstance(item, torch.nn.Module):
+                [dist.broadcast(tensor, src=0) for tensor in item.state_dict().values()]
+            elif isinstance(item, torch.Tensor):
+                dist.broadcast(item.data, src=0)
+
+
+def ddp_wrap_optimizer(optimizer, learner_num):  # all-reduce (average) the gradients before optimizer.step()
+    import torch.distributed as dist
+    params = [param for group in optimizer.param_groups for param in group['params']]
+    optimizer_step = optimizer.step
+
+    def step_after_all_reduce(*args, **kwargs):
+        for param in params:
+            if param.grad is None:
+                param.grad = torch.zeros_like(param)
+        grads = torch.cat([param.grad.reshape(-1) for param in params])  # one all_reduce for all parameters
+        dist.all_reduce(grads)
+        grads /= learner_num
+
+        offset = 0
+        for param in params:
+            numel = param.numel()
+            param.grad.copy_(grads[offset:offset + numel].view_as(param))
+            offset += numel
+        return optimizer_step(*args, **kwargs)
+
+    optimizer.step = step_after_all_reduce
+
+
+def ddp_wrap_trust_rho(trust_rho, learner_num):  # all-reduce (average) the critic loss before TrustRho.update_rho()
+    """rho decides the actor steps and the learning rate of actor (such as AgentDeepSAC.update_parameters).
+    A different rho in each learner pairs up the all_reduce of different optimizers, and the parameters drift apart.
+    """
+    import torch.distributed as dist
+    update_rho = trust_rho.update_rho
+
+    def update_rho_after_all_reduce(loss_c):
+        loss_c = torch.tensor((float(loss_c),), dtype=torch.float64)
+        dist.all_reduce(loss_c)
+        return update_rho(loss_c.item() / learner_num)
+
+    trust_rho.update_rho = update_rho_after_all_reduce
+
+
+def ddp_sync_now_len(buffer):  # the update_times of agent.update_parameters() depends on buffer.now_len
+    import torch.distributed as dist
+    now_len = torch.tensor((buffer.now_len,))
+    dist.all_reduce(now_len, op=dist.ReduceOp.MIN)
+    buffer.now_len = int(now_len.item())
+
+
+def get_episode_shards(buffer_array, shard_num):  # split a chunk of memories into shards of whole episodes
+    """The shards have about the same number of memories. An episode is not split into two shards,
+    otherwise EpisodeIndex and the n-step memories of a shard join the parts of different episodes.
+    The chunk of mp__update_buffer() ends at the end of an episode (mask == 0.0).
+    """
+    memo_num = buffer_array.shape[0]
+    ends = np.flatnonzero(buffer_array[:, 1] == 0.0) + 1  # mask == 0.0, the end of episodes
+    if ends.shape[0] == 0 or ends[-1] != memo_num:
+        ends = np.append(ends, memo_num)  # the episode which is not done stays in the last shard
+
+    targets = np.arange(1, shard_num) * (memo_num / shard_num)  # the split points of equal shards
+    split_idx = ends[np.abs(ends[np.newaxis, :] - targets[:, np.newaxis]).argmin(axis=1)]
+    return np.split(buffer_array, split_idx)
+
+
+def build_for_ddp(args, learner_num=2):  # 2020-09-20
+    """build_for_mp() with learner_num data-parallel learners (mp__update_params_ddp).
+    batch_size is the batch of each learner, so the batch of a gradient step is batch_size * learner_num.
+    max_memo is the total of the replay buffers of learners.
+    """
+    import socket
+    import multiprocessing as mp
+    from copy import copy
+    args = copy(args)  # the learners do not save checkpoints, so the evaluator neither saves nor resumes one
+    args.save_gap = 0
+    args.if_resume = False
+    q_i_buf = PipeQueue('q_i_buf', maxsize=8)  # buffer I
+    q_o_buf = PipeQueue('q_o_buf', maxsize=8)  # buffer O
+    q_i_eva = PipeQueue('q_i_eva', maxsize=8)  # evaluate I
+    q_o_eva = PipeQueue('q_o_eva', maxsize=8)  # evaluate O
+    q_shards = [mp.Queue(maxsize=8) for _ in range(learner_num)]  # the learner rank 0 sends the shards of memories
+    get_env_spec(args.env_name)  # build the env spec cache once, before the processes read it
+
+    with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:  # a free port for init_process_group()
+        sock.bind(('127.0.0.1', 0))
+        init_method = f'tcp://127.0.0.1:{sock.getsockname()[1]}'
+
+    process = [mp.Process(target=mp__update_params_ddp, args=(
+        args, rank, learner_num, init_method, q_i_buf, q_o_buf, q_i_eva, q_o_eva, q_shards))
+        for rank in range(learner_num)]
+    process.extend([mp.Process(target=mp__update_buffer, args=(args, q_i_buf, q_o_buf,)),
+                    mp.Process(target=mp_evaluate_agent, args=(args, q_i_eva, q_o_eva)), ])
+    [p.start() for p in process]
+    [p.join() for p in process]
+    print('\n')
+
+
+def mp__replay_server(args, address, authkey, actor_num, replay_ratio):  # 2020-09-21, the replay of build_for_apex()
+    """The replay server owns BufferArrayPER. It serves the connections of actor_num explorers and one learner.
+    explorer -> server: ('push', memo_array, td_errors, reward_list, step_sum, version), a chunk of memories
+    server -> explorer: (version, params) the newer actor and critic of learner, (version, None), or 'stop'
+    learner -> server: ('sample', batch_size, batch_num, indices, td_errors), the priority updates of last batches
+    server -> learner: (memories, indices, is_weights, now_len, reward_list, step_sum), batch_num batches
+    learner -> server: ('params', params) or ('stop',), no reply
+
+    replay_ratio: the sampled memories of learner per pushed memory. The server holds the reply of a push
+    (backpressure) while the explorers are ahead of the learner by more than one chunk (max_step) per explorer.
+    It does not hold them before the buffer has batch_size * 2 memories, the learner can not sample before that.
+    The explorers stop when their total steps reach max_total_step, the learner does not need to wait for them.
+    """
+    env_name = args.env_name
+    max_memo = args.max_memo
+    n_step = args.n_step
+    max_step = args.max_step
+    max_total_step = args.max_total_step
+    min_len = args.batch_size * 2  # the batch of update_parameters_per() is batch_size * k, k in [1, 2]
+    telemetry = PipeTelemetry(args.cwd, 'replay', (), args.telemetry_gap)
+    del args
+
+    from multiprocessing.connection import Listener, wait
+    state_dim, action_dim, _, _, _ = get_env_spec(env_name)
+    buffer = BufferArrayPER(max_memo, state_dim, action_dim, n_step=n_step)
+
+    listener = Listener(address, authkey=authkey)
+    conns = [listener.accept() for _ in range(actor_num + 1)]  # the explorers and the learner in any order
+    listener.close()
+
+    params = None  # the state_dict (np.ndarray) of the actor and critic of learner
+    version = 0
+    reward_list = list()  # the episode rewards of explorers since the last reply to learner
+    step_sum = 0
+    total_step = 0  # the env steps of all explorers
+    push_memo = 0
+    sample_memo = 0
+    explore_ahead = actor_num * max_step  # the pushed memories which do not wait for the learner
+    waiting = list()  # the (conn, version) of the explorers whose push is not replied (backpressure)
+    if_stop = False
+    while conns:
+        for conn in wait(conns):
+            try:
+                message = conn.recv()
+            except EOFError:  # the remote process quits
+                conns.remove(conn)
+                waiting = [item for item in waiting if item[0] is not conn]
+                continue
+
+            if message[0] == 'push':
+                _, memo_array, td_errors, rewards, steps, actor_version = message
+                buffer.extend_memo(memo_array, td_errors)
+                buffer.init_before_sample()  # now_len for the backpressure
+                reward_list.extend(rewards)
+                step_sum += steps
+                total_step += steps
+                push_memo += memo_array.shape[0]
+                waiting.append((conn, actor_version))
+                telemetry.add_step('push_memo', memo_array.shape[0])
+            elif message[0] == 'sample':
+                _, batch_size, batch_num, indices, td_errors = message
+                if indices is not None:
+                    buffer.td_error_update(td_errors, indices)
+                buffer.init_before_sample()
+                if buffer.now_len < batch_size:
+                    batch_num = 0
+
+                batches = [buffer.get_per_indices(batch_size) for _ in range(batch_num)]
+                indices = np.stack([batch[0] for batch in batches]) if batches else None
+                is_weights = np.stack([batch[1] for batch in batches]) if batches else None
+                memories = buffer.memories[indices] if batches else None  # (batch_num, batch_size, memo_dim)
+                conn.send((memories, indices, is_weights, buffer.now_len, reward_list, step_sum))
+                reward_list = list()
+                step_sum = 0
+                sample_memo += batch_size * batch_num
+                telemetry.add_step('sample_batch', batch_num)
+            elif message[0] == 'params':
+                params = message[1]
+                version += 1
+            elif message[0] == 'stop':
+                if_stop = True
+                conns.remove(conn)
+
+            '''reply to the pushes of explorers which are not ahead of the learner'''
+            if_explore = not (if_stop or total_step > max_total_step)
+            if_ahead = buffer.now_len >= min_len and push_memo - explore_ahead > sample_memo / replay_ratio
+            while waiting and not (if_explore and if_ahead):
+                actor_conn, actor_version = waiting.pop(0)
+                if if_explore:
+                    actor_conn.send((version, params if version > actor_version else None))
+                else:
+                    actor_conn.send('stop')
+                    conns.remove(actor_conn)
+            telemetry.update()
+    telemetry.update(if_final=True)
+    # print('; quit: replay')
+
+
+def mp__explore_actor(args, address, authkey, actor_id, actor_num):  # an explorer of build_for_apex()
+    """It can run on another host with the address of mp__replay_server().
+    The explorer computes the initial priorities of its memories (get_td_priority) using its copy of actor and critic,
+    and pushes them to the replay server per max_step steps. The reply has the newer actor and critic of learner.
+    """
+    env_name = args.env_name
+    net_dim = args.net_dim
+    max_step = args.max_step
+    reward_scale = args.reward_scale
+    gamma = args.gamma
+    action_repeat = args.action_repeat
+    n_step = args.n_step
+    random_seed = args.random_seed + actor_id
+    telemetry = PipeTelemetry(args.cwd, f'actor{actor_id}', (), args.telemetry_gap)
+    class_agent = args.rl_agent
+    del args
+
+    torch.set_num_threads(1)
+    torch.manual_seed(random_seed)
+    np.random.seed(random_seed)
+
+    env, state_dim, action_dim, max_action, _, is_discrete = build_gym_env(
+        env_name, is_print=False, action_repeat=action_repeat)
+
+    '''build the explore only actor and critic'''
+    from copy import deepcopy
+    agent = class_agent(state_dim, action_dim, net_dim)
+    act = deepcopy(agent.act).to(torch.device('cpu'))
+    cri = deepcopy(agent.cri).to(torch.device('cpu'))
+    del agent
+    act.eval()
+    cri.eval()
+    [setattr(param, 'requires_grad', False) for param in (*act.parameters(), *cri.parameters())]
+    explore_noise = get_apex_noise(actor_id, actor_num)
+
+    conn = get_replay_conn(address, authkey)
+
+    '''initial_exploration'''
+    buffer_part, reward_list, step_list = get__buffer_reward_step(
+        env, max_step, max_action, reward_scale, gamma, action_dim, is_discrete)
+    step_list = get_raw_steps(env, step_list, get_raw_step(env))
+    version = 0
+    conn.send(('push', buffer_part, None, reward_list, sum(step_list), version))
+
+    state = env.reset()
+    is_training = True
+    while is_training:
+        reply = conn.recv()
+        if reply == 'stop':
+            break
+        version, params = reply
+        if params is not None:
+            load_state_array(act, params['act'])
+            load_state_array(cri, params['cri'])
+
+        buffer_list = list()
+        reward_list = list()
+        reward_item = 0.0
+        step_list = list()
+        step_item = 0
+
+        raw_step = get_raw_step(env)
+        global_step = 0
+        with torch.no_grad():
+            while global_step < max_step:
+                '''select action'''
+                s_tensor = torch.tensor((state,), dtype=torch.float32, requires_grad=False)
+                a_tensor = act(s_tensor, explore_noise)
+                action = a_tensor.numpy()[0]
+
+                next_state, reward, done, _ = env.step(action * max_action)
+                reward_item += reward
+                step_item += 1
+
+                adjust_reward = reward * reward_scale
+                mask = 0.0 if done else gamma
+                buffer_list.append((adjust_reward, mask, state, action, next_state))
+
+                if done:
+                    global_step += step_item
+
+                    reward_list.append(reward_item)
+                    reward_item = 0.0
+                    step_list.append(step_item)
+                    step_item = 0
+
+                    state = env.reset()
+                else:
+                    state = next_state
+
+        buffer_part = np.stack([np.hstack(buf_tuple) for buf_tuple in buffer_list])
+        if version == 0:  # the critic is not trained, use the max priority
+            td_errors = None
+        elif n_step > 1:  # the priorities of the n-step memories which BufferArrayPER.extend_memo() saves
+            n_step_part = get_n_step_memo(buffer_part.copy(), n_step, state_dim)
+            td_errors = get_td_priority(act, cri, n_step_part, state_dim, action_dim)
+        else:
+            td_errors = get_td_priority(act, cri, buffer_part, state_dim, action_dim)
+        step_list = get_raw_steps(env, step_list, get_raw_step(env) - raw_step)
+        conn.send(('push', buffer_part, td_errors, reward_list, sum(step_list), version))
+        telemetry.add_step('explore_step', len(buffer_list))
+        telemetry.update()
+
+    conn.close()
+    telemetry.update(if_final=True)
+    # print(f'; quit: actor{actor_id}')
+
+
+def mp__update_params_apex(args, address, authkey, q_i_eva, q_o_eva):  # the learner of build_for_apex()
+    class_agent = args.rl_agent
+    env_name = args.env_name
+    max_memo = args.max_memo
+    net_dim = args.net_dim
+    max_step = args.max_step
+    max_total_step = args.max_total_step
+    batch_size = args.batch_size
+    repeat_times = args.repeat_times
+    cwd = args.cwd
+    if_stop = args.if_stop
+    telemetry = PipeTelemetry(cwd, 'params', (q_i_eva, q_o_eva), args.telemetry_gap)
+    del args
+
+    state_dim, action_dim, _, _, _ = get_env_spec(env_name)
+    agent = build_agent(class_agent, state_dim, action_dim, net_dim, args.if_recompute)
+    assert hasattr(agent, 'update_parameters_per')  # such as AgentSAC
+
+    conn = get_replay_conn(address, authkey)
+    replay = ReplayClient(conn, state_dim, action_dim, max_memo)
+    replay.random_sample_per = telemetry.count_calls(replay.random_sample_per, 'grad_step')
+    conn.send(('params', {'act': get_state_array(agent.act), 'cri': get_state_array(agent.cri)}))
+
+    from copy import deepcopy
+    act_cpu = deepcopy(agent.act).to(torch.device("cpu"))
+    act_cpu.eval()
+    [setattr(param, 'requires_grad', False) for param in act_cpu.parameters()]
+    q_i_eva.put(act_cpu)  # q_i_eva 1.
+
+    '''initial_exploration'''
+    while replay.now_len < max(max_step, batch_size * 2):  # wait for the random memories of explorers
+        time.sleep(0.1)
+        replay.init_before_sample()
+    reward_list, step_sum = replay.get_explore_record()
+    reward_avg = np.average(reward_list)
+    q_i_eva.put((act_cpu, reward_avg, step_sum, 0, 0))  # q_i_eva 1.
+
+    total_step = step_sum
+    if_train = True
+    if_solve = False
+    while if_train:
+        replay.init_before_sample()
+        loss_a_avg, loss_c_avg = agent.update_parameters_per(replay, max_step, batch_size, repeat_times)
+        conn.send(('params', {'act': get_state_array(agent.act), 'cri': get_state_array(agent.cri)}))
+
+        reward_list, step_sum = replay.get_explore_record()
+        reward_avg = np.average(reward_list) if reward_list else reward_avg
+        total_step += step_sum
+
+        act_cpu.load_state_dict(agent.act.state_dict())
+        q_i_eva.put((act_cpu, reward_avg, step_sum, loss_a_avg, loss_c_avg))  # q_i_eva n.
+
+        if q_o_eva.qsize() > 0:
+            if_solve = q_o_eva.get()  # q_o_eva n.
+        telemetry.update()
+        '''break loop rules'''
+        if_train = not ((if_stop and if_solve)
+                        or total_step > max_total_step
+                        or os.path.exists(f'{cwd}/stop.mark'))
+
+    replay.flush()  # the last priority updates
+    conn.send(('stop',))
+    conn.close()
+    q_i_eva.put('stop')
+    telemetry.update(if_final=True)
+    while q_i_eva.qsize() > 0:
+        time.sleep(1)
+    time.sleep(4)
+    # print('; quit: params')
+
+
+class ReplayClient:  # the replay buffer of mp__update_params_apex(), a proxy of the BufferArrayPER of replay server
+    def __init__(self, conn, state_dim, action_dim, max_len, batch_num=2 ** 4):
+        """It has the same sampling API as BufferArrayPER: now_len, max_len, random_sample_per(), td_error_update().
+        A request gets batch_num batches, and sends the priority updates of the previous batches, in one round trip.
+        """
+        self.conn = conn
+        self.batch_num = batch_num
+        self.now_len = 0
+        self.max_len = max_len
+
+        self.state_idx = 1 + 1 + state_dim  # reward_dim==1, done_dim==1
+        self.action_idx = self.state_idx + action_dim
+
+        self.batches = list()  # the received (memory, indices, is_weights)
+        self.per_indices = None  # the indices of the last random_sample_per(), for td_error_update()
+        self.td_indices = list()  # the priority updates which are sent with the next request
+        self.td_errors = list()
+        self.reward_list = list()  # the episode rewards and steps of explorers, see get_explore_record()
+        self.step_sum = 0
+
+    def init_before_sample(self):  # update now_len and the record of explorers
+        self.request(batch_size=0, batch_num=0)
+
+    def request(self, batch_size, batch_num):
+        if self.td_indices:
+            indices = np.concatenate(self.td_indices)
+            td_errors = np.concatenate(self.td_errors)
+        else:
+            indices = td_errors = None
+        self.td_indices = list()
+        self.td_errors = list()
+
+        self.conn.send(('sample', batch_size, batch_num, indices, td_errors))
+        memories, indices, is_weights, self.now_len, reward_list, step_sum = self.conn.recv()
+        self.reward_list.extend(reward_list)
+        self.step_sum += step_sum
+        if memories is not None:
+            self.batches.extend(zip(memories, indices, is_weights))
+
+    def flush(self):  # send the priority updates without sampling
+        if self.td_indices:
+            self.request(batch_size=0, batch_num=0)
+
+    def random_sample_per(self, batch_size, device):
+        while not self.batches:
+            self.request(batch_size, self.batch_num)
+        memory, self.per_indices, is_weights = self.batches.pop()
+        if device:
+            memory = torch.tensor(memory, dtype=torch.float32, device=device)
+            is_weights = torch.tensor(is_weights, dtype=torch.float32, device=device)
+
+        '''convert array into torch.tensor'''
+        tensors = (
+            memory[:, 0:1],  # rewards
+            memory[:, 1:2],  # masks, mark == (1-float(done)) * gamma
+            memory[:, 2:self.state_idx],  # states
+            memory[:, self.state_idx:self.action_idx],  # actions
+            memory[:, self.action_idx:],  # next_states
+            is_weights.reshape(-1, 1),  # importance sampling weights
+        )
+        return tensors
+
+    def td_error_update(self, td_errors):
+        if isinstance(td_errors, torch.Tensor):
+            td_errors = td_errors.detach().cpu().numpy()
+        self.td_indices.append(self.per_indices)
+        self.td_errors.append(td_errors.reshape(-1))
+
+    def get_explore_record(self):  # the episode rewards and steps of explorers since the last call
+        reward_list, step_sum = self.reward_list, self.step_sum
+        self.reward_list = list()
+        self.step_sum = 0
+        return reward_list, step_sum
+
+
+def get_replay_conn(address, authkey, wait_time=2 ** 6):  # connect to mp__replay_server(), it may start later
+    from multiprocessing.connection import Client
+    start_time = time.time()
+    while True:
+        try:
+            return Client(address, authkey=authkey)
+        except ConnectionRefusedError:
+            if time.time() - start_time > wait_time:
+                raise
+            time.sleep(0.1)
+
+
+def get_apex_noise(actor_id, actor_num, noise_max=2 ** 1, noise_min=2 ** -2):
+    """The explore noise of the actor_id-th explorer, noise_max to noise_min in geometric sequence (Ape-X).
+    For ActorSAC, it is the scale of the std of the policy. For Actor (DDPG, TD3), it is the std of action noise.
+    """
+    if actor_num == 1:
+        return 1.0
+    return noise_max * (noise_min / noise_max) ** (actor_id / (actor_num - 1))
+
+
+def get_state_array(net):  # the state_dict in np.ndarray, which can be sent to another host by socket
+    return {key: value.detach().cpu().numpy() for key, value in net.state_dict().items()}
+
+
+def load_state_array(net, state_array):
+    net.load_state_dict({key: torch.as_tensor(value) for key, value in state_array.items()})
+
+
+def build_for_apex(args, actor_num=4, replay_ratio=None, address=None, authkey=b'ElegantRL'):  # 2020-09-21
+    """A central replay server (mp__replay_server), actor_num explorers (mp__explore_actor) with different
+    explore noises, a learner with prioritized replay (mp__update_params_apex), and mp_evaluate_agent().
+    They talk by multiprocessing.connection (TCP socket, pickle of np.ndarray), so address can be a remote host.
+    On one host, address=None uses a free port of 127.0.0.1.
+    replay_ratio: the sampled memories per explored memory, None: batch_size (a gradient step per env step)
+    """
+    import socket
+    import multiprocessing as mp
+    from copy import copy
+    args = copy(args)  # the learners do not save checkpoints, so the evaluator neither saves nor resumes one
+    args.save_gap = 0
+    args.if_resume = False
+    q_i_eva = PipeQueue('q_i_eva', maxsize=8)  # evaluate I
+    q_o_eva = PipeQueue('q_o_eva', maxsize=8)  # evaluate O
+    get_env_spec(args.env_name)  # build the env spec cache once, before the processes read it
+
+    if address is None:
+        with socket.socket(socket.AF_INET, socket.SOCK_STREAM) as sock:  # a free port for the replay server
+            sock.bind(('127.0.0.1', 0))
+            address = ('127.0.0.1', sock.getsockname()[1])
+
+    replay_ratio = args.batch_size if replay_ratio is None else replay_ratio
+    process = [mp.Process(target=mp__replay_server, args=(args, address, authkey, actor_num, replay_ratio)),
+               mp.Process(target=mp__update_params_apex, args=(args, address, authkey, q_i_eva, q_o_eva)),
+               mp.Process(target=mp_evaluate_agent, args=(args, q_i_eva, q_o_eva)), ]
+    process.extend([mp.Process(target=mp__explore_actor, args=(args, address, authkey, actor_id, actor_num))
+                    for actor_id in range(actor_num)])
+    [p.start() for p in process]
+    [p.join() for p in process]
+    print('\n')
+
+
+class PipeQueue:  # mp.Queue with telemetry, for build_for_mp() 2020-09-09
+    def __init__(self, name, maxsize=8):
+        """Each process gets its own copy of the counters (after fork or spawn).
+        So the process that puts records the put side, and the process that gets records the get side.
+        """
+        import multiprocessing as mp
+        self.queue = mp.Queue(maxsize=maxsize)
+        self.name = name
+        self.maxsize = maxsize
+
+        self.put_num = 0
+        self.put_bytes = 0
+        self.put_time = 0.0  # the time blocked on put() (queue is full)
+        self.get_num = 0
+        self.get_bytes = 0
+        self.get_time = 0.0  # the time blocked on get() and wait_for_item() (queue is empty)
+
+    def put(self, item):
+        timer = time.time()
+        self.queue.put(item)
+        self.put_time += time.time() - timer
+        self.put_num += 1
+        self.put_bytes += get_payload_bytes(item)
+
+    def get(self):
+        timer = time.time()
+        item = self.queue.get()
+        self.get_time += time.time() - timer
+        self.get_num += 1
+        self.get_bytes += get_payload_bytes(item)
+        return item
+
+    def qsize(self):
+        return self.queue.qsize()  # NotImplementedError on macOS, the same as mp.Queue
+
+    def wait_for_item(self, poll_gap=1):
+        timer = time.time()
+        while self.queue.qsize() == 0:
+            time.sleep(poll_gap)
+        self.get_time += time.time() - timer
+
+
+class PipeTelemetry:  # 2020-09-09
+    def __init__(self, cwd, proc_name, queues, telemetry_gap):
+        """Append the telemetry of this process to f'{cwd}/record_telemetry.txt' per telemetry_gap seconds.
+        Each line is a json dict. Three processes append to the same file,
+        the line is short so that a single write() is atomic in append mode.
+        queue: depth, items, items/s, bytes, seconds blocked on put/get (the backpressure)
+        step: explore_step/s in 'buffer' process, grad_step/s in 'params' process
+        """
+        self.save_path = f'{cwd}/record_telemetry.txt'
+        self.proc_name = proc_name
+        self.queues = queues
+        self.gap = telemetry_gap
+
+        self.step_dict = dict()  # the total step of counters, such as 'explore_step', 'grad_step'
+        self.prev_step_dict = dict()
+        self.prev_queue_num = {q.name: (0, 0) for q in queues}  # (put_num, get_num)
+
+        self.start_time = time.time()
+        self.prev_time = self.start_time
+
+    def add_step(self, key, step):
+        self.step_dict[key] = self.step_dict.get(key, 0) + step
+
+    def count_calls(self, func, key):
+        return count_calls(func, self.step_dict, key)
+
+    def update(self, if_final=False):
+        if self.gap <= 0:
+            return
+        now_time = time.time()
+        if not if_final and now_time - self.prev_time < self.gap:
+            return
+        gap_time = max(now_time - self.prev_time, 1e-6)
+
+        step_dict = dict()
+        for key, step in self.step_dict.items():
+            step_dict[key] = step
+            step_dict[f'{key}/s'] = round((step - self.prev_step_dict.get(key, 0)) / gap_time, 2)
+        self.prev_step_dict = self.step_dict.copy()
+
+        queue_dict = dict()
+        for q in self.queues:
+            prev_put_num, prev_get_num = self.prev_queue_num[q.name]
+            try:
+                depth = q.qsize()
+            except NotImplementedError:  # macOS
+                depth = -1
+            queue_dict[q.name] = {
+                'depth': depth, 'maxsize': q.maxsize,
+                'put': q.put_num, 'put/s': round((q.put_num - prev_put_num) / gap_time, 3),
+                'put_bytes': q.put_bytes, 'put_block_s': round(q.put_time, 3),
+                'get': q.get_num, 'get/s': round((q.get_num - prev_get_num) / gap_time, 3),
+                'get_bytes': q.get_bytes, 'get_block_s': round(q.get_time, 3),
+            }
+            self.prev_queue_num[q.name] = (q.put_num, q.get_num)
+
+        import json
+        line = json.dumps({'proc': self.proc_name, 'pid': os.getpid(),
+                           'time': round(now_time, 3), 'used_time': round(now_time - self.start_time, 3),
+                           'final': if_final, 'peak_rss': get_peak_rss(),
+                           'step': step_dict, 'queue': queue_dict, })
+        with open(self.save_path, 'a') as f:
+            f.write(line + '\n')
+        self.prev_time = now_time
+
+
+def count_calls(func, counter, key):  # counter[key] += 1 when calling func
+    def func_with_counter(*args, **kwargs):
+        counter[key] = counter.get(key, 0) + 1
+        return func(*args, **kwargs)
+
+    return func_with_counter
+
+
+def get_payload_bytes(item):  # the approximate size of an item in mp.Queue, without pickling it again
+    if isinstance(item, np.ndarray):
+        return item.nbytes
+    elif isinstance(item, torch.Tensor):
+        return item.element_size() * item.nelement()
+    elif isinstance(item, torch.nn.Module):
+        return sum([get_payload_bytes(tensor) for tensor in item.state_dict().values()])
+    elif isinstance(item, (tuple, list)):
+        return sum([get_payload_bytes(i) for i in item])
+    else:
+        return sys.getsizeof(item)
+
+
 """utils"""
 
 
 def get_env_info(env, is_print=True):  # 2020-06-06
+    import gym  # import gym when a process builds env, get_env_spec() does not need it
     env_name = env.unwrapped.spec.id
 
     state_shape = env.observation_space.shape
@@ -369,7 +1333,8 @@ def get_env_info(env, is_print=True):  # 2020-06-06
     return state_dim, action_dim, action_max, target_reward, is_discrete
 
 
-def build_gym_env(env_name, is_print=True):
+def build_gym_env(env_name, is_print=True, action_repeat=1):
+    import gym
     assert env_name is not None
 
     if env_name == 'Pendulum-v0':
@@ -381,12 +1346,10 @@ def build_gym_env(env_name, is_print=True):
         env = gym.make(env_name)
         env = fix_car_racing_v0(env)
         state_dim, action_dim, max_action, target_reward, is_discrete = get_env_info(env, is_print)
-        assert len(state_dim)
-        # state_dim = (2, state_dim[0], state_dim[1])  # two consecutive frame (96, 96)
-        state_dim = (1, state_dim[0], state_dim[1])  # two consecutive frame (96, 96)
+        assert len(state_dim) == 3  # (stack_num, 96, 96), uint8 pixel state
     elif env_name == 'MultiWalker':
         from multiwalker_base import MultiWalkerEnv, multi_to_single_walker_decorator
-        env = MultiWalkerEnv()
+        env = MultiWalkerEnv(perf_mode=True)
         env = multi_to_single_walker_decorator(env)
 
         state_dim = sum([box.shape[0] for box in env.observation_space])
@@ -394,13 +1357,225 @@ def build_gym_env(env_name, is_print=True):
         max_action = 1.0
         target_reward = 50
         is_discrete = False
+    elif env_name.startswith('Vec'):  # synthetic env in NumPy for throughput test, such as 'VecPendulum-v0'
+        from AgentEnv import build_vec_env
+        env = build_vec_env(env_name, env_num=1)
+        state_dim, action_dim, max_action, target_reward, is_discrete = get_env_info(env, is_print)
     else:
         env = gym.make(env_name)
         state_dim, action_dim, max_action, target_reward, is_discrete = get_env_info(env, is_print)
 
+    if action_repeat > 1:
+        env = decorate_action_repeat(env, action_repeat)
     return env, state_dim, action_dim, max_action, target_reward, is_discrete
 
 
+def decorate_action_repeat(env, action_repeat):  # 2020-09-09
+    """Repeat an action for action_repeat env steps (frame skip), sum the rewards, stop early on done.
+    The policy and the replay buffer see one step. env.raw_step counts the env steps for get_raw_steps().
+    The reward of a step is the sum of action_repeat rewards, adjust reward_scale for it.
+    """
+    env.raw_step = 0
+    env.action_repeat = action_repeat
+
+    def decorator_step(env_step):
+        def new_env_step(action):
+            reward_sum = 0.0
+            for _ in range(action_repeat):
+                state, reward, done, info = env_step(action)
+                reward_sum += reward
+                env.raw_step += 1
+                if done:
+                    break
+            return state, reward_sum, done, info
+
+        return new_env_step
+
+    env.step = decorator_step(env.step)
+    env.raw_step_left = 0  # the raw steps of the unfinished episode, see get_raw_steps()
+    return env
+
+
+def get_raw_step(env):  # the env steps without action repeat
+    return getattr(env, 'raw_step', 0)
+
+
+def get_raw_steps(env, steps, raw_step):
+    """Replace the policy steps of episodes (returned by update_buffer) with raw env steps (action repeat).
+    raw_step: the env steps of the exploration. All of them (and the steps left by the previous call),
+    including the steps of the unfinished episode, are split over the finished episodes in proportion to
+    their policy steps, so the sum is exact and max_total_step stays honest.
+    They wait for the next call (env.raw_step_left) only when no episode is finished.
+    """
+    if not hasattr(env, 'raw_step_left'):  # action_repeat == 1
+        return steps
+    env.raw_step_left += raw_step
+    step_sum = sum(steps)
+    if step_sum == 0:
+        return steps
+
+    raw_steps = [int(step * env.raw_step_left / step_sum) for step in steps]
+    raw_steps[-1] += env.raw_step_left - sum(raw_steps)
+    env.raw_step_left = 0
+    return raw_steps
+
+
+def get_env_spec(env_name, spec_path='./env_spec_cache.json'):  # 2020-09-09
+    """Get (state_dim, action_dim, max_action, target_reward, is_discrete) without building env.
+    The env spec is saved in an on-disk cache (keyed by env_name) after building the env for the first time.
+    Each entry stores the version of get_env_spec_version(), an entry of an older version is rebuilt,
+    such as after changing the stack_num of fix_car_racing_v0() or the MultiWalkerEnv of build_gym_env().
+    """
+    import json
+    version = get_env_spec_version()
+    spec_dict = dict()
+    if os.path.exists(spec_path):
+        try:
+            with open(spec_path, 'r') as f:
+                spec_dict = json.load(f)
+        except (OSError, ValueError):  # rebuild a broken cache
+            spec_dict = dict()
+
+    spec_item = spec_dict.get(env_name)
+    if not isinstance(spec_item, dict) or spec_item.get('version') != version:
+        env, *env_spec = build_gym_env(env_name, is_print=False)
+        spec_dict[env_name] = {'version': version, 'env_spec': env_spec}
+        temp_path = f'{spec_path}.{os.getpid()}'  # atomic rename, the other processes never read half a file
+        with open(temp_path, 'w') as f:
+            json.dump(spec_dict, f, indent=2, default=lambda item: item.item())  # numpy scalar to Python
+        os.replace(temp_path, spec_path)
+
+    state_dim, action_dim, max_action, target_reward, is_discrete = spec_dict[env_name]['env_spec']
+    state_dim = tuple(state_dim) if isinstance(state_dim, list) else state_dim  # such as (1, 96, 96)
+    return state_dim, action_dim, max_action, target_reward, is_discrete
+
+
+def get_env_spec_version():  # the hash of the code that decides the env spec, for the cache of get_env_spec()
+    """build_gym_env(), get_env_info(), the env modules that build_gym_env() imports and the version of gym.
+    The modules are found by find_spec(), which reads no module, so it does not import gym or Box2D.
+    """
+    import hashlib
+    import inspect
+    from importlib.util import find_spec
+    md5 = hashlib.md5()
+    for func in (build_gym_env, get_env_info):
+        md5.update(inspect.getsource(func).encode())
+    for module_name in ('AgentPixel', 'multiwalker_base', 'AgentEnv'):
+        module_spec = find_spec(module_name)
+        if module_spec is not None and module_spec.origin and os.path.isfile(module_spec.origin):
+            with open(module_spec.origin, 'rb') as f:
+                md5.update(f.read())
+    try:
+        from importlib.metadata import version  # Python 3.8+
+        md5.update(version('gym').encode())
+    except ImportError:  # no importlib.metadata, or gym is not installed by pip
+        pass
+    return md5.hexdigest()
+
+
+def get_memory_info(agent, buffer):  # 2020-09-09
+    """the memory (bytes) of replay buffer, networks, gradients and optimizers (Adam state) that the agent owns.
+    A network shared by two names (such as `self.cri = self.act` in AgentInterSAC) is counted once.
+    """
+    memory_info = {'buffer': get_payload_bytes(buffer.memories if hasattr(buffer, 'memories')
+                                               else buffer.storage_list), }
+    if hasattr(buffer, 'memories') and not isinstance(buffer.memories, list):
+        memory_info['buffer_shape'] = tuple(buffer.memories.shape)  # (max_len, memo_dim)
+
+    net_info = dict()
+    optim_info = dict()
+    counted_ids = set()
+    for name, item in vars(agent).items():
+        if isinstance(item, torch.nn.Module) and id(item) not in counted_ids:
+            counted_ids.add(id(item))
+            params = list(item.parameters())
+            if len(params) == 0:  # such as self.criterion
+                continue
+            net_info[name] = {'param': sum([get_payload_bytes(p.data) for p in params]),
+                              'grad': sum([get_payload_bytes(p.grad) for p in params if p.grad is not None]), }
+        elif isinstance(item, torch.optim.Optimizer):
+            optim_info[name] = sum([get_payload_bytes(tensor)
+                                    for state in item.state.values()
+                                    for tensor in state.values() if isinstance(tensor, torch.Tensor)])
+    memory_info['net'] = net_info
+    memory_info['optim'] = optim_info  # Adam: exp_avg and exp_avg_sq (allocated after the first step)
+
+    memory_info['peak_rss'] = get_peak_rss()
+    if torch.cuda.is_available():
+        memory_info['cuda_allocated'] = torch.cuda.memory_allocated()
+        memory_info['cuda_peak'] = torch.cuda.max_memory_allocated()
+        memory_info['cuda_reserved'] = torch.cuda.memory_reserved()
+    return memory_info
+
+
+def get_peak_rss():  # the peak resident set size (bytes) of this process
+    try:
+        import resource  # Unix only
+    except ImportError:
+        return -1
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak_rss if sys.platform == 'darwin' else peak_rss * 1024  # KB on Linux, Bytes on macOS
+
+
+def print_memory_info(memory_info):
+    def to_mb(n_bytes):
+        return f"{n_bytes / 2 ** 20:.1f}MB" if n_bytes >= 2 ** 20 else f"{n_bytes / 2 ** 10:.1f}KB"
+
+    print(f"| Memory: buffer {to_mb(memory_info['buffer'])} {memory_info.get('buffer_shape', '')}  "
+          f"peak RSS {to_mb(memory_info['peak_rss'])}")
+    for name, net in memory_info['net'].items():
+        print(f"| Memory: {name:12} param {to_mb(net['param'])}  grad {to_mb(net['grad'])}")
+    for name, n_bytes in memory_info['optim'].items():
+        print(f"| Memory: {name:12} state {to_mb(n_bytes)}")
+    if 'cuda_allocated' in memory_info:
+        print(f"| Memory: CUDA allocated {to_mb(memory_info['cuda_allocated'])}  "
+              f"peak {to_mb(memory_info['cuda_peak'])}  reserved {to_mb(memory_info['cuda_reserved'])}")
+
+
+def save_memory_info(cwd, memory_info):  # append a json line per epoch
+    import json
+    memory_info = dict(memory_info, time=round(time.time(), 3), pid=os.getpid())
+    with open(f'{cwd}/record_memory.txt', 'a') as f:
+        f.write(json.dumps(memory_info) + '\n')
+
+
+def plan_memory_budget(env_name, ram_budget, rl_agent=None, net_dim=2 ** 8):  # 2020-09-09
+    """Suggest the largest max_memo (2 ** n, the style of Arguments) of replay buffer under ram_budget (bytes).
+    The memory of networks is subtracted when rl_agent is given,
+    param for all networks, and grad + Adam state (exp_avg, exp_avg_sq) for the trainable ones.
+
+    float32 is the default memo_dtype of BufferArray. float16 halves the buffer,
+    it is compatible with the state and action in range (-1, 1) or reward that are not too large (|r| < 6e4),
+    but it loses precision (about 3 decimal digits).
+    Pixel-level state (such as CarRacing) should be stored as uint8 instead.
+    """
+    state_dim, action_dim, max_action, target_reward, is_discrete = get_env_spec(env_name)
+    state_dim = state_dim if isinstance(state_dim, int) else int(np.prod(state_dim))
+    memo_dim = 1 + 1 + state_dim + (1 if is_discrete else action_dim) + state_dim
+
+    net_bytes = 0
+    if rl_agent is not None:
+        agent = rl_agent(state_dim, action_dim, net_dim)
+        memory_info = get_memory_info(agent, buffer=BufferTupleOnline(0))
+        net_bytes = sum([net['param'] for net in memory_info['net'].values()])
+        net_bytes += sum([get_payload_bytes(param.data) * 3  # grad, exp_avg, exp_avg_sq
+                          for optimizer in vars(agent).values() if isinstance(optimizer, torch.optim.Optimizer)
+                          for group in optimizer.param_groups for param in group['params']])
+    buffer_budget = ram_budget - net_bytes
+
+    plan = {'env_name': env_name, 'memo_dim': memo_dim, 'net_bytes': net_bytes, }
+    for dtype_name, item_size in (('float32', 4), ('float16', 2)):
+        max_len = buffer_budget // (memo_dim * item_size)
+        plan[dtype_name] = 2 ** int(np.log2(max_len)) if max_len >= 1 else 0
+    plan['memo_dtype'] = 'float32' if plan['float32'] >= 2 ** 17 else 'float16'  # 2 ** 17 default max_memo
+    plan['max_memo'] = plan[plan['memo_dtype']]
+
+    print(f"| Plan: {env_name}  memo_dim {memo_dim}  networks {net_bytes / 2 ** 20:.1f}MB  "
+          f"max_memo {plan['float32']:.2e} (float32) {plan['float16']:.2e} (float16)  "
+          f"suggest {plan['memo_dtype']}, max_memo {plan['max_memo']}")
+    return plan
+
+
 def draw_plot_with_2npy(cwd, train_time):  # 2020-07-07
     record_explore = np.load('%s/record_explore.npy' % cwd)  # , allow_pickle=True)
     # record_explore.append((total_step, exp_r_avg, loss_a_avg, loss_c_avg))
@@ -468,6 +1643,247 @@ def draw_plot_with_2npy(cwd, train_time):  # 2020-07-07
     plt.close()
 
 
+class MarkProfiler:  # 2020-09-09
+    def __init__(self, cwd, default_step=1):
+        """A sibling of f'{cwd}/stop.mark'. Touch f'{cwd}/profile.mark' while training,
+        (optionally write the number of update steps into it, such as `echo 4 > profile.mark`)
+        then torch.profiler captures the next N update_parameters(), and saves the chrome trace to cwd.
+        The mark is removed when the capture starts, so it captures only once for each mark.
+        """
+        self.cwd = cwd
+        self.mark_path = f'{cwd}/profile.mark'
+        self.default_step = default_step
+
+        self.profiler = None
+        self.left_step = 0
+
+    def check_mark(self):
+        if self.profiler is not None or not os.path.exists(self.mark_path):
+            return
+        try:
+            with open(self.mark_path, 'r') as f:
+                text = f.read().strip()
+            profile_step = int(text) if text else self.default_step
+        except ValueError:
+            profile_step = self.default_step
+        os.remove(self.mark_path)
+
+        try:
+            from torch.profiler import profile, ProfilerActivity  # PyTorch 1.8.1+
+        except ImportError:
+            print("| MarkProfiler: torch.profiler needs PyTorch 1.8.1+")
+            return
+        activities = [ProfilerActivity.CPU, ]
+        if torch.cuda.is_available():
+            activities.append(ProfilerActivity.CUDA)
+
+        self.profiler = profile(activities=activities, record_shapes=True, profile_memory=True)
+        self.profiler.start()
+        self.left_step = max(profile_step, 1)
+        print(f"| MarkProfiler: profile {self.left_step} update steps")
+
+    def step(self):
+        if self.profiler is None:
+            return
+        self.left_step -= 1
+        if self.left_step <= 0:
+            self.stop()
+
+    def stop(self):
+        if self.profiler is None:
+            return
+        self.profiler.stop()
+        save_path = f'{self.cwd}/profile_{int(time.time())}_{os.getpid()}.json'
+        self.profiler.export_chrome_trace(save_path)  # open it in chrome://tracing
+        print(f"| MarkProfiler: save trace in {save_path}")
+        self.profiler = None
+
+
+class Checkpoint:  # 2020-09-16
+    def __init__(self, cwd, proc_name='train', save_gap=2 ** 9, run_config=None):
+        """The resumable training state: networks, optimizers, target networks, log_alpha, TrustRho,
+        replay buffer, Recorder, step counters and RNG states. (save_or_load_model() saves the networks only)
+        save_gap: check_time() saves a checkpoint per save_gap seconds (0: close).
+        The main thread takes a snapshot in memory (CPU), a background thread writes it to
+        f'{cwd}/checkpoint_{proc_name}.pkl.tmp' and renames it (atomic), so a crash never leaves a broken checkpoint.
+        The checkpoint is removed when the training finishes normally, so a new run does not resume it.
+        run_config: see get_run_config(). A checkpoint of another run config (such as the stale checkpoint
+        of a crashed run with another rl_agent or net_dim) is not resumed, it is overwritten.
+        """
+        self.save_path = f'{cwd}/checkpoint_{proc_name}.pkl'
+        self.save_gap = save_gap
+        self.save_time = time.time()
+        self.thread = None  # the background thread which is writing the checkpoint
+        self.run_config = dict() if run_config is None else run_config
+
+    def exists(self):  # a checkpoint which can be resumed
+        if not os.path.exists(self.save_path):
+            return False
+        if read_checkpoint_config(self.save_path) != self.run_config:
+            print(f"| Checkpoint: the run config of {self.save_path} is different, do not resume")
+            return False
+        return True
+
+    def check_time(self, **objects):  # save a checkpoint of objects per save_gap seconds
+        if self.save_gap == 0 or time.time() - self.save_time < self.save_gap:
+            return
+        if self.thread is not None and self.thread.is_alive():  # the last checkpoint is still writing
+            return
+        self.save(**objects)
+
+    def save(self, **objects):
+        import threading
+        state = {name: get_object_state(obj) for name, obj in objects.items()}  # snapshot
+        state['rng_state'] = get_rng_state()
+        state['save_time'] = time.time()
+
+        self.join()
+        self.thread = threading.Thread(target=write_pickle_atomic, args=(state, self.save_path, self.run_config))
+        self.thread.start()
+        self.save_time = time.time()
+
+    def load(self, **objects):
+        import pickle
+        with open(self.save_path, 'rb') as f:
+            pickle.load(f)  # run_config, see exists()
+            state = pickle.load(f)
+        for name, obj in objects.items():
+            set_object_state(obj, state[name])
+            if isinstance(obj, Recorder):  # the time of the last run is counted, the downtime is not
+                obj.start_time += time.time() - state['save_time']
+                obj.print_time = time.time()
+        set_rng_state(state['rng_state'])
+        print(f"| Checkpoint: resume from {self.save_path}")
+
+    def join(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def close(self):  # the training finishes normally
+        self.join()
+        if os.path.exists(self.save_path):
+            os.remove(self.save_path)
+
+
+def write_pickle_atomic(state, save_path, run_config=None):
+    import pickle
+    temp_path = f'{save_path}.tmp'
+    with open(temp_path, 'wb') as f:
+        if run_config is not None:  # the small head of file, read_checkpoint_config() does not load the state
+            pickle.dump(run_config, f, protocol=4)
+        pickle.dump(state, f, protocol=4)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, save_path)
+
+
+def read_checkpoint_config(save_path):
+    import pickle
+    try:
+        with open(save_path, 'rb') as f:
+            return pickle.load(f)
+    except (OSError, EOFError, pickle.UnpicklingError):
+        return None
+
+
+def build_agent(rl_agent, state_dim, action_dim, net_dim, if_recompute=False):  # the agent that updates the network
+    """if_recompute=True is passed to the agents with DenseNet only (AgentInterAC, AgentDeepSAC, AgentInterSAC,
+    AgentGAE, AgentInterGAE, AgentDiscreteGAE, AgentDoubleDQN), the other agents have no DenseNet to recompute.
+    It changes no parameter, so the checkpoint and the saved networks are the same.
+    """
+    if if_recompute:
+        return rl_agent(state_dim, action_dim, net_dim, if_recompute=True)
+    return rl_agent(state_dim, action_dim, net_dim)
+
+
+def get_run_config(rl_agent, env_name, net_dim, max_memo, gamma, reward_scale, n_step=1, action_repeat=1,
+                   **_kwargs):  # the settings that a checkpoint must match, for Checkpoint and init_for_training()
+    return {'rl_agent': rl_agent.__name__, 'env_name': env_name, 'net_dim': net_dim, 'max_memo': max_memo,
+            'gamma': gamma, 'reward_scale': reward_scale, 'n_step': n_step, 'action_repeat': action_repeat, }
+
+
+def get_object_state(obj):  # a copy of the attributes in CPU memory, for Checkpoint
+    import types
+    from copy import deepcopy
+
+    if isinstance(obj, dict):  # such as step_counter
+        return deepcopy(obj)
+
+    state = dict()
+    for key, value in vars(obj).items():
+        if isinstance(value, (types.FunctionType, types.MethodType, torch.device)):
+            continue  # such as buffer.random_sample = count_calls(buffer.random_sample, ...)
+        elif isinstance(value, torch.nn.Module):
+            state[key] = {k: v.detach().cpu().clone() for k, v in value.state_dict().items()}
+        elif isinstance(value, torch.optim.Optimizer):
+            state[key] = get_cpu_copy(value.state_dict())
+        elif isinstance(value, torch.Tensor):  # such as log_alpha, the memories of BufferArrayGPU
+            state[key] = value.detach().cpu().clone()
+        else:  # such as TrustRho, EpisodeIndex, the memories of BufferArray
+            state[key] = deepcopy(value)
+    return state
+
+
+def set_object_state(obj, state):
+    if isinstance(obj, dict):
+        obj.update(state)
+        return
+
+    for key, value in state.items():
+        now_value = getattr(obj, key, None)
+        if isinstance(now_value, (torch.nn.Module, torch.optim.Optimizer)):
+            now_value.load_state_dict(value)
+        elif isinstance(now_value, torch.Tensor) and now_value.shape == value.shape:
+            now_value.data.copy_(value)  # keep the tensor which the optimizer holds, such as log_alpha
+        else:
+            setattr(obj, key, value)
+
+
+def reset_episode_state(agent, buffer):  # the env does not resume, so the episode in progress is closed
+    """The checkpoint saves the state of the episode in progress, but the env starts a new episode after resume.
+    agent: reward_sum, step and the recurrent state (AgentRecurrentSAC.hidden) of the episode in progress
+    buffer: close_episode(), the n-step memories waiting for the next steps (open_idx), the open episode
+    of EpisodeIndex, the last memory of BufferSeq (its next_state is the next memory, so it is marked as done)
+    """
+    if agent is not None:
+        agent.reward_sum = 0.0
+        agent.step = 0
+        if getattr(agent, 'hidden', None) is not None:
+            agent.hidden = np.zeros_like(agent.hidden)
+
+    if hasattr(buffer, 'close_episode'):
+        buffer.close_episode()
+
+
+def get_cpu_copy(item):
+    if isinstance(item, torch.Tensor):
+        return item.detach().cpu().clone()
+    elif isinstance(item, dict):
+        return {k: get_cpu_copy(v) for k, v in item.items()}
+    elif isinstance(item, (list, tuple)):
+        return type(item)(get_cpu_copy(v) for v in item)
+    else:
+        return item
+
+
+def get_rng_state():
+    import random
+    return {'random': random.getstate(),
+            'numpy': np.random.get_state(),
+            'torch': torch.get_rng_state(),
+            'cuda': torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None, }
+
+
+def set_rng_state(rng_state):
+    import random
+    random.setstate(rng_state['random'])
+    np.random.set_state(rng_state['numpy'])
+    torch.set_rng_state(rng_state['torch'])
+    if rng_state['cuda'] is not None and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all(rng_state['cuda'])
+
+
 def whether_remove_history(cwd, is_remove=None):  # 2020-03-04
     import shutil
 
@@ -492,6 +1908,7 @@ class Recorder:
         self.record_exp = list()  # total_step, exp_r_avg, loss_a_avg, loss_c_avg
         self.record_eva = list()  # total_step, eva_r_avg, eva_r_std
         self.is_solved = False
+        self.solved_step = None  # the total_step when reaching the target reward
 
         '''constant'''
         self.eva_size1 = eval_size1
@@ -542,6 +1959,7 @@ class Recorder:
             self.is_solved = True
             if self.used_time is None:
                 self.used_time = int(time.time() - self.start_time)
+                self.solved_step = self.total_step
                 print(f"{'GPU':>3}  {'Step':>8}  {'TargetR':>8} |"
                       f"{'avgR':>8}  {'stdR':>8} |"
                       f"{'ExpR':>8}  {'UsedTime':>8}  ########")
@@ -618,6 +2036,8 @@ def get_episode_reward(env, act, max_step, max_action, device, is_discrete) -> f
     reward_item = 0.0
 
     state = env.reset()
+    if hasattr(act, 'reset_hidden'):  # recurrent policy, such as ActorSACRNN
+        act.reset_hidden()
     for _ in range(max_step):
         s_tensor = torch.tensor((state,), dtype=torch.float32, device=device)
 
@@ -672,6 +2092,217 @@ def get__buffer_reward_step(env, max_step, max_action, reward_scale, gamma, acti
     return buffer_array, reward_list, step_list
 
 
+def save_dataset(buffer, data_dir, env_name, gamma, reward_scale, chunk_size=2 ** 16):  # 2020-09-17
+    """Save the memories of BufferArray (or BufferArrayGPU) into an offline dataset, from the oldest to the newest.
+    Each chunk saves one .npy file per column: f'{data_dir}/{column}_{chunk_id:05}.npy'
+    meta.json saves the env spec (get_env_spec) and the gamma, reward_scale of the rewards and masks.
+    meta.json is written at last, a dataset without meta.json is incomplete.
+    The memories should be 1-step (n_step == 1), so load_dataset() can rebuild n-step memories for any n_step.
+    """
+    import json
+    check_dataset_buffer(buffer)
+    os.makedirs(data_dir, exist_ok=True)
+
+    buffer.init_before_sample()
+    memo_num = buffer.now_len
+    memo_idx = (np.arange(memo_num) + buffer.next_idx) % buffer.max_len if buffer.is_full else np.arange(memo_num)
+    column_slices = get_dataset_columns(buffer)
+
+    chunk_num = 0
+    for i in range(0, memo_num, chunk_size):
+        memories = buffer.memories[memo_idx[i:i + chunk_size]]
+        if isinstance(memories, torch.Tensor):  # BufferArrayGPU
+            memories = memories.cpu().numpy()
+        for column, (start, end) in column_slices.items():
+            np.save(f'{data_dir}/{column}_{chunk_num:05}.npy', memories[:, start:end])
+        chunk_num += 1
+
+    state_dim, action_dim, max_action, target_reward, is_discrete = get_env_spec(env_name)
+    meta = {'env_name': env_name, 'state_dim': state_dim, 'action_dim': action_dim, 'max_action': max_action,
+            'target_reward': target_reward, 'is_discrete': is_discrete,
+            'gamma': gamma, 'reward_scale': reward_scale,
+            'memo_num': int(memo_num), 'chunk_size': chunk_size, 'chunk_num': chunk_num,
+            'columns': {column: end - start for column, (start, end) in column_slices.items()}, }
+    with open(f'{data_dir}/meta.json', 'w') as f:
+        json.dump(meta, f, indent=2, default=lambda item: item.item())  # numpy scalar to Python
+    print(f"| save_dataset: {memo_num} memories in {data_dir}")
+
+
+def check_dataset_buffer(buffer):  # check it before training, if_save_dataset should not fail after training
+    assert isinstance(buffer, (BufferArray, BufferArrayGPU)), \
+        f"| save_dataset: {type(buffer).__name__} is not supported, use BufferArray or BufferArrayGPU"
+    assert buffer.n_step == 1, "| save_dataset: the memories of n-step buffer can not be changed back to 1-step"
+
+
+def load_dataset(buffer, data_dir, env_name, gamma, reward_scale):  # 2020-09-17
+    """Load an offline dataset of save_dataset() into BufferArray (or BufferArrayGPU) by extend_memo() in chunks.
+    The rewards and masks are changed to the reward_scale and gamma of this run.
+    Only the newest memories are loaded when the dataset is larger than the buffer.
+    return: the number of loaded memories
+    """
+    import json
+    with open(f'{data_dir}/meta.json', 'r') as f:
+        meta = json.load(f)
+    if meta['env_name'] != env_name:
+        print(f"| load_dataset: Warning: the dataset is collected in {meta['env_name']}, not {env_name}")
+
+    column_slices = get_dataset_columns(buffer)
+    for column, (start, end) in column_slices.items():
+        assert meta['columns'][column] == end - start, f"| load_dataset: the dim of {column} is different"
+
+    reward_ratio = reward_scale / meta['reward_scale']
+    memo_num = meta['memo_num']
+    chunk_size = meta['chunk_size']
+    skip_num = max(memo_num - buffer.max_len, 0)  # the oldest memories which will be overwritten
+    for chunk_id in range(skip_num // chunk_size, meta['chunk_num']):
+        columns = [np.load(f'{data_dir}/{column}_{chunk_id:05}.npy', mmap_mode='r') for column in column_slices]
+        memo_array = np.hstack(columns)
+        memo_array = memo_array[max(skip_num - chunk_id * chunk_size, 0):]
+
+        memo_array[:, 0] *= reward_ratio  # reward
+        memo_array[:, 1] = np.where(memo_array[:, 1] == 0.0, 0.0, gamma)  # mask == 0.0 if done else gamma
+        for i in range(0, memo_array.shape[0], buffer.max_len):  # extend_memo() needs size <= max_len
+            buffer.extend_memo(memo_array[i:i + buffer.max_len])
+
+    buffer.init_before_sample()
+    load_num = memo_num - skip_num
+    print(f"| load_dataset: {load_num} memories from {data_dir}")
+    return load_num
+
+
+def get_dataset_columns(buffer):  # the columns of memories, memo_array == (reward, mask, state, action, next_state)
+    return {'reward': (0, 1),
+            'mask': (1, 2),
+            'state': (2, buffer.state_idx),
+            'action': (buffer.state_idx, buffer.action_idx),
+            'next_state': (buffer.action_idx, buffer.memories.shape[1]), }
+
+
+"""hyper-parameter sweep"""
+
+
+def run_sweep(args, sweep, core_num=2, cwd_root=None, save_path=None):  # 2020-09-18
+    """Train the variants of args in parallel (one process per variant), and collect the results in a table.
+    sweep: a grid {'net_dim': [2 ** 7, 2 ** 8], 'batch_size': [2 ** 7, 2 ** 8]} (4 variants)
+           or a list of overrides [{'net_dim': 2 ** 7}, {'rl_agent': AgentTD3, 'random_seed': 1944}, ...]
+    core_num: the physical cores of each variant. The variants run on disjoint CPU sets (sched_setaffinity),
+              with torch.set_num_threads(core_num), so they do not fight for the cores.
+              The number of concurrent variants is (the physical cores of this process) // core_num.
+    Each variant has its own cwd in cwd_root. The results are saved after each variant finishes.
+    """
+    import json
+    import queue
+    import multiprocessing as mp
+
+    overrides = get_sweep_overrides(sweep)
+    cores = get_cpu_cores()
+    slot_num = max(len(cores) // core_num, 1)
+    slot_cores = [cores[i * core_num:(i + 1) * core_num] for i in range(slot_num)]
+    cpu_sets = [sum(slot_core, list()) for slot_core in slot_cores]  # the siblings of a core are in one CPU set
+    cwd_root = f'./Sweep_{args.rl_agent.__name__}_{args.env_name}' if cwd_root is None else cwd_root
+    save_path = f'{cwd_root}/sweep_result.json' if save_path is None else save_path
+    os.makedirs(cwd_root, exist_ok=True)
+    print(f"| Sweep: {len(overrides)} variants, {slot_num} concurrent, CPU sets {cpu_sets}")
+
+    q_o_result = mp.Queue()
+    results = [None, ] * len(overrides)
+    waiting = list(enumerate(overrides))
+    running = dict()  # slot_id: (process, run_id)
+    while waiting or running:
+        '''start the variants on the free CPU sets'''
+        for slot_id in range(slot_num):
+            if slot_id in running or not waiting:
+                continue
+            run_id, override = waiting.pop(0)
+            cwd = f'{cwd_root}/{run_id:03}_' + '_'.join(f'{k}={get_value_name(v)}' for k, v in override.items())
+            process = mp.Process(target=mp__sweep_run, args=(
+                args, override, cwd, cpu_sets[slot_id], len(slot_cores[slot_id]), q_o_result, run_id))
+            process.start()
+            running[slot_id] = (process, run_id)
+
+        '''wait for a variant to finish'''
+        try:
+            run_id, result = q_o_result.get(timeout=4)
+            results[run_id] = result
+        except queue.Empty:  # check the processes which exit without result, such as killed by OOM
+            for process, run_id in running.values():
+                if not process.is_alive() and results[run_id] is None:
+                    results[run_id] = {'run_id': run_id, 'overrides': get_value_name(overrides[run_id]),
+                                       'error': f'exitcode {process.exitcode}'}
+        for slot_id, (process, run_id) in list(running.items()):
+            if results[run_id] is not None:
+                process.join()
+                del running[slot_id]
+
+        with open(save_path, 'w') as f:
+            json.dump([result for result in results if result is not None], f, indent=2,
+                      default=lambda item: item.item())  # numpy scalar to Python
+    print_sweep_table(results)
+    return results
+
+
+def mp__sweep_run(args, override, cwd, cpu_set, thread_num, q_o_result, run_id):
+    if hasattr(os, 'sched_setaffinity'):  # Linux only
+        os.sched_setaffinity(0, cpu_set)
+    args.update_args(override)
+    args.init_for_training(cpu_threads=thread_num, cwd=cwd)
+
+    log_file = open(f'{cwd}/train_log.txt', 'a', buffering=1)  # the prints of concurrent variants are not mixed
+    sys.stdout = sys.stderr = log_file
+    result = {'run_id': run_id, 'overrides': get_value_name(override), 'cwd': cwd, 'cpu_set': cpu_set}
+    try:
+        train_info = train_agent(**vars(args))
+        record_eva = np.load(f'{cwd}/record_evaluate.npy')  # total_step, eva_r_avg, eva_r_std
+        result.update(train_info, eva_r_avg=record_eva[-1, 1], eva_r_std=record_eva[-1, 2])
+    except Exception as error:
+        import traceback
+        traceback.print_exc()
+        result['error'] = repr(error)
+    log_file.flush()
+    q_o_result.put((run_id, result))
+
+
+def get_sweep_overrides(sweep):
+    if isinstance(sweep, dict):  # grid
+        import itertools
+        keys = list(sweep.keys())
+        return [dict(zip(keys, values)) for values in itertools.product(*[sweep[key] for key in keys])]
+    return [dict(override) for override in sweep]
+
+
+def get_cpu_cores():  # the logical CPUs of each physical core (hyper-threading siblings), for run_sweep()
+    cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else list(range(os.cpu_count()))
+    cores = dict()
+    for cpu in cpus:
+        try:
+            with open(f'/sys/devices/system/cpu/cpu{cpu}/topology/thread_siblings_list', 'r') as f:
+                siblings = f.read().strip()
+        except OSError:
+            siblings = str(cpu)
+        cores.setdefault(siblings, list()).append(cpu)
+    return list(cores.values())
+
+
+def get_value_name(value):  # such as rl_agent=AgentSAC, for the cwd name and the json of results
+    if isinstance(value, dict):
+        return {k: get_value_name(v) for k, v in value.items()}
+    return value.__name__ if hasattr(value, '__name__') else value
+
+
+def print_sweep_table(results):
+    print(f"{'ID':>3}  {'Overrides':40}  {'MaxR':>8}  {'avgR':>8}  {'Step':>8}  {'Time(s)':>8}  {'Solved':>8}")
+    for result in results:
+        if result is None:
+            continue
+        overrides = ' '.join(f'{k}={v}' for k, v in result['overrides'].items())
+        if 'error' in result:
+            print(f"{result['run_id']:>3}  {overrides:40}  | Error: {result['error']}")
+            continue
+        solved_step = f"{result['solved_step']:8.2e}" if result['is_solved'] else f"{'-':>8}"
+        print(f"{result['run_id']:>3}  {overrides:40}  {result['eva_r_max']:8.2f}  {result['eva_r_avg']:8.2f}  "
+              f"{result['total_step']:8.2e}  {result['used_time']:8.0f}  {solved_step}")
+
+
 """demo"""
 
 
@@ -683,6 +2314,35 @@ def run__demo():
     train_agent(**vars(args))
 
 
+def run__sweep():  # train 4 variants in parallel, see run_sweep()
+    import AgentZoo as Zoo
+    args = Arguments(rl_agent=Zoo.AgentSAC, env_name="Pendulum-v0", gpu_id=0)
+    args.max_total_step = int(1e4 * 8)
+    args.reward_scale = 2 ** -2
+    args.show_gap = 2 ** 6
+    run_sweep(args, {'net_dim': [2 ** 7, 2 ** 8], 'batch_size': [2 ** 7, 2 ** 8]}, core_num=2)
+
+
+def run__population():  # train 4 AgentSAC with different learning rates in one process
+    import AgentZoo as Zoo
+    args = Arguments(rl_agent=Zoo.AgentPopSAC, env_name="Pendulum-v0", gpu_id=0)
+    args.max_total_step = int(1e4 * 8)
+    args.reward_scale = 2 ** -2
+    args.show_gap = 2 ** 6
+    args.init_for_training()
+    train_population(**vars(args), pop_num=4, learning_rates=(1e-4, 2e-4, 4e-4, 8e-4))
+
+
+def run__apex():  # a central replay server, 4 explorers and a learner with prioritized replay
+    import AgentZoo as Zoo
+    args = Arguments(rl_agent=Zoo.AgentSAC, env_name="Pendulum-v0", gpu_id=0)
+    args.max_total_step = int(1e4 * 8)
+    args.reward_scale = 2 ** -2
+    args.show_gap = 2 ** 6
+    args.init_for_training()
+    build_for_apex(args, actor_num=4)
+
+
 def run__discrete_action(gpu_id=None):
     import AgentZoo as Zoo
 
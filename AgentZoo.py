@@ -8,6 +8,8 @@ import torch.nn as nn
 from AgentNet import QNet, QNetTwin, QNetDuel  # Q-learning based
 from AgentNet import Actor, Critic, CriticTwin  # DDPG, TD3
 from AgentNet import ActorSAC, CriticTwinShared  # SAC
+from AgentNet import ActorSACRNN, CriticTwinRNN  # SAC with sequence replay
+from AgentNet import ActorSACPop, CriticTwinPop  # SAC of a population in one process
 from AgentNet import ActorPPO, CriticAdv  # PPO
 from AgentNet import ActorGAE, CriticAdvTwin  # AdvGAE
 from AgentNet import InterDPG, InterSPG, InterGAE  # share params between Actor and Critic
@@ -55,6 +57,7 @@ class AgentDDPG:  # DEMO (tutorial only, simplify, low effective)
         reward_sum = 0.0
         step = 0
 
+        memo.close_episode()  # the last call may stop at max_step before done
         state = env.reset()
         for step in range(max_step):
             '''inactive with environment'''
@@ -469,16 +472,355 @@ class AgentSAC(AgentBasicAC):
         loss_c_avg = loss_c_sum / (update_times * repeat_times)
         return loss_a_avg, loss_c_avg
 
+    def update_parameters_per(self, buffer, max_step, batch_size, repeat_times):
+        """update_parameters() with Prioritized Experience Replay (BufferArrayPER or ReplayClient of build_for_apex)
+        The critic loss is weighted by the importance sampling weights, the td_errors are the new priorities.
+        """
+        loss_a_sum = 0.0
+        loss_c_sum = 0.0
 
-class AgentInterAC(AgentBasicAC):  # warning: sth. wrong
+        k = 1.0 + buffer.now_len / buffer.max_len
+        batch_size_ = int(batch_size * k)
+        update_times = int(max_step * k)
+
+        for i in range(update_times * repeat_times):
+            with torch.no_grad():
+                reward, mask, state, action, next_s, is_weights = buffer.random_sample_per(batch_size_, self.device)
+
+                next_a_noise, next_log_prob = self.act.get__a__log_prob(next_s)
+                next_q_target = torch.min(*self.cri_target.get__q1_q2(next_s, next_a_noise))  # CriticTwin
+                next_q_target = next_q_target + next_log_prob * self.alpha  # SAC, alpha
+                q_target = reward + mask * next_q_target
+            '''critic_loss'''
+            q1_value, q2_value = self.cri.get__q1_q2(state, action)  # CriticTwin
+            critic_loss = (((q1_value - q_target).pow(2) + (q2_value - q_target).pow(2)) * is_weights).mean()
+            loss_c_sum += critic_loss.item() * 0.5  # CriticTwin
+
+            self.cri_optimizer.zero_grad()
+            critic_loss.backward()
+            self.cri_optimizer.step()
+
+            td_error = ((q1_value - q_target).abs() + (q2_value - q_target).abs()) * 0.5
+            buffer.td_error_update(td_error.detach())
+
+            '''actor_loss'''
+            if i % repeat_times == 0:
+                # stochastic policy
+                actions_noise, log_prob = self.act.get__a__log_prob(state)  # policy gradient
+                # auto alpha
+                alpha_loss = (self.log_alpha * (log_prob - self.target_entropy).detach()).mean()
+                self.alpha_optimizer.zero_grad()
+                alpha_loss.backward()
+                self.alpha_optimizer.step()
+
+                # policy gradient
+                self.alpha = self.log_alpha.exp()
+                q_eval_pg = torch.min(*self.cri.get__q1_q2(state, actions_noise))  # policy gradient
+                actor_loss = -(q_eval_pg + log_prob * self.alpha).mean()  # policy gradient
+                loss_a_sum += actor_loss.item()
+
+                self.act_optimizer.zero_grad()
+                actor_loss.backward()
+                self.act_optimizer.step()
+
+            """target update"""
+            soft_target_update(self.cri_target, self.cri)  # soft target update
+
+        loss_a_avg = loss_a_sum / update_times
+        loss_c_avg = loss_c_sum / (update_times * repeat_times)
+        return loss_a_avg, loss_c_avg
+
+
+class AgentPopSAC(AgentBasicAC):  # pop_num independent AgentSAC trained in one process, see train_population()
+    def __init__(self, state_dim, action_dim, net_dim, pop_num=4, learning_rates=None):
+        """The networks of pop_num agents are stacked in axis 0, (pop_num, batch, dim). (2020-09-19)
+        The agents share no parameter and no memory (BufferArrayPop). The losses are summed over the agents,
+        so the gradient of each agent is the same as training it alone.
+        learning_rates: the learning rate of each agent, None: 1e-4 for all agents
+        """
+        super(AgentBasicAC, self).__init__()
+        self.learning_rate = 1e-4
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.pop_num = pop_num
+
+        '''network'''
+        actor_dim = net_dim
+        self.act = ActorSACPop(state_dim, action_dim, actor_dim, pop_num).to(self.device)
+        self.act.train()
+        self.act_optimizer = torch.optim.Adam(self.act.parameters(), lr=self.learning_rate)
+
+        critic_dim = int(net_dim * 1.25)
+        self.cri = CriticTwinPop(state_dim, action_dim, critic_dim, pop_num).to(self.device)
+        self.cri.train()
+        self.cri_optimizer = torch.optim.Adam(self.cri.parameters(), lr=self.learning_rate)
+
+        self.cri_target = CriticTwinPop(state_dim, action_dim, critic_dim, pop_num).to(self.device)
+        self.cri_target.eval()
+        self.cri_target.load_state_dict(self.cri.state_dict())
+
+        '''training record'''
+        self.state = None  # env.reset_vec(), shape == (pop_num, state_dim)
+        self.reward_sum = np.zeros(pop_num)
+        self.step = np.zeros(pop_num, dtype=np.int64)
+
+        '''extension: auto-alpha for maximum entropy'''
+        self.log_alpha = torch.zeros((pop_num, 1, 1), requires_grad=True, device=self.device)
+        self.alpha = self.log_alpha.exp()
+        self.alpha_optimizer = torch.optim.Adam((self.log_alpha,), lr=self.learning_rate)
+        self.target_entropy = np.log(action_dim) * 0.98
+
+        '''constant'''
+        self.explore_noise = True  # stochastic policy choose noise_std by itself.
+        if learning_rates is None:
+            self.lr_scale = None
+        else:  # Adam update is proportional to lr, pop_optimizer_step() scales the update of each agent
+            assert len(learning_rates) == pop_num
+            self.lr_scale = torch.tensor(learning_rates, dtype=torch.float32, device=self.device) / self.learning_rate
+
+    def update_buffer(self, env, buffer, max_step, max_action, reward_scale, gamma):
+        """env: pop_num envs with the batched API (reset_vec, step_vec), such as VecEnv of AgentEnv.py
+        return: rewards and steps of the finished episodes of each agent, [[r, ...], ...]
+        """
+        rewards = [list() for _ in range(self.pop_num)]
+        steps = [list() for _ in range(self.pop_num)]
+        for _ in range(max_step):
+            actions = self.select_actions(self.state[:, np.newaxis], self.explore_noise)[:, 0]
+            next_states, rewards_, dones, _ = env.step_vec(actions * max_action)
+
+            self.reward_sum += rewards_
+            self.step += 1
+
+            masks = np.where(dones, 0.0, gamma)
+            buffer.add_memo((rewards_ * reward_scale, masks, self.state, actions, next_states))
+
+            self.state = next_states  # the next_state of a done env is the state after reset
+            for i in np.flatnonzero(dones):
+                rewards[i].append(self.reward_sum[i])
+                self.reward_sum[i] = 0.0
+                steps[i].append(self.step[i])
+                self.step[i] = 0
+        return rewards, steps
+
+    def update_parameters(self, buffer, max_step, batch_size, repeat_times):
+        loss_a_sum = 0.0
+        loss_c_sum = 0.0
+
+        k = 1.0 + buffer.now_len / buffer.max_len
+        batch_size_ = int(batch_size * k)
+        update_times = int(max_step * k)
+
+        for i in range(update_times * repeat_times):
+            with torch.no_grad():
+                reward, mask, state, action, next_s = buffer.random_sample(batch_size_, self.device)
+
+                next_a_noise, next_log_prob = self.act.get__a__log_prob(next_s)
+                next_q_target = torch.min(*self.cri_target.get__q1_q2(next_s, next_a_noise))  # CriticTwin
+                next_q_target = next_q_target + next_log_prob * self.alpha  # SAC, alpha
+                q_target = reward + mask * next_q_target
+            '''critic_loss'''
+            q1_value, q2_value = self.cri.get__q1_q2(state, action)  # CriticTwin
+            critic_loss = get_pop_mse_loss(q1_value, q_target) + get_pop_mse_loss(q2_value, q_target)
+            loss_c_sum += critic_loss.item() * 0.5 / self.pop_num  # CriticTwin
+
+            self.cri_optimizer.zero_grad()
+            critic_loss.backward()
+            pop_optimizer_step(self.cri_optimizer, self.lr_scale)
+
+            '''actor_loss'''
+            if i % repeat_times == 0:
+                # stochastic policy
+                actions_noise, log_prob = self.act.get__a__log_prob(state)  # policy gradient
+                # auto alpha
+                alpha_loss = (self.log_alpha * (log_prob - self.target_entropy).detach()).mean(dim=(1, 2)).sum()
+                self.alpha_optimizer.zero_grad()
+                alpha_loss.backward()
+                pop_optimizer_step(self.alpha_optimizer, self.lr_scale)
+
+                # policy gradient
+                self.alpha = self.log_alpha.exp()
+                q_eval_pg = torch.min(*self.cri.get__q1_q2(state, actions_noise))  # policy gradient
+                actor_loss = -(q_eval_pg + log_prob * self.alpha).mean(dim=(1, 2)).sum()  # policy gradient
+                loss_a_sum += actor_loss.item() / self.pop_num
+
+                self.act_optimizer.zero_grad()
+                actor_loss.backward()
+                pop_optimizer_step(self.act_optimizer, self.lr_scale)
+
+            """target update"""
+            soft_target_update(self.cri_target, self.cri)  # soft target update
+
+        loss_a_avg = loss_a_sum / update_times
+        loss_c_avg = loss_c_sum / (update_times * repeat_times)
+        return loss_a_avg, loss_c_avg
+
+
+class AgentRecurrentSAC(AgentBasicAC):  # SAC with GRU actor and critic, sequence replay (BufferSeq) 2020-09-14
     def __init__(self, state_dim, action_dim, net_dim):
+        super(AgentBasicAC, self).__init__()
+        self.learning_rate = 1e-4
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+        '''network'''
+        self.act = ActorSACRNN(state_dim, action_dim, net_dim).to(self.device)
+        self.act.train()
+        self.act_optimizer = torch.optim.Adam(self.act.parameters(), lr=self.learning_rate)
+
+        critic_dim = int(net_dim * 1.25)
+        self.cri = CriticTwinRNN(state_dim, action_dim, critic_dim).to(self.device)
+        self.cri.train()
+        self.cri_optimizer = torch.optim.Adam(self.cri.parameters(), lr=self.learning_rate)
+
+        self.cri_target = CriticTwinRNN(state_dim, action_dim, critic_dim).to(self.device)
+        self.cri_target.eval()
+        self.cri_target.load_state_dict(self.cri.state_dict())
+
+        self.criterion = nn.MSELoss()
+
+        '''training record'''
+        self.state = None  # env.reset()
+        self.hidden_dim = net_dim + critic_dim  # the recurrent state of actor and critic, saved in BufferSeq
+        self.hidden = np.zeros(self.hidden_dim, dtype=np.float32)  # the recurrent state before self.state
+        self.reward_sum = 0.0
+        self.step = 0
+
+        '''extension: auto-alpha for maximum entropy'''
+        self.log_alpha = torch.zeros(1, requires_grad=True, device=self.device)
+        self.alpha = self.log_alpha.exp()
+        self.alpha_optimizer = torch.optim.Adam((self.log_alpha,), lr=self.learning_rate)
+        self.target_entropy = np.log(action_dim) * 0.98
+
+        '''constant'''
+        self.explore_noise = True  # stochastic policy choose noise_std by itself.
+        self.seq_len = 2 ** 4  # the length of sequence for gradient descent
+        self.burn_in = 2 ** 3  # the length of prefix to rebuild the recurrent state from the saved one
+
+    def select_actions(self, states, explore_noise=0.0):  # for the hidden of env.reset(), so it is zero
+        states = torch.tensor(states, dtype=torch.float32, device=self.device)
+        hidden = torch.zeros((states.shape[0], self.act.hidden_dim), dtype=torch.float32, device=self.device)
+        actions = self.act.get__a(self.act.rnn(self.act.enc_s(states), hidden), explore_noise)
+        return actions.cpu().data.numpy()
+
+    def select_action__hidden(self, state, hidden, explore_noise=0.0):  # CPU array to GPU tensor to CPU array
+        state = torch.tensor((state,), dtype=torch.float32, device=self.device)
+        hidden = torch.tensor((hidden,), dtype=torch.float32, device=self.device)
+        hidden_a = self.act.rnn(self.act.enc_s(state), hidden[:, :self.act.hidden_dim])
+        hidden_c = self.cri.rnn(self.cri.enc_s(state), hidden[:, self.act.hidden_dim:])
+
+        action = self.act.get__a(hidden_a, explore_noise)
+        hidden = torch.cat((hidden_a, hidden_c), dim=1)
+        return action.cpu().data.numpy()[0], hidden.cpu().data.numpy()[0]
+
+    def update_buffer(self, env, buffer, max_step, max_action, reward_scale, gamma):
+        self.act.eval()
+
+        rewards = list()
+        steps = list()
+        for _ in range(max_step):
+            '''inactive with environment'''
+            action, next_hidden = self.select_action__hidden(self.state, self.hidden, self.explore_noise)
+            next_state, reward, done, _ = env.step(action * max_action)
+
+            self.reward_sum += reward
+            self.step += 1
+
+            '''update replay buffer'''
+            reward_ = reward * reward_scale
+            mask = 0.0 if done else gamma
+            buffer.add_memo((reward_, mask, self.state, action), self.hidden)
+
+            self.state = next_state
+            self.hidden = next_hidden
+            if done:
+                rewards.append(self.reward_sum)
+                self.reward_sum = 0.0
+
+                steps.append(self.step)
+                self.step = 0
+
+                self.state = env.reset()
+                self.hidden = np.zeros(self.hidden_dim, dtype=np.float32)  # reset the recurrent state
+        return rewards, steps
+
+    def update_parameters(self, buffer, max_step, batch_size, repeat_times):
+        self.act.train()
+        loss_a_sum = 0.0
+        loss_c_sum = 0.0
+
+        k = 1.0 + buffer.now_len / buffer.max_len
+        batch_size_ = max(int(batch_size * k) // self.seq_len, 1)  # the number of sequences in a batch
+        update_times = int(max_step * k)
+        burn_in = self.burn_in
+        act_dim = self.act.hidden_dim
+
+        for i in range(update_times * repeat_times):
+            is_update_actor = i % repeat_times == 0
+            with torch.no_grad():
+                reward, mask, state, action, hidden = buffer.random_sample(batch_size_, self.device)
+                reset = (mask != 0.0).float()  # the recurrent state is reset after the end of an episode
+
+                '''burn-in: rebuild the recurrent state from the saved one, without gradient'''
+                hidden_a = self.act.get__feature_seq(state[:burn_in], hidden[:, :act_dim], reset[:burn_in])[1]
+                hidden_c = self.cri.get__feature_seq(state[:burn_in], hidden[:, act_dim:], reset[:burn_in])[1]
+                hidden_t = self.cri_target.get__feature_seq(state[:burn_in], hidden[:, act_dim:], reset[:burn_in])[1]
+                reward, mask, state, action, reset = [ten[burn_in:] for ten in (reward, mask, state, action, reset)]
+
+                x_target = self.cri_target.get__feature_seq(state, hidden_t, reset)[0]
+
+            with torch.set_grad_enabled(is_update_actor):
+                x_act = self.act.get__feature_seq(state, hidden_a, reset)[0]  # (seq_len + 1, batch_size, mid_dim)
+
+            with torch.no_grad():
+                next_a_noise, next_log_prob = self.act.get__a__log_prob(x_act[1:].detach())
+                next_q_target = torch.min(*self.cri_target.get__q1_q2(x_target[1:], next_a_noise))  # CriticTwin
+                next_q_target = next_q_target + next_log_prob * self.alpha  # SAC, alpha
+                q_target = reward + mask * next_q_target
+
+            '''critic_loss'''
+            x_cri = self.cri.get__feature_seq(state[:-1], hidden_c, reset)[0]
+            q1_value, q2_value = self.cri.get__q1_q2(x_cri, action)  # CriticTwin
+            critic_loss = self.criterion(q1_value, q_target) + self.criterion(q2_value, q_target)
+            loss_c_sum += critic_loss.item() * 0.5  # CriticTwin
+
+            self.cri_optimizer.zero_grad()
+            critic_loss.backward()
+            self.cri_optimizer.step()
+
+            '''actor_loss'''
+            if is_update_actor:
+                actions_noise, log_prob = self.act.get__a__log_prob(x_act[:-1])  # policy gradient
+                # auto alpha
+                alpha_loss = (self.log_alpha * (log_prob - self.target_entropy).detach()).mean()
+                self.alpha_optimizer.zero_grad()
+                alpha_loss.backward()
+                self.alpha_optimizer.step()
+
+                # policy gradient
+                self.alpha = self.log_alpha.exp()
+                q_eval_pg = torch.min(*self.cri.get__q1_q2(x_cri.detach(), actions_noise))  # policy gradient
+                actor_loss = -(q_eval_pg + log_prob * self.alpha).mean()  # policy gradient
+                loss_a_sum += actor_loss.item()
+
+                self.act_optimizer.zero_grad()
+                actor_loss.backward()
+                self.act_optimizer.step()
+
+            """target update"""
+            soft_target_update(self.cri_target, self.cri)  # soft target update
+
+        loss_a_avg = loss_a_sum / update_times
+        loss_c_avg = loss_c_sum / (update_times * repeat_times)
+        return loss_a_avg, loss_c_avg
+
+
+class AgentInterAC(AgentBasicAC):  # warning: sth. wrong
+    def __init__(self, state_dim, action_dim, net_dim, if_recompute=False):
         super(AgentBasicAC, self).__init__()
         # use_dn = True  # SNAC, use_dn (DenseNet) and (Spectral Normalization)
         self.learning_rate = 1e-4
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
         '''network'''
-        self.act = InterDPG(state_dim, action_dim, net_dim).to(self.device)
+        self.act = InterDPG(state_dim, action_dim, net_dim, if_recompute).to(self.device)
         self.act.train()
         self.act_optimizer = torch.optim.Adam(self.act.parameters(), lr=self.learning_rate)
 
@@ -523,7 +865,8 @@ class AgentInterAC(AgentBasicAC):  # warning: sth. wrong
                 q_target = reward + mask * next_q_target
 
             '''critic loss'''
-            q_eval = self.act.critic(state, action)
+            state_ = self.act.enc_s(state)  # encode a state batch once, reuse it in actor and critic
+            q_eval = self.act.critic_(state_, action)
             critic_loss = self.criterion(q_eval, q_target)
             loss_c_tmp = critic_loss.item()
             loss_c_sum += loss_c_tmp
@@ -534,7 +877,7 @@ class AgentInterAC(AgentBasicAC):  # warning: sth. wrong
 
             if i % repeat_times == 0:
                 '''actor loss'''
-                action_cur = self.act(state)  # policy gradient
+                action_cur = self.act.actor_(state_)  # policy gradient
                 actor_loss = -self.act_target.critic(state, action_cur).mean()  # policy gradient
                 # NOTICE! It is very important to use act_target.critic here instead act.critic
                 # Or you can use act.critic.deepcopy(). Whatever you cannot use act.critic directly.
@@ -561,7 +904,7 @@ class AgentInterAC(AgentBasicAC):  # warning: sth. wrong
 
 
 class AgentDeepSAC(AgentBasicAC):
-    def __init__(self, state_dim, action_dim, net_dim):
+    def __init__(self, state_dim, action_dim, net_dim, if_recompute=False):
         super(AgentBasicAC, self).__init__()
         use_dn = True  # and use hard target update
         self.learning_rate = 1e-4
@@ -569,7 +912,7 @@ class AgentDeepSAC(AgentBasicAC):
 
         '''network'''
         actor_dim = net_dim
-        self.act = ActorSAC(state_dim, action_dim, actor_dim, use_dn).to(self.device)
+        self.act = ActorSAC(state_dim, action_dim, actor_dim, use_dn, if_recompute).to(self.device)
         self.act.train()
         self.act_optimizer = torch.optim.Adam(self.act.parameters(), lr=self.learning_rate)
 
@@ -578,7 +921,7 @@ class AgentDeepSAC(AgentBasicAC):
         self.act_target.load_state_dict(self.act.state_dict())
 
         critic_dim = int(net_dim * 1.25)
-        self.cri = CriticTwinShared(state_dim, action_dim, critic_dim, use_dn).to(self.device)
+        self.cri = CriticTwinShared(state_dim, action_dim, critic_dim, use_dn, if_recompute).to(self.device)
         self.cri.train()
         self.cri_optimizer = torch.optim.Adam(self.cri.parameters(), lr=self.learning_rate)
 
@@ -671,14 +1014,14 @@ class AgentDeepSAC(AgentBasicAC):
 
 
 class AgentInterSAC(AgentBasicAC):  # Integrated Soft Actor-Critic Methods
-    def __init__(self, state_dim, action_dim, net_dim):
+    def __init__(self, state_dim, action_dim, net_dim, if_recompute=False):
         super(AgentBasicAC, self).__init__()
         self.learning_rate = 1e-4
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
         '''network'''
         actor_dim = net_dim
-        self.act = InterSPG(state_dim, action_dim, actor_dim).to(self.device)
+        self.act = InterSPG(state_dim, action_dim, actor_dim, if_recompute).to(self.device)
         self.act.train()
 
         self.cri = self.act
@@ -726,21 +1069,27 @@ class AgentInterSAC(AgentBasicAC):  # Integrated Soft Actor-Critic Methods
             with torch.no_grad():
                 reward, mask, state, action, next_s = buffer.random_sample(batch_size_, self.device)
 
-                next_a_noise, next_log_prob = self.act_target.get__a__log_prob(next_s)
-                next_q_target = torch.min(*self.act_target.get__q1_q2(next_s, next_a_noise))  # twin critic
+                next_s_ = self.act_target.enc_s(next_s)  # encode a state batch once, reuse it in actor and critic
+                next_a_noise, next_log_prob = self.act_target.dec__a__log_prob(self.act_target.net(next_s_))
+                next_q_target = torch.min(*self.act_target.dec__q1_q2(
+                    self.act_target.get__q_(next_s_, next_a_noise)))  # twin critic
                 q_target = reward + mask * (next_q_target + next_log_prob * alpha)  # policy entropy
+
+                state_target_ = self.act_target.enc_s(state)  # for action correction term and policy gradient
+                a2_mean, a2_log_std = self.act_target.dec__a__std(self.act_target.net(state_target_))
             '''critic_loss'''
-            q1_value, q2_value = self.cri.get__q1_q2(state, action)  # CriticTwin
+            state_ = self.act.enc_s(state)
+            a_, q_ = self.act.get__a__q_(state_, action)  # the trunk features of actor and critic
+            q1_value, q2_value = self.cri.dec__q1_q2(q_)  # CriticTwin
             critic_loss = self.criterion(q1_value, q_target) + self.criterion(q2_value, q_target)
             loss_c_tmp = critic_loss.item() * 0.5  # CriticTwin
             loss_c_list.append(loss_c_tmp)
             rho = self.trust_rho.update_rho(loss_c_tmp)
 
             '''stochastic policy'''
-            a1_mean, a1_log_std, a_noise, log_prob = self.act.get__a__avg_std_noise_prob(state)  # policy gradient
+            a1_mean, a1_log_std, a_noise, log_prob = self.act.dec__a__avg_std_noise_prob(a_)  # policy gradient
 
             '''action correction term'''
-            a2_mean, a2_log_std = self.act_target.get__a__std(state)
             actor_term = self.criterion(a1_mean, a2_mean) + self.criterion(a1_log_std, a2_log_std)
 
             '''auto alpha'''
@@ -754,7 +1103,8 @@ class AgentInterSAC(AgentBasicAC):  # Integrated Soft Actor-Critic Methods
 
             '''actor_loss'''
             if rho > 2 ** -8:  # (self.rho>2**-8) ~= (self.critic_loss<2.355)
-                q_eval_pg = torch.min(*self.act_target.get__q1_q2(state, a_noise))  # policy gradient
+                q_eval_pg = torch.min(*self.act_target.dec__q1_q2(
+                    self.act_target.get__q_(state_target_, a_noise)))  # policy gradient
                 actor_loss = -(q_eval_pg + log_prob * alpha).mean()  # policy gradient
                 loss_a_list.append(actor_loss.item())
             else:
@@ -790,6 +1140,7 @@ class AgentPPO:
         self.cri_optimizer = torch.optim.Adam(self.cri.parameters(), lr=self.learning_rate, )  # betas=(0.5, 0.99))
 
         self.criterion = nn.SmoothL1Loss()
+        self.chunk_memory = 2 ** 28  # bytes, for the full-rollout pass in chunks, see get_chunk_size()
 
     def update_buffer(self, env, buffer, max_step, max_action, reward_scale, gamma):
         # collect tuple (reward, mask, state, action, log_prob, )
@@ -849,8 +1200,8 @@ class AgentPPO:
             torch.tensor(ary, dtype=torch.float32, device=self.device)
             for ary in (all_batch.reward, all_batch.mask, all_batch.state, all_batch.action, all_batch.log_prob,)
         ]
-        # with torch.no_grad():
-        all__new_v = self.cri(all_state).detach_()  # all new value
+        chunk_size = get_chunk_size(self.cri, self.cri, (all_state,), self.chunk_memory)
+        all__new_v = get_output_in_chunks(self.cri, (all_state,), chunk_size)  # all new value
 
         '''compute old_v (old policy value), adv_v (advantage value) 
         refer: GAE. ICLR 2016. Generalization Advantage Estimate. 
@@ -875,17 +1226,8 @@ class AgentPPO:
 
         '''mini batch sample'''
         sample_times = int(repeat_times * max_memo / batch_size)
-        for _ in range(sample_times):
-            '''random sample'''
-            # indices = rd.choice(max_memo, batch_size, replace=True)  # False)
-            indices = rd.randint(max_memo, size=batch_size)
-
-            state = all_state[indices]
-            action = all_action[indices]
-            advantage = all__adv_v[indices]
-            old_value = all__old_v[indices].unsqueeze(1)
-            old_log_prob = all_log_prob[indices]
-
+        for state, action, advantage, old_value, old_log_prob in get_epoch_minibatch(
+                (all_state, all_action, all__adv_v, all__old_v.unsqueeze(1), all_log_prob), batch_size, sample_times):
             """Adaptive KL Penalty Coefficient
             loss_KLPEN = surrogate_obj + value_obj * lambda_value + entropy_obj * lambda_entropy
             loss_KLPEN = (value_obj * lambda_value) + (surrogate_obj + entropy_obj * lambda_entropy)
@@ -957,23 +1299,24 @@ class AgentPPO:
 
 
 class AgentGAE(AgentPPO):
-    def __init__(self, state_dim, action_dim, net_dim):
+    def __init__(self, state_dim, action_dim, net_dim, if_recompute=False):
         super(AgentPPO, self).__init__()
         self.learning_rate = 1e-4  # learning rate of actor
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
         '''network'''
-        self.act = ActorGAE(state_dim, action_dim, net_dim).to(self.device)
+        self.act = ActorGAE(state_dim, action_dim, net_dim, if_recompute).to(self.device)
         self.act.train()
         self.act_optimizer = torch.optim.Adam(self.act.parameters(), lr=self.learning_rate, )  # betas=(0.5, 0.99))
 
-        self.cri = CriticAdvTwin(state_dim, net_dim).to(self.device)
+        self.cri = CriticAdvTwin(state_dim, net_dim, if_recompute).to(self.device)
         self.cri.train()
         self.cri_optimizer = torch.optim.Adam(self.cri.parameters(), lr=self.learning_rate, )  # betas=(0.5, 0.99))
         # cannot use actor target network
         # not need to use critic target network
 
         self.criterion = nn.SmoothL1Loss()
+        self.chunk_memory = 2 ** 28  # bytes, for the full-rollout pass in chunks, see get_chunk_size()
 
     def update_parameters(self, buffer, _max_step, batch_size, repeat_times):
         """Differences between AgentGAE and AgentPPO are:
@@ -1001,10 +1344,8 @@ class AgentGAE(AgentPPO):
         # with torch.no_grad():
         # all__new_v = self.cri(all_state).detach_()  # all new value
         # all__new_v = torch.min(*self.cri(all_state)).detach_()  # TwinCritic
-        with torch.no_grad():
-            b_size = 256
-            all__new_v = torch.cat([torch.min(*self.cri(all_state[i:i + b_size]))
-                                    for i in range(0, all_state.size()[0], b_size)], dim=0)
+        chunk_size = get_chunk_size(self.cri, self.cri, (all_state,), self.chunk_memory)
+        all__new_v = torch.min(*get_output_in_chunks(self.cri, (all_state,), chunk_size))  # TwinCritic
 
         '''compute old_v (old policy value), adv_v (advantage value) 
         refer: Generalization Advantage Estimate. ICLR 2016. 
@@ -1030,17 +1371,8 @@ class AgentGAE(AgentPPO):
 
         '''mini batch sample'''
         sample_times = int(repeat_times * max_memo / batch_size)
-        for _ in range(sample_times):
-            '''random sample'''
-            # indices = rd.choice(max_memo, batch_size, replace=True)  # False)
-            indices = rd.randint(max_memo, size=batch_size)
-
-            state = all_state[indices]
-            action = all_action[indices]
-            advantage = all__adv_v[indices]
-            old_value = all__old_v[indices].unsqueeze(1)
-            old_log_prob = all_log_prob[indices]
-
+        for state, action, advantage, old_value, old_log_prob in get_epoch_minibatch(
+                (all_state, all_action, all__adv_v, all__old_v.unsqueeze(1), all_log_prob), batch_size, sample_times):
             """Adaptive KL Penalty Coefficient
             loss_KLPEN = surrogate_obj + value_obj * lambda_value + entropy_obj * lambda_entropy
             loss_KLPEN = (value_obj * lambda_value) + (surrogate_obj + entropy_obj * lambda_entropy)
@@ -1080,13 +1412,13 @@ class AgentGAE(AgentPPO):
 
 
 class AgentInterGAE(AgentPPO):
-    def __init__(self, state_dim, action_dim, net_dim):
+    def __init__(self, state_dim, action_dim, net_dim, if_recompute=False):
         super(AgentPPO, self).__init__()
         self.learning_rate = 1e-4
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
         '''network'''
-        self.act = InterGAE(state_dim, action_dim, net_dim).to(self.device)
+        self.act = InterGAE(state_dim, action_dim, net_dim, if_recompute).to(self.device)
         self.act.train()
         self.cri = self.act.get__q1_q2
         self.act_optimizer = torch.optim.Adam(self.act.parameters(), lr=self.learning_rate, )  # betas=(0.5, 0.99))
@@ -1097,6 +1429,7 @@ class AgentInterGAE(AgentPPO):
         self.cri_target = self.act_target.get__q1_q2
 
         self.criterion = nn.SmoothL1Loss()
+        self.chunk_memory = 2 ** 28  # bytes, for the full-rollout pass in chunks, see get_chunk_size()
 
     def update_parameters(self, buffer, _max_step, batch_size, repeat_times):
         self.act.train()
@@ -1119,10 +1452,8 @@ class AgentInterGAE(AgentPPO):
         # with torch.no_grad():
         # all__new_v = self.cri(all_state).detach_()  # all new value
         # all__new_v = torch.min(*self.cri(all_state)).detach_()  # TwinCritic
-        with torch.no_grad():
-            b_size = 128
-            all__new_v = torch.cat([torch.min(*self.cri_target(all_state[i:i + b_size]))
-                                    for i in range(0, all_state.size()[0], b_size)], dim=0)
+        chunk_size = get_chunk_size(self.act_target, self.cri_target, (all_state,), self.chunk_memory)
+        all__new_v = torch.min(*get_output_in_chunks(self.cri_target, (all_state,), chunk_size))  # TwinCritic
 
         '''compute old_v (old policy value), adv_v (advantage value) 
         refer: Generalization Advantage Estimate. ICLR 2016. 
@@ -1148,17 +1479,8 @@ class AgentInterGAE(AgentPPO):
 
         '''mini batch sample'''
         sample_times = int(repeat_times * max_memo / batch_size)
-        for _ in range(sample_times):
-            '''random sample'''
-            # indices = rd.choice(max_memo, batch_size, replace=True)  # False)
-            indices = rd.randint(max_memo, size=batch_size)
-
-            state = all_state[indices]
-            action = all_action[indices]
-            advantage = all__adv_v[indices]
-            old_value = all__old_v[indices].unsqueeze(1)
-            old_log_prob = all_log_prob[indices]
-
+        for state, action, advantage, old_value, old_log_prob in get_epoch_minibatch(
+                (all_state, all_action, all__adv_v, all__old_v.unsqueeze(1), all_log_prob), batch_size, sample_times):
             """Adaptive KL Penalty Coefficient
             loss_KLPEN = surrogate_obj + value_obj * lambda_value + entropy_obj * lambda_entropy
             loss_KLPEN = (value_obj * lambda_value) + (surrogate_obj + entropy_obj * lambda_entropy)
@@ -1166,9 +1488,7 @@ class AgentInterGAE(AgentPPO):
             """
 
             '''critic_loss'''
-            new_log_prob = self.act.compute__log_prob(state, action)
-            new_value1, new_value2 = self.cri(state)  # TwinCritic
-            # new_log_prob, new_value1, new_value2 = self.act_target.compute__log_prob(state, action)
+            new_log_prob, new_value1, new_value2 = self.act.compute__log_prob__q1_q2(state, action)  # TwinCritic
 
             critic_loss = (self.criterion(new_value1, old_value) +
                            self.criterion(new_value2, old_value)) / (old_value.std() * 2 + 1e-6)
@@ -1202,8 +1522,8 @@ class AgentInterGAE(AgentPPO):
 
 
 class AgentDiscreteGAE(AgentGAE):  # wait to be elegant
-    def __init__(self, state_dim, action_dim, net_dim):
-        AgentGAE.__init__(self, state_dim, action_dim, net_dim)
+    def __init__(self, state_dim, action_dim, net_dim, if_recompute=False):
+        AgentGAE.__init__(self, state_dim, action_dim, net_dim, if_recompute)
 
         self.cri_target = CriticAdvTwin(state_dim, net_dim).to(self.device)
         self.cri_target.eval()
@@ -1282,7 +1602,8 @@ class AgentDiscreteGAE(AgentGAE):  # wait to be elegant
         ]
         # with torch.no_grad():
         # all__new_v = self.cri(all_state).detach_()  # all new value
-        all__new_v = torch.min(*self.cri_target(all_state)).detach_()  # TwinCritic
+        chunk_size = get_chunk_size(self.cri_target, self.cri_target, (all_state,), self.chunk_memory)
+        all__new_v = torch.min(*get_output_in_chunks(self.cri_target, (all_state,), chunk_size))  # TwinCritic
 
         '''compute old_v (old policy value), adv_v (advantage value) 
         refer: Generalization Advantage Estimate. ICLR 2016. 
@@ -1308,17 +1629,8 @@ class AgentDiscreteGAE(AgentGAE):  # wait to be elegant
 
         '''mini batch sample'''
         sample_times = int(repeat_times * max_memo / batch_size)
-        for _ in range(sample_times):
-            '''random sample'''
-            # indices = rd.choice(max_memo, batch_size, replace=True)  # False)
-            indices = rd.randint(max_memo, size=batch_size)
-
-            state = all_state[indices]
-            action = all_action[indices]
-            advantage = all__adv_v[indices]
-            old_value = all__old_v[indices].unsqueeze(1)
-            old_log_prob = all_log_prob[indices]
-
+        for state, action, advantage, old_value, old_log_prob in get_epoch_minibatch(
+                (all_state, all_action, all__adv_v, all__old_v.unsqueeze(1), all_log_prob), batch_size, sample_times):
             """Adaptive KL Penalty Coefficient
             loss_KLPEN = surrogate_obj + value_obj * lambda_value + entropy_obj * lambda_entropy
             loss_KLPEN = (value_obj * lambda_value) + (surrogate_obj + entropy_obj * lambda_entropy)
@@ -1484,13 +1796,13 @@ class AgentDQN:  # 2020-06-06
 
 
 class AgentDoubleDQN(AgentBasicAC):  # 2020-06-06 # I'm not sure.
-    def __init__(self, state_dim, action_dim, net_dim):  # 2020-04-30
+    def __init__(self, state_dim, action_dim, net_dim, if_recompute=False):  # 2020-04-30
         super(AgentBasicAC, self).__init__()
         self.learning_rate = 1e-4
         self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 
         '''network'''
-        act = QNetTwin(state_dim, action_dim, net_dim).to(self.device)
+        act = QNetTwin(state_dim, action_dim, net_dim, if_recompute).to(self.device)
         act.train()
         self.act = act
         self.act_optimizer = torch.optim.Adam(act.parameters(), lr=self.learning_rate)
@@ -1737,6 +2049,117 @@ def initial_exploration(env, memo, max_step, action_max, reward_scale, gamma, ac
     return rewards, steps
 
 
+def initial_exploration_pop(env, memo, max_step, action_max, reward_scale, gamma, action_dim):
+    """initial_exploration() of train_population(), env: pop_num envs with the batched API (reset_vec, step_vec)
+    """
+    states = env.reset_vec()
+    for _ in range(max_step):
+        actions = rd.uniform(-1, 1, size=(states.shape[0], action_dim))
+        next_states, rewards, dones, _ = env.step_vec(actions * action_max)
+
+        masks = np.where(dones, 0.0, gamma)
+        memo.add_memo((rewards * reward_scale, masks, states, actions, next_states))
+        states = next_states
+    memo.init_before_sample()
+    return states
+
+
+def get_epoch_minibatch(tensors, batch_size, sample_times):  # 2020-09-13, for on-policy update_parameters()
+    """yield sample_times minibatches of tensors (the same len(tensor) == max_memo), without replacement in an epoch.
+    Each epoch permutes the tensors once on their device and yields fixed-shape views (batch_size, ...) of them.
+    The tail of an epoch (max_memo % batch_size) is skipped. No index is sent from host to device in the loop.
+    """
+    max_memo = tensors[0].shape[0]
+    batch_size = min(batch_size, max_memo)
+    batch_num = max_memo // batch_size  # minibatches in an epoch
+
+    sample_count = 0
+    while sample_count < sample_times:
+        indices = torch.randperm(max_memo, device=tensors[0].device)
+        epoch_tensors = [tensor[indices] for tensor in tensors]  # copy once per epoch, not per minibatch
+
+        for i in range(min(batch_num, sample_times - sample_count)):
+            j = i * batch_size
+            yield [tensor[j:j + batch_size] for tensor in epoch_tensors]
+        sample_count += batch_num
+
+
+def get_chunk_size(net, func, tensors, memory_budget=2 ** 28):  # 2020-09-13
+    """the largest chunk size (2 ** n) of a full-rollout pass `func(*tensors)` that keeps the activation memory
+    under memory_budget (bytes). It measures the outputs of the leaf modules of net in a pass of a small probe chunk.
+    """
+    max_memo = tensors[0].shape[0]
+    probe_size = min(2 ** 4, max_memo)
+    probe_bytes = [0, ]
+
+    def add_output_bytes(_module, _input, output):
+        output = output if isinstance(output, tuple) else (output,)
+        probe_bytes[0] += sum([item.numel() * item.element_size() for item in output if isinstance(item, torch.Tensor)])
+
+    handles = [module.register_forward_hook(add_output_bytes)
+               for module in net.modules() if len(list(module.children())) == 0]
+    with torch.no_grad():
+        func(*[tensor[:probe_size] for tensor in tensors])
+    [handle.remove() for handle in handles]
+
+    chunk_size = int(memory_budget * probe_size / max(probe_bytes[0], 1))
+    chunk_size = 2 ** int(np.log2(chunk_size)) if chunk_size >= 1 else 1
+    return min(chunk_size, max_memo)
+
+
+def get_output_in_chunks(func, tensors, chunk_size):  # 2020-09-13, full-rollout pass of on-policy agents
+    """the same as func(*tensors) under torch.no_grad(), but func runs on the chunks of tensors (len(tensor) == max_memo)
+    and each output streams into a tensor that is allocated once. So the peak memory is bounded by chunk_size.
+    """
+    max_memo = tensors[0].shape[0]
+    outputs = None
+    with torch.no_grad():
+        for i in range(0, max_memo, chunk_size):
+            output = func(*[tensor[i:i + chunk_size] for tensor in tensors])
+            output = output if isinstance(output, tuple) else (output,)
+            if outputs is None:
+                outputs = [item.new_empty((max_memo,) + item.shape[1:]) for item in output]
+            for item_all, item in zip(outputs, output):
+                item_all[i:i + item.shape[0]] = item
+    return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+
+def get_pop_mse_loss(value, target):  # the sum of the MSELoss of each agent, value.shape == (pop_num, batch, 1)
+    return (value - target).pow(2).mean(dim=(1, 2)).sum()
+
+
+def pop_optimizer_step(optimizer, lr_scale=None):  # 2020-09-19, the learning rate of agent i is lr * lr_scale[i]
+    if lr_scale is None:
+        optimizer.step()
+        return
+
+    params = [param for group in optimizer.param_groups for param in group['params']]
+    params_old = [param.detach().clone() for param in params]
+    optimizer.step()
+    for param, param_old in zip(params, params_old):  # the parameters of agents are stacked in axis 0
+        scale = lr_scale.view((-1,) + (1,) * (param.dim() - 1))
+        param.data.sub_(param_old).mul_(scale).add_(param_old)
+
+
+def get_td_priority(act, cri, memo_array, state_dim, action_dim):  # 2020-09-21, the initial priorities of explorer
+    """the |td_error| of memories using the local copy of actor and CriticTwin, for BufferArrayPER.extend_memo()
+    memo_array == (reward, mask, state, action, next_state), the same as the td_error of AgentSAC.update_parameters_per()
+    but without the entropy term, because the explorer does not know alpha.
+    """
+    state_idx = 2 + state_dim
+    action_idx = state_idx + action_dim
+    memory = torch.as_tensor(memo_array, dtype=torch.float32)
+    reward, mask = memory[:, 0:1], memory[:, 1:2]
+    state, action, next_s = memory[:, 2:state_idx], memory[:, state_idx:action_idx], memory[:, action_idx:]
+
+    with torch.no_grad():
+        next_q_target = torch.min(*cri.get__q1_q2(next_s, act(next_s)))
+        q_target = reward + mask * next_q_target
+        q1_value, q2_value = cri.get__q1_q2(state, action)
+        td_error = ((q1_value - q_target).abs() + (q2_value - q_target).abs()) * 0.5
+    return td_error.numpy().reshape(-1)
+
+
 def soft_target_update(target, online, tau=5e-3):
     for target_param, param in zip(target.parameters(), online.parameters()):
         target_param.data.copy_(tau * param.data + (1.0 - tau) * target_param.data)
@@ -1828,12 +2251,169 @@ class BufferList:
         return tensors
 
 
+def get_n_step_memo(memo_array, n_step, state_dim):  # 2020-09-11
+    """memo_array: the 1-step memories in time order, each row is (reward, mask, state, action, next_state)
+    mask == gamma if not done else 0.0, so the products of masks are the powers of gamma.
+    return the n-step memories (in place):
+        reward = r[t] + m[t] r[t+1] + ... + m[t]...m[t+k-1] r[t+k]
+        mask   = m[t] m[t+1] ... m[t+k]  (0.0 if the episode ends in these steps)
+        next_state = next_state[t+k]
+    k < n_step. k stops at the end of episode and at the end of memo_array (a shorter but unbiased target),
+    so the agents compute `q_target = reward + mask * next_q` as before.
+    """
+    size = memo_array.shape[0]
+    rewards = memo_array[:, 0].copy()
+    masks = memo_array[:, 1].copy()
+
+    reward_n = rewards.copy()
+    mask_n = masks.copy()
+    last_idx = np.arange(size)
+    for k in range(1, n_step):
+        i = np.arange(size - k)
+        i = i[mask_n[i] != 0.0]  # the episode of memo[i] does not end in memo[i:i+k]
+        reward_n[i] += mask_n[i] * rewards[i + k]
+        mask_n[i] *= masks[i + k]
+        last_idx[i] = i + k
+
+    memo_array[:, 0] = reward_n
+    memo_array[:, 1] = mask_n
+    memo_array[:, -state_dim:] = memo_array[last_idx, -state_dim:]
+    return memo_array
+
+
+class EpisodeIndex:  # 2020-09-15, the episode table of BufferArray and BufferArrayGPU
+    def __init__(self, memo_max_len):
+        """Save the start index, length and return of each complete episode in the replay buffer.
+        The boundary of episode is `mask == 0.0` of the 1-step memories. return: the sum of rewards (reward_scale).
+        The episodes are saved in a ring: episode_id % max_len, from the oldest (head_id) to the newest (tail_id - 1).
+        When the buffer overwrites the first memory of the oldest episode, the episode is evicted from the index.
+        An episode longer than memo_max_len is never complete in the buffer, so it is not indexed.
+        The episode which is not done (the open episode) is indexed when it is done.
+        """
+        self.max_len = memo_max_len
+        self.starts = np.zeros(memo_max_len, dtype=np.int64)  # each complete episode has >= 1 memory in buffer
+        self.lengths = np.zeros(memo_max_len, dtype=np.int64)
+        self.returns = np.zeros(memo_max_len, dtype=np.float64)
+        self.memo_episode = np.full(memo_max_len, -1, dtype=np.int64)  # episode_id of each memory, -1: open
+
+        self.head_id = 0  # the id of the oldest complete episode
+        self.tail_id = 0  # the id of the next complete episode
+        self.open_start = 0
+        self.open_len = 0
+        self.open_return = 0.0
+
+    def __len__(self):
+        return self.tail_id - self.head_id
+
+    def drop_open(self):  # the open episode is abandoned without done, so it is never indexed
+        self.open_len = 0
+        self.open_return = 0.0
+
+    def add_memo(self, next_idx, reward, mask):  # the memo of BufferArray.add_memo(), next_idx before writing
+        if len(self) > 0 and self.starts[self.head_id % self.max_len] == next_idx:
+            self.head_id += 1  # overwrite the first memory of the oldest episode
+        self.memo_episode[next_idx] = -1
+
+        if self.open_len == 0:
+            self.open_start = next_idx
+        self.open_len += 1
+        self.open_return += reward
+        if mask == 0.0:  # done
+            if self.open_len <= self.max_len:
+                self.add_episodes(np.array((self.open_start,)), np.array((self.open_len,)),
+                                  np.array((self.open_return,)))
+            self.open_len = 0
+            self.open_return = 0.0
+
+    def extend_memo(self, next_idx, rewards, masks):  # the 1-step memories of BufferArray.extend_memo()
+        size = rewards.shape[0]
+        while len(self) > 0 and (self.starts[self.head_id % self.max_len] - next_idx) % self.max_len < size:
+            self.head_id += 1  # overwrite the first memory of the oldest episode
+        write_idx = (next_idx + np.arange(size)) % self.max_len
+        self.memo_episode[write_idx] = -1
+
+        if self.open_len == 0:
+            self.open_start = next_idx
+        cum_rewards = np.cumsum(rewards, dtype=np.float64)
+        ends = np.flatnonzero(masks == 0.0)  # the last step of the episodes which are done in this chunk
+        if ends.shape[0] == 0:
+            self.open_len += size
+            self.open_return += cum_rewards[-1]
+            return
+
+        begins = np.hstack((-self.open_len, ends[:-1] + 1))  # relative to next_idx
+        prefix = np.hstack((-self.open_return, cum_rewards[ends[:-1]]))
+        lengths = ends - begins + 1
+        is_saved = begins >= size - self.max_len  # the first memory is not overwritten by the later memories
+        self.add_episodes(((next_idx + begins) % self.max_len)[is_saved], lengths[is_saved],
+                          (cum_rewards[ends] - prefix)[is_saved])
+
+        self.open_start = (next_idx + ends[-1] + 1) % self.max_len
+        self.open_len = size - ends[-1] - 1
+        self.open_return = cum_rewards[-1] - cum_rewards[ends[-1]]
+
+    def add_episodes(self, starts, lengths, returns):
+        episode_ids = np.arange(self.tail_id, self.tail_id + starts.shape[0])
+        slots = episode_ids % self.max_len
+        self.starts[slots] = starts
+        self.lengths[slots] = lengths
+        self.returns[slots] = returns
+        self.tail_id += starts.shape[0]
+
+        step_ids = np.arange(lengths.sum()) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+        memo_idx = (np.repeat(starts, lengths) + step_ids) % self.max_len
+        self.memo_episode[memo_idx] = np.repeat(episode_ids, lengths)
+
+    '''O(1) lookup'''
+
+    def get_episode(self, episode_id):  # return (start, length, return), the memories of an episode may wrap around
+        slot = episode_id % self.max_len
+        return self.starts[slot], self.lengths[slot], self.returns[slot]
+
+    def get_episode_id(self, memo_idx):  # the episode of a memory in buffer, -1: open or evicted
+        episode_id = self.memo_episode[memo_idx]
+        return episode_id if self.head_id <= episode_id < self.tail_id else -1
+
+    def get_oldest_id(self):
+        return self.head_id if len(self) > 0 else -1
+
+    def evict_oldest(self):  # remove the oldest complete episode from the index, the buffer keeps its memories
+        assert len(self) > 0
+        start, length, episode_return = self.get_episode(self.head_id)
+        self.head_id += 1
+        return start, length, episode_return
+
+    '''sample'''
+
+    def sample_episodes(self, batch_size):  # return episode_ids
+        return self.head_id + rd.randint(len(self), size=batch_size)
+
+    def sample_segments(self, batch_size, seg_len):
+        """return memo_idx shape == (batch_size, seg_len), each segment is contiguous within one episode.
+        The segments are sampled uniformly from all the segments of episodes (len >= seg_len).
+        """
+        slots = np.arange(self.head_id, self.tail_id) % self.max_len
+        seg_nums = np.maximum(self.lengths[slots] - seg_len + 1, 0)  # the number of segments in each episode
+        seg_cums = np.cumsum(seg_nums)
+        assert seg_cums[-1] > 0
+
+        seg_ids = rd.randint(seg_cums[-1], size=batch_size)
+        episode_i = np.searchsorted(seg_cums, seg_ids, side='right')
+        offsets = seg_ids - (seg_cums[episode_i] - seg_nums[episode_i])
+        starts = self.starts[slots[episode_i]] + offsets
+        return (starts[:, np.newaxis] + np.arange(seg_len)[np.newaxis, :]) % self.max_len
+
+    def get_memo_idx(self, episode_id):  # the memo_idx of all the memories of an episode
+        start, length, _ = self.get_episode(episode_id)
+        return (start + np.arange(length)) % self.max_len
+
+
 class BufferArray:  # 2020-05-20
-    def __init__(self, memo_max_len, state_dim, action_dim, ):
+    def __init__(self, memo_max_len, state_dim, action_dim, memo_dtype=np.float32, n_step=1):
         state_dim = state_dim if isinstance(state_dim, int) else np.prod(state_dim)  # pixel-level state
 
         memo_dim = 1 + 1 + state_dim + action_dim + state_dim
-        self.memories = np.empty((memo_max_len, memo_dim), dtype=np.float32)
+        self.memories = np.empty((memo_max_len, memo_dim), dtype=memo_dtype)  # np.float16 halves the memory
 
         self.next_idx = 0
         self.is_full = False
@@ -1843,30 +2423,62 @@ class BufferArray:  # 2020-05-20
         self.state_idx = 1 + 1 + state_dim  # reward_dim==1, done_dim==1
         self.action_idx = self.state_idx + action_dim
 
+        self.state_dim = state_dim
+        self.n_step = n_step  # n-step return, 1: close. The memories of extend_memo() should be in time order.
+        self.open_idx = list()  # for add_memo(), the indices of memories which have fewer than n_step steps
+        self.episodes = EpisodeIndex(memo_max_len)  # the start, length and return of episodes in buffer
+
     def add_memo(self, memo_tuple):
         # memo_array == (reward, mask, state, action, next_state)
-        self.memories[self.next_idx] = np.hstack(memo_tuple)
+        memo_array = np.hstack(memo_tuple)
+        self.episodes.add_memo(self.next_idx, memo_array[0], memo_array[1])
+        if self.n_step > 1:  # extend the n-step memories of the last n_step-1 steps
+            self.update_open_memo(memo_array)
+
+        self.memories[self.next_idx] = memo_array
         self.next_idx = self.next_idx + 1
         if self.next_idx >= self.max_len:
             self.is_full = True
             self.next_idx = 0
 
+    def update_open_memo(self, memo_array):
+        """The memories in self.open_idx have fewer than n_step steps and the episode does not end.
+        They are extended by the new memo. A memory in the buffer is always an unbiased k-step memory (k <= n_step)
+        """
+        if self.open_idx:
+            idx = np.array(self.open_idx)
+            self.memories[idx, 0] += self.memories[idx, 1] * memo_array[0]  # reward
+            self.memories[idx, 1] *= memo_array[1]  # mask
+            self.memories[idx, self.action_idx:] = memo_array[self.action_idx:]  # next_state
+
+        if memo_array[1] == 0.0:  # done, all the memories of this episode are closed
+            self.open_idx = list()
+        else:
+            self.open_idx.append(self.next_idx)
+            self.open_idx = self.open_idx[-(self.n_step - 1):]
+
     def extend_memo(self, memo_array):  # 2020-07-07
         # assert isinstance(memo_array, np.ndarray)
+        self.episodes.extend_memo(self.next_idx, memo_array[:, 0], memo_array[:, 1])  # before n-step
+        if self.n_step > 1:
+            memo_array = get_n_step_memo(memo_array, self.n_step, self.state_dim)
+            self.open_idx = list()
         size = memo_array.shape[0]
         next_idx = self.next_idx + size
         if next_idx < self.max_len:
             self.memories[self.next_idx:next_idx] = memo_array
-        if next_idx >= self.max_len:
-            if next_idx > self.max_len:
-                self.memories[self.next_idx:self.max_len] = memo_array[:self.max_len - self.next_idx]
+        else:  # fix bug: it did not write the tail part when next_idx == self.max_len
+            self.memories[self.next_idx:self.max_len] = memo_array[:self.max_len - self.next_idx]
             self.is_full = True
             next_idx = next_idx - self.max_len
-            self.memories[0:next_idx] = memo_array[-next_idx:]
-        else:
-            self.memories[self.next_idx:next_idx] = memo_array
+            if next_idx > 0:
+                self.memories[0:next_idx] = memo_array[-next_idx:]
         self.next_idx = next_idx
 
+    def close_episode(self):  # the episode in progress is abandoned without done, such as env.reset() before done
+        self.open_idx = list()  # its n-step memories are not extended by the steps of the next episode
+        self.episodes.drop_open()
+
     def init_before_sample(self):
         self.now_len = self.max_len if self.is_full else self.next_idx
 
@@ -1879,7 +2491,81 @@ class BufferArray:  # 2020-05-20
         indices = rd.randint(self.now_len, size=batch_size)
         memory = self.memories[indices]
         if device:
-            memory = torch.tensor(memory, device=device)
+            memory = torch.tensor(memory, dtype=torch.float32, device=device)
+
+        '''convert array into torch.tensor'''
+        tensors = (
+            memory[:, 0:1],  # rewards
+            memory[:, 1:2],  # masks, mark == (1-float(done)) * gamma
+            memory[:, 2:self.state_idx],  # states
+            memory[:, self.state_idx:self.action_idx],  # actions
+            memory[:, self.action_idx:],  # next_states
+        )
+        return tensors
+
+    def random_sample_segment(self, batch_size, seg_len, device):  # 2020-09-15, the memories in one episode
+        memo_idx = self.episodes.sample_segments(batch_size, seg_len)  # shape == (batch_size, seg_len)
+        memory = self.memories[memo_idx]
+        if device:
+            memory = torch.tensor(memory, dtype=torch.float32, device=device)
+
+        '''convert array into torch.tensor'''
+        tensors = (
+            memory[:, :, 0:1],  # rewards
+            memory[:, :, 1:2],  # masks, mark == (1-float(done)) * gamma
+            memory[:, :, 2:self.state_idx],  # states
+            memory[:, :, self.state_idx:self.action_idx],  # actions
+            memory[:, :, self.action_idx:],  # next_states
+        )
+        return tensors
+
+
+class BufferArrayPER(BufferArray):  # Prioritized Experience Replay, the replay buffer of mp__replay_server() 2020-09-21
+    def __init__(self, memo_max_len, state_dim, action_dim, memo_dtype=np.float32, n_step=1, alpha=0.6, beta=0.4):
+        """The probability of sampling memory i is p_i ** alpha / sum(p ** alpha), p_i == |td_error_i| + prio_eps.
+        The critic loss of memory i is weighted by the importance sampling weight (now_len * prob_i) ** -beta,
+        normalized by the max weight in a batch.
+        """
+        super().__init__(memo_max_len, state_dim, action_dim, memo_dtype, n_step)
+        self.tree = SumTree(memo_max_len)  # the sum tree of p ** alpha
+        self.alpha = alpha
+        self.beta = beta
+        self.prio_eps = 1e-6  # the memory with zero td_error can be sampled
+        self.prio_max = 1.0  # the priority (p ** alpha) of the new memories without td_error
+        self.per_indices = None  # the indices of the last random_sample_per(), for td_error_update()
+
+    def add_memo(self, memo_tuple):
+        self.tree.update_ids(np.array((self.next_idx,)), np.array((self.prio_max,)))
+        super().add_memo(memo_tuple)
+
+    def extend_memo(self, memo_array, td_errors=None):
+        """td_errors: the initial priorities computed by the explorer (get_td_priority), None: the max priority"""
+        memo_idx = (self.next_idx + np.arange(memo_array.shape[0])) % self.max_len
+        if td_errors is None:
+            prios = np.full(memo_idx.shape[0], self.prio_max)
+        else:
+            prios = self.get_prios(td_errors)
+        super().extend_memo(memo_array)
+        self.tree.update_ids(memo_idx, prios)
+
+    def get_prios(self, td_errors):
+        prios = (np.abs(np.asarray(td_errors, dtype=np.float64).reshape(-1)) + self.prio_eps) ** self.alpha
+        self.prio_max = max(self.prio_max, prios.max())
+        return prios
+
+    def get_per_indices(self, batch_size):
+        indices, probs = self.tree.important_sampling(batch_size)
+        is_weights = (probs * self.now_len) ** -self.beta
+        is_weights = (is_weights / is_weights.max()).astype(np.float32)
+        return indices, is_weights
+
+    def random_sample_per(self, batch_size, device):
+        indices, is_weights = self.get_per_indices(batch_size)
+        self.per_indices = indices
+        memory = self.memories[indices]
+        if device:
+            memory = torch.tensor(memory, dtype=torch.float32, device=device)
+            is_weights = torch.tensor(is_weights, dtype=torch.float32, device=device)
 
         '''convert array into torch.tensor'''
         tensors = (
@@ -1888,18 +2574,59 @@ class BufferArray:  # 2020-05-20
             memory[:, 2:self.state_idx],  # states
             memory[:, self.state_idx:self.action_idx],  # actions
             memory[:, self.action_idx:],  # next_states
+            is_weights.reshape(-1, 1),  # importance sampling weights
         )
         return tensors
 
+    def td_error_update(self, td_errors, indices=None):  # the new priorities of the memories of random_sample_per()
+        if isinstance(td_errors, torch.Tensor):
+            td_errors = td_errors.detach().cpu().numpy()
+        indices = self.per_indices if indices is None else indices
+        self.tree.update_ids(indices, self.get_prios(td_errors))
+
+
+class SumTree:  # 2020-09-21, a binary tree, the parent node is the sum of its two children
+    def __init__(self, max_len):
+        """tree[1] is the root (the total priority), the leaf of memory i is tree[self.leaf_start + i]
+        The leaves of empty memories are 0.0, so they are never sampled.
+        """
+        self.max_len = max_len
+        self.depth = int(np.ceil(np.log2(max(max_len, 2))))
+        self.leaf_start = 2 ** self.depth
+        self.tree = np.zeros(self.leaf_start * 2, dtype=np.float64)
+
+    def update_ids(self, data_ids, prios):  # vectorized, update the leaves and then their parents level by level
+        tree_ids = data_ids + self.leaf_start
+        self.tree[tree_ids] = prios  # the last one wins if data_ids has duplicates (same as BufferArray.memories)
+
+        for _ in range(self.depth):
+            tree_ids = np.unique(tree_ids // 2)
+            self.tree[tree_ids] = self.tree[tree_ids * 2] + self.tree[tree_ids * 2 + 1]
+
+    def important_sampling(self, batch_size):  # stratified sampling, one value in each of the batch_size segments
+        total = self.tree[1]
+        values = (np.arange(batch_size) + rd.rand(batch_size)) * (total / batch_size)
+
+        tree_ids = np.ones(batch_size, dtype=np.int64)
+        for _ in range(self.depth):  # vectorized, go down from the root to the leaves
+            left_ids = tree_ids * 2
+            left_values = self.tree[left_ids]
+            is_right = (values >= left_values) & (self.tree[left_ids + 1] > 0.0)  # float error, never go to 0.0
+            values = values - left_values * is_right
+            tree_ids = left_ids + is_right
+
+        probs = self.tree[tree_ids] / total
+        return tree_ids - self.leaf_start, probs
+
 
 class BufferArrayGPU:  # 2020-07-07, for mp__update_params()
-    def __init__(self, memo_max_len, state_dim, action_dim, ):
+    def __init__(self, memo_max_len, state_dim, action_dim, memo_dtype=torch.float32, n_step=1):
         state_dim = state_dim if isinstance(state_dim, int) else np.prod(state_dim)  # pixel-level state
 
         memo_dim = 1 + 1 + state_dim + action_dim + state_dim
         assert torch.cuda.is_available()
         self.device = torch.device("cuda")
-        self.memories = torch.empty((memo_max_len, memo_dim), dtype=torch.float32, device=self.device)
+        self.memories = torch.empty((memo_max_len, memo_dim), dtype=memo_dtype, device=self.device)
 
         self.next_idx = 0
         self.is_full = False
@@ -1909,34 +2636,50 @@ class BufferArrayGPU:  # 2020-07-07, for mp__update_params()
         self.state_idx = 1 + 1 + state_dim  # reward_dim==1, done_dim==1
         self.action_idx = self.state_idx + action_dim
 
+        self.state_dim = state_dim
+        self.n_step = n_step  # n-step return, 1: close. The memories of extend_memo() should be in time order.
+        self.open_idx = list()  # for add_memo(), the indices of memories which have fewer than n_step steps
+        self.episodes = EpisodeIndex(memo_max_len)  # the start, length and return of episodes in buffer
+
     def add_memo(self, memo_tuple):
         """memo_tuple == (reward, mask, state, action, next_state)
         """
         memo_array = np.hstack(memo_tuple)
+        self.episodes.add_memo(self.next_idx, memo_array[0], memo_array[1])
+        if self.n_step > 1:  # extend the n-step memories of the last n_step-1 steps
+            self.update_open_memo(torch.tensor(memo_array, dtype=self.memories.dtype, device=self.device))
         self.memories[self.next_idx] = torch.tensor(memo_array, device=self.device)
         self.next_idx = self.next_idx + 1
         if self.next_idx >= self.max_len:
             self.is_full = True
             self.next_idx = 0
 
+    update_open_memo = BufferArray.update_open_memo
+
     def extend_memo(self, memo_array):  # 2020-07-07
         # assert isinstance(memo_array, np.ndarray)
+        self.episodes.extend_memo(self.next_idx, memo_array[:, 0], memo_array[:, 1])  # before n-step
+        if self.n_step > 1:
+            memo_array = get_n_step_memo(memo_array, self.n_step, self.state_dim)
+            self.open_idx = list()
         size = memo_array.shape[0]
         memo_tensor = torch.tensor(memo_array, device=self.device)
 
         next_idx = self.next_idx + size
         if next_idx < self.max_len:
             self.memories[self.next_idx:next_idx] = memo_tensor
-        if next_idx >= self.max_len:
-            if next_idx > self.max_len:
-                self.memories[self.next_idx:self.max_len] = memo_tensor[:self.max_len - self.next_idx]
+        else:  # fix bug: it did not write the tail part when next_idx == self.max_len
+            self.memories[self.next_idx:self.max_len] = memo_tensor[:self.max_len - self.next_idx]
             self.is_full = True
             next_idx = next_idx - self.max_len
-            self.memories[0:next_idx] = memo_tensor[-next_idx:]
-        else:
-            self.memories[self.next_idx:next_idx] = memo_tensor
+            if next_idx > 0:
+                self.memories[0:next_idx] = memo_tensor[-next_idx:]
         self.next_idx = next_idx
 
+    def close_episode(self):  # the episode in progress is abandoned without done, such as env.reset() before done
+        self.open_idx = list()  # its n-step memories are not extended by the steps of the next episode
+        self.episodes.drop_open()
+
     def init_before_sample(self):
         self.now_len = self.max_len if self.is_full else self.next_idx
 
@@ -1947,7 +2690,7 @@ class BufferArrayGPU:  # 2020-07-07, for mp__update_params()
         # indices = rd.choice(self.memo_len, batch_size, replace=True)  # why perform better?
         # same as:
         indices = rd.randint(self.now_len, size=batch_size)
-        memory = self.memories[indices]
+        memory = self.memories[indices].float()  # float() does nothing when memo_dtype is torch.float32
         # if device:
         #     memory = torch.tensor(memory, device=device)
 
@@ -1961,6 +2704,131 @@ class BufferArrayGPU:  # 2020-07-07, for mp__update_params()
         )
         return tensors
 
+    def random_sample_segment(self, batch_size, seg_len, _device):  # 2020-09-15, the memories in one episode
+        memo_idx = self.episodes.sample_segments(batch_size, seg_len)  # shape == (batch_size, seg_len)
+        memory = self.memories[torch.as_tensor(memo_idx, device=self.device)].float()
+
+        '''convert array into torch.tensor'''
+        tensors = (
+            memory[:, :, 0:1],  # rewards
+            memory[:, :, 1:2],  # masks, mark == (1-float(done)) * gamma
+            memory[:, :, 2:self.state_idx],  # states
+            memory[:, :, self.state_idx:self.action_idx],  # actions
+            memory[:, :, self.action_idx:],  # next_states
+        )
+        return tensors
+
+
+class BufferArrayPop:  # the replay buffers of the agents of AgentPopSAC, stacked in axis 0 2020-09-19
+    def __init__(self, memo_max_len, state_dim, action_dim, pop_num):
+        memo_dim = 1 + 1 + state_dim + action_dim + state_dim
+        self.memories = np.empty((pop_num, memo_max_len, memo_dim), dtype=np.float32)
+
+        self.next_idx = 0
+        self.is_full = False
+        self.max_len = memo_max_len
+        self.now_len = self.max_len if self.is_full else self.next_idx
+
+        self.state_idx = 1 + 1 + state_dim  # reward_dim==1, done_dim==1
+        self.action_idx = self.state_idx + action_dim
+        self.pop_num = pop_num
+
+    def add_memo(self, memo_tuple):
+        # memo_tuple == (reward, mask, state, action, next_state), each item has pop_num rows
+        memo_array = np.hstack([np.reshape(item, (self.pop_num, -1)) for item in memo_tuple])
+        self.memories[:, self.next_idx] = memo_array
+        self.next_idx = self.next_idx + 1
+        if self.next_idx >= self.max_len:
+            self.is_full = True
+            self.next_idx = 0
+
+    def init_before_sample(self):
+        self.now_len = self.max_len if self.is_full else self.next_idx
+
+    def random_sample(self, batch_size, device):
+        indices = rd.randint(self.now_len, size=(self.pop_num, batch_size))  # each agent samples its own memories
+        memory = self.memories[np.arange(self.pop_num)[:, np.newaxis], indices]
+        memory = torch.tensor(memory, dtype=torch.float32, device=device)
+
+        '''convert array into torch.tensor'''
+        tensors = (
+            memory[:, :, 0:1],  # rewards
+            memory[:, :, 1:2],  # masks, mark == (1-float(done)) * gamma
+            memory[:, :, 2:self.state_idx],  # states
+            memory[:, :, self.state_idx:self.action_idx],  # actions
+            memory[:, :, self.action_idx:],  # next_states
+        )
+        return tensors
+
+
+class BufferSeq:  # sequence replay for recurrent policy, such as AgentRecurrentSAC 2020-09-14
+    def __init__(self, memo_max_len, state_dim, action_dim, hidden_dim, seq_len=2 ** 4, burn_in=2 ** 3):
+        """Save the transitions (reward, mask, state, action) in time order, and the recurrent state (hidden)
+        at the start of each chunk. A chunk starts every chunk_gap steps, so the chunks overlap each other.
+        random_sample() returns the sequences of chunks in shape (seq, batch, dim), seq == burn_in + seq_len,
+        state has one more step for the next_state of the last step.
+        The saved hidden may be stale (saved by an older policy), the burn-in prefix rebuilds it.
+        """
+        state_dim = state_dim if isinstance(state_dim, int) else np.prod(state_dim)  # pixel-level state
+        self.chunk_gap = max(seq_len // 2, 1)  # the chunks overlap by half of seq_len
+        assert memo_max_len % self.chunk_gap == 0
+
+        memo_dim = 1 + 1 + state_dim + action_dim
+        self.memories = np.empty((memo_max_len, memo_dim), dtype=np.float32)
+        self.hiddens = np.zeros((memo_max_len // self.chunk_gap, hidden_dim), dtype=np.float32)
+
+        self.next_idx = 0
+        self.is_full = False
+        self.max_len = memo_max_len
+        self.now_len = self.max_len if self.is_full else self.next_idx
+
+        self.state_idx = 1 + 1 + state_dim  # reward_dim==1, done_dim==1
+        self.seq_len = burn_in + seq_len + 1
+        self.chunk_starts = np.empty(0, dtype=np.int64)  # the chunks which are saved and not overwritten
+
+    def add_memo(self, memo_tuple, hidden=None):
+        """memo_tuple == (reward, mask, state, action, *_), next_state is the state of the next step.
+        hidden: the recurrent state before this state. None: zero, such as initial_exploration()
+        """
+        if self.next_idx % self.chunk_gap == 0:
+            self.hiddens[self.next_idx // self.chunk_gap] = 0.0 if hidden is None else hidden
+
+        self.memories[self.next_idx] = np.hstack(memo_tuple[:4])
+        self.next_idx = self.next_idx + 1
+        if self.next_idx >= self.max_len:
+            self.is_full = True
+            self.next_idx = 0
+
+    def close_episode(self):  # the episode in progress is abandoned without done, such as env.reset() before done
+        if self.is_full or self.next_idx > 0:  # the next_state of a memory is the next memory, so it is marked as done
+            self.memories[self.next_idx - 1, 1] = 0.0  # mask, next_idx - 1 == -1 when next_idx == 0
+
+    def init_before_sample(self):
+        self.now_len = self.max_len if self.is_full else self.next_idx
+
+        starts = np.arange(0, self.max_len, self.chunk_gap)
+        if self.is_full:  # the steps of chunk should not cross the next_idx (the oldest memory)
+            is_saved = (self.next_idx - starts) % self.max_len >= self.seq_len
+        else:
+            is_saved = starts + self.seq_len <= self.next_idx
+        self.chunk_starts = starts[is_saved]
+
+    def random_sample(self, batch_size, device):
+        starts = self.chunk_starts[rd.randint(len(self.chunk_starts), size=batch_size)]
+        indices = (starts[np.newaxis, :] + np.arange(self.seq_len)[:, np.newaxis]) % self.max_len
+        memory = torch.tensor(self.memories[indices], dtype=torch.float32, device=device)  # (seq, batch, dim)
+        hidden = torch.tensor(self.hiddens[starts // self.chunk_gap], dtype=torch.float32, device=device)
+
+        '''convert array into torch.tensor'''
+        tensors = (
+            memory[:-1, :, 0:1],  # rewards
+            memory[:-1, :, 1:2],  # masks, mark == (1-float(done)) * gamma
+            memory[:, :, 2:self.state_idx],  # states, one more step for next_state
+            memory[:-1, :, self.state_idx:],  # actions
+            hidden,  # the recurrent state before states[0]
+        )
+        return tensors
+
 
 class BufferTuple:
     def __init__(self, memo_max_len):
@@ -172,6 +172,135 @@ class MInterSPG(nn.Module):  # class AgentIntelAC for SAC (SPG means stochastic
         return pg_sum
 
 
+class MultiLinear(nn.Module):  # n_agents nn.Linear in one batched matmul, x: (batch, n_agents, inp_dim)
+    def __init__(self, n_agents, inp_dim, out_dim):
+        super().__init__()
+        self.weight = nn.Parameter(torch.empty(n_agents, inp_dim, out_dim))
+        self.bias = nn.Parameter(torch.empty(n_agents, 1, out_dim))
+
+        bound = 1 / np.sqrt(inp_dim)  # the same as the default init of nn.Linear
+        nn.init.uniform_(self.weight, -bound, bound)
+        nn.init.uniform_(self.bias, -bound, bound)
+
+    def forward(self, x):
+        return torch.baddbmm(self.bias, x.transpose(0, 1), self.weight).transpose(0, 1)
+
+
+def layer_norm_multi(layer, std=1.0, bias_const=1e-6):  # layer_norm() for each agent of MultiLinear
+    for weight in layer.weight.data:
+        torch.nn.init.orthogonal_(weight.t(), std)  # weight.t() is the weight of nn.Linear
+    torch.nn.init.constant_(layer.bias, bias_const)
+
+
+class MInterSPGBatch(nn.Module):  # MInterSPG for homogeneous agents, stack the agents in an axis 2020-09-10
+    def __init__(self, state_dim, action_dim, mid_dim, n_agents):
+        """state: (batch, n_agents, state_dim), action: (batch, n_agents, action_dim)
+        The encoders and decoders of agents are MultiLinear (a batched matmul), instead of Python loops.
+        Each agent keeps its own weights in MultiLinear (not parameter sharing), the same as MInterSPG.
+        """
+        super().__init__()
+        self.n_agents = n_agents
+
+        self.log_std_min = -20
+        self.log_std_max = 2
+        self.constant_log_sqrt_2pi = np.log(np.sqrt(2 * np.pi))
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+        '''encoders'''
+        self.enc_s = nn.Sequential(MultiLinear(n_agents, state_dim, mid_dim), nn.ReLU(),
+                                   MultiLinear(n_agents, mid_dim, mid_dim), )  # encoders of state
+        self.enc_a = nn.Sequential(MultiLinear(n_agents, action_dim, mid_dim), nn.ReLU(),
+                                   MultiLinear(n_agents, mid_dim, mid_dim), )  # encoders of action
+
+        self.net = DenseNet2(mid_dim)
+        net_out_dim = self.net.out_dim
+
+        '''decoders'''
+        self.dec_a = nn.Sequential(MultiLinear(n_agents, net_out_dim, mid_dim), nn.ReLU(),
+                                   MultiLinear(n_agents, mid_dim, action_dim), )  # decoder of action mean
+        self.dec_d = nn.Sequential(MultiLinear(n_agents, net_out_dim, mid_dim), nn.ReLU(),
+                                   MultiLinear(n_agents, mid_dim, action_dim), )  # decoder of action LogStd
+        self.dec_q1 = nn.Sequential(
+            nn.Linear(net_out_dim, mid_dim), nn.ReLU(),
+            nn.Linear(mid_dim, n_agents),
+        )  # decoder of q1 (Q value for twin critics)
+        self.dec_q2 = nn.Sequential(
+            nn.Linear(net_out_dim, mid_dim), nn.ReLU(),
+            nn.Linear(mid_dim, n_agents),
+        )  # decoder of q2 (Q value for twin critics)
+
+        layer_norm_multi(self.dec_a[-1], std=0.01)  # net[-1] is output layer for action, it is no necessary.
+        layer_norm(self.dec_q1[-1], std=0.1)
+        layer_norm(self.dec_q2[-1], std=0.1)
+
+    def get__a_(self, s):  # the shared feature of all agents, (batch, n_agents, net_out_dim)
+        a_ = self.net(self.enc_s(s).mean(dim=1))
+        return a_.unsqueeze(1).expand(-1, self.n_agents, -1)
+
+    def forward(self, s, noise_std=0.0):  # actor, in fact, noise_std is a boolean
+        is_list = isinstance(s, (list, tuple))  # the list of agents, such as get_episode_reward_ma()
+        s = torch.stack(s, dim=1) if is_list else s
+
+        a_ = self.get__a_(s)
+        a_mean = self.dec_a(a_)  # NOTICE! it is a_mean without tensor.tanh()
+        if noise_std != 0.0:
+            a_std_log = self.dec_d(a_).clamp(self.log_std_min, self.log_std_max)
+            a_std = a_std_log.exp()
+            a_mean = torch.normal(a_mean, a_std)  # NOTICE! it is a_mean without .tanh()
+        a_mean = a_mean.tanh()
+        return a_mean.unbind(dim=1) if is_list else a_mean
+
+    def get__a__log_prob(self, s):  # actor, log_prob: (batch, n_agents)
+        a_mean_tanh, a_std_log, a_noise_tanh, log_prob = self.get__a__avg_std_noise_prob(s)
+        return a_noise_tanh, log_prob
+
+    def get__a__std(self, s):
+        a_ = self.get__a_(s)
+        a_mean = self.dec_a(a_)  # NOTICE! it is a_mean without .tanh()
+        a_std_log = self.dec_d(a_).clamp(self.log_std_min, self.log_std_max)
+        return a_mean.tanh(), a_std_log
+
+    def get__a__avg_std_noise_prob(self, s):  # actor
+        a_ = self.get__a_(s)
+        a_mean = self.dec_a(a_)  # NOTICE! it is a_mean without .tanh()
+        a_std_log = self.dec_d(a_).clamp(self.log_std_min, self.log_std_max)
+        a_std = a_std_log.exp()
+
+        """add noise to action, stochastic policy"""
+        noise = torch.randn_like(a_mean, requires_grad=True, device=self.device)
+        a_noise = a_mean + a_std * noise
+
+        '''compute log_prob according to mean and std of action (stochastic policy)'''
+        a_delta = ((a_noise - a_mean) / a_std).pow(2) * 0.5
+        log_prob_noise = a_delta + a_std_log + self.constant_log_sqrt_2pi
+
+        a_noise_tanh = a_noise.tanh()
+        log_prob = log_prob_noise + (-a_noise_tanh.pow(2) + 1.000001).log()  # todo neg_log_prob
+        return a_mean.tanh(), a_std_log, a_noise_tanh, log_prob.sum(dim=2)
+
+    def get__q1_q2(self, s, a):  # critic, q: (batch, n_agents)
+        x_ = (self.enc_s(s) + self.enc_a(a)).mean(dim=1)
+        q_ = self.net(x_)
+        return self.dec_q1(q_), self.dec_q2(q_)
+
+    def get__policy_gradient(self, s, a):  # critic
+        """The same as MInterSPG.get__policy_gradient(): the q value of agent i is evaluated with the action
+        encoding of agent i only (its loop averages a_l_[i] with n_agents-1 detached copies of a_l_[i]),
+        so the value is a_[:, i] and 1/n_agents of the gradient goes through it.
+        All n_agents evaluations run in one batch of (n_agents * batch).
+        """
+        n, b = self.n_agents, s.size(0)
+        s_ = self.enc_s(s).mean(dim=1)  # (batch, mid_dim)
+        a_ = self.enc_a(a)  # (batch, n_agents, mid_dim)
+
+        a_sum = ((a_ + a_.detach() * (n - 1)) / n).transpose(0, 1)  # (n_agents, batch, mid_dim)
+
+        q_ = self.net((s_.unsqueeze(0) + a_sum).view(n * b, -1))
+        q1 = self.dec_q1(q_).view(n, b, n).diagonal(dim1=0, dim2=2)  # q1[i, :, i] -> (batch, n_agents)
+        q2 = self.dec_q2(q_).view(n, b, n).diagonal(dim1=0, dim2=2)
+        return torch.min(q1, q2).mean()
+
+
 class MAgentInterSAC(AgentBasicAC):  # Integrated Soft Actor-Critic Methods
     def __init__(self, state_dim, action_dim, net_dim, reward_dim):  # todo multi reward
         super(AgentBasicAC, self).__init__()
@@ -326,6 +455,113 @@ class MAgentInterSAC(AgentBasicAC):  # Integrated Soft Actor-Critic Methods
         return loss_a_avg, loss_c_avg
 
 
+class MAgentInterSACBatch(MAgentInterSAC):  # MAgentInterSAC for homogeneous agents, MInterSPGBatch 2020-09-10
+    def __init__(self, state_dim, action_dim, net_dim, reward_dim):
+        super(AgentBasicAC, self).__init__()
+        assert len(set(state_dim)) == 1 and len(set(action_dim)) == 1  # homogeneous agents, such as MultiWalker
+        self.learning_rate = 8e-5
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+        self.reward_dim = reward_dim
+
+        '''network'''
+        self.act = MInterSPGBatch(state_dim[0], action_dim[0], net_dim, reward_dim).to(self.device)
+        self.act.train()
+        self.cri = self.act
+        self.act_optimizer = torch.optim.Adam(self.act.parameters(), lr=self.learning_rate)
+
+        self.act_target = MInterSPGBatch(state_dim[0], action_dim[0], net_dim, reward_dim).to(self.device)
+        self.act_target.eval()
+        self.act_target.load_state_dict(self.act.state_dict())
+
+        self.criterion1 = nn.SmoothL1Loss(reduction='none')
+        self.criterion = nn.SmoothL1Loss(reduction='mean')
+
+        '''training record'''
+        self.state = None  # env.reset()
+        self.reward_sum = 0.0
+        self.step = 0
+        self.update_counter = 0
+
+        '''extension: auto-alpha for maximum entropy'''
+        self.log_alpha = torch.tensor([0.0, ] * reward_dim, requires_grad=True, device=self.device)
+        self.alpha_optimizer = torch.optim.Adam((self.log_alpha,), lr=self.learning_rate)
+        self.target_entropy = torch.tensor([np.log(dim) * 0.5 for dim in action_dim],
+                                           requires_grad=False, device=self.device)
+
+        '''extension: auto learning rate of actor'''
+        self.trust_rho_l = [TrustRho() for _ in range(reward_dim)]
+
+        '''constant'''
+        self.explore_rate = 1.0  # explore rate when update_buffer(), 1.0 is better than 0.5
+        self.explore_noise = True  # stochastic policy choose noise_std by itself.
+
+    def select_actions(self, state_l, explore_noise=0.0):  # CPU array to GPU tensor to CPU array
+        states = torch.tensor(np.stack(state_l)[np.newaxis], dtype=torch.float32, device=self.device)
+        actions = self.act(states, explore_noise)  # (1, n_agents, action_dim)
+        return list(actions[0].cpu().data.numpy())  # array
+
+    def update_parameters(self, buffer, max_step, batch_size, repeat_times):
+        self.act.train()
+
+        loss_a_list = list()
+        loss_c_list = list()
+
+        alpha = self.log_alpha.exp().detach()
+        k = 1.0 + buffer.now_len / buffer.max_len
+        batch_size_ = int(batch_size * k)
+        update_times = int(max_step * k)
+
+        for i in range(update_times):
+            with torch.no_grad():
+                reward, mask, state, action, next_s = buffer.random_sample_stack(batch_size_, self.device)
+
+                next_a_noise, next_log_prob = self.act_target.get__a__log_prob(next_s)
+                next_q_target = torch.min(*self.act_target.get__q1_q2(next_s, next_a_noise))  # twin critic
+                q_target = reward + mask * (next_q_target + next_log_prob * alpha)  # policy entropy
+
+            '''critic_loss'''
+            q1_value, q2_value = self.cri.get__q1_q2(state, action)  # CriticTwin
+            critic_loss = (self.criterion1(q1_value, q_target).mean(dim=0) +
+                           self.criterion1(q2_value, q_target).mean(dim=0))
+            loss_c_tmp_l = critic_loss.data.cpu().numpy() * 0.5  # CriticTwin
+            loss_c_list.append(loss_c_tmp_l.mean())
+            rho_l = np.array([self.trust_rho_l[i].update_rho(loss_c_tmp_l[i])
+                              for i in range(self.reward_dim)])
+
+            '''stochastic policy'''
+            a1_mean, a1_log_std, a_noise, log_prob = self.act.get__a__avg_std_noise_prob(state)  # policy gradient
+
+            '''action correction term'''
+            a2_mean, a2_log_std = self.act_target.get__a__std(state)
+            actor_term = (self.criterion1(a1_mean, a2_mean).mean(dim=(0, 2)) +
+                          self.criterion1(a1_log_std, a2_log_std).mean(dim=(0, 2)))  # (n_agents, )
+
+            '''auto alpha'''
+            alpha_loss = (self.log_alpha * (log_prob - self.target_entropy).detach()).mean()
+            self.alpha_optimizer.zero_grad()
+            alpha_loss.backward()
+            self.alpha_optimizer.step()
+            alpha = self.log_alpha.exp().detach()
+
+            rho_l[rho_l < 2 ** -8] = 0
+            rho_l = torch.tensor(rho_l, dtype=torch.float32, device=self.device)
+            '''actor_loss'''
+            q_eval_pg = self.act_target.get__policy_gradient(state, a_noise)  # policy gradient
+            actor_loss = -(q_eval_pg + log_prob * alpha).mean()  # policy gradient
+            loss_a_list.append(actor_loss.item())
+
+            united_loss = (critic_loss + actor_term * (- rho_l + 1) + actor_loss * rho_l).sum()
+            self.act_optimizer.zero_grad()
+            united_loss.backward()
+            self.act_optimizer.step()
+
+            soft_target_update(self.act_target, self.act, tau=2 ** -8)
+
+        loss_a_avg = (sum(loss_a_list) / len(loss_a_list)) if len(loss_a_list) > 0 else 0.0
+        loss_c_avg = sum(loss_c_list) / len(loss_c_list)
+        return loss_a_avg, loss_c_avg
+
+
 def multi_to_single_walker_decorator_ma(env):
     def decorator_step(env_step):
         def new_env_step(action):
@@ -414,6 +650,22 @@ class BufferArrayMA:  # 2020-05-20
                    )
         return tensors
 
+    def random_sample_stack(self, batch_size, device):  # for homogeneous agents, MAgentInterSACBatch
+        """return (reward, mask, state, action, next_state) in shape
+        (batch, n_agents), (batch, 1), (batch, n_agents, state_dim), (batch, n_agents, action_dim), ...
+        The states of agents are adjacent in a row of memories, so it is a view instead of per-agent slices.
+        """
+        indices = rd.randint(self.now_len, size=batch_size)
+        memory = torch.tensor(self.memories[indices], device=device)
+
+        n = self.num_l[1] - self.num_l[0]  # n_agents
+        i_s, i_a, i_n, i_end = [self.idx_l[i] for i in self.num_l]
+        return (memory[:, 0:self.idx_l[1]],
+                memory[:, self.idx_l[1]:i_s],
+                memory[:, i_s:i_a].view(batch_size, n, -1),
+                memory[:, i_a:i_n].view(batch_size, n, -1),
+                memory[:, i_n:i_end].view(batch_size, n, -1),)
+
 
 def initial_exploration_ma(env, memo, max_step, action_max, reward_scale, gamma, action_dim_l):
     state_l = env.reset()
@@ -624,7 +876,7 @@ def train_agent(
 
 def run_continuous_action(gpu_id=None):
     # import AgentZoo as Zoo
-    args = Arguments(rl_agent=MAgentInterSAC, gpu_id=gpu_id)
+    args = Arguments(rl_agent=MAgentInterSACBatch, gpu_id=gpu_id)
 
     args.env_name = "MultiWalker"
     args.random_seed = 1945
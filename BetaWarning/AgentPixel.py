@@ -35,6 +35,15 @@ def test_conv2d():
     exit()
 
 
+class PixelState(nn.Module):  # NnnReshape for uint8 pixel state, convert it to float inside the network
+    def __init__(self, *args):
+        super().__init__()
+        self.args = args
+
+    def forward(self, x):  # x is uint8 or float (0, 255), such as torch.tensor(uint8_array, dtype=torch.float32)
+        return x.view((x.size(0),) + self.args).float() / 128.0 - 1.0
+
+
 class ActorGAE(nn.Module):
     def __init__(self, state_dim, action_dim, mid_dim):
         super().__init__()
@@ -43,7 +52,7 @@ class ActorGAE(nn.Module):
             return int(16 * 1.6487 ** i)
 
         self.net = nn.Sequential(
-            NnnReshape(*state_dim),  # -> [?, 2, 96, 96]
+            PixelState(*state_dim),  # uint8 [?, k*96*96] -> float [?, k, 96, 96]
             nn.Conv2d(state_dim[0], idx_dim(0), 3, 2, bias=True),  # todo CarRacing-v0
             nn.Conv2d(idx_dim(0), idx_dim(1), 4, 2, bias=False), nn.ReLU(),
             nn.Conv2d(idx_dim(1), idx_dim(2), 3, 2, bias=False), nn.ReLU(),
@@ -102,7 +111,7 @@ class CriticAdvTwin(nn.Module):
             return int(16 * 1.6487 ** i)
 
         self.net = nn.Sequential(
-            NnnReshape(*state_dim),  # -> [?, 2, 96, 96]
+            PixelState(*state_dim),  # uint8 [?, k*96*96] -> float [?, k, 96, 96]
             nn.Conv2d(state_dim[0], idx_dim(0), 3, 2, bias=True),  # todo CarRacing-v0
             nn.Conv2d(idx_dim(0), idx_dim(1), 4, 2, bias=False), nn.ReLU(),
             nn.Conv2d(idx_dim(1), idx_dim(2), 3, 2, bias=False), nn.ReLU(),
@@ -135,7 +144,7 @@ class ActorSAC(nn.Module):
 
         if use_dn:  # use DenseNet (DenseNet has both shallow and deep linear layer)
             self.net__mid = nn.Sequential(
-                NnnReshape(*state_dim),  # -> [?, 2, 96, 96]
+                PixelState(*state_dim),  # uint8 [?, k*96*96] -> float [?, k, 96, 96]
                 nn.Conv2d(state_dim[0], idx_dim(0), 3, 2, bias=True),  # todo CarRacing-v0
                 nn.Conv2d(idx_dim(0), idx_dim(1), 4, 2, bias=False), nn.ReLU(),
                 nn.Conv2d(idx_dim(1), idx_dim(2), 3, 2, bias=False), nn.ReLU(),
@@ -213,7 +222,7 @@ class CriticTwinShared(nn.Module):  # 2020-06-18
             return int(16 * 1.6487 ** i)
 
         self.enc_s = nn.Sequential(
-            NnnReshape(*state_dim),  # -> [?, 2, 96, 96]
+            PixelState(*state_dim),  # uint8 [?, k*96*96] -> float [?, k, 96, 96]
             nn.Conv2d(state_dim[0], idx_dim(0), 3, 2, bias=True),  # todo CarRacing-v0
             nn.Conv2d(idx_dim(0), idx_dim(1), 4, 2, bias=False), nn.ReLU(),
             nn.Conv2d(idx_dim(1), idx_dim(2), 3, 2, bias=False), nn.ReLU(),
@@ -261,6 +270,89 @@ class CriticTwinShared(nn.Module):  # 2020-06-18
         return q_value1, q_value2
 
 
+class ConvEncoder(nn.Module):  # the conv stack over 96x96 pixel state, shared by actor and critic
+    def __init__(self, state_dim, mid_dim):
+        super().__init__()
+
+        def idx_dim(i):
+            return int(16 * 1.6487 ** i)
+
+        self.net = nn.Sequential(
+            PixelState(*state_dim),  # uint8 [?, k*96*96] -> float [?, k, 96, 96]
+            nn.Conv2d(state_dim[0], idx_dim(0), 3, 2, bias=True),
+            nn.Conv2d(idx_dim(0), idx_dim(1), 4, 2, bias=False), nn.ReLU(),
+            nn.Conv2d(idx_dim(1), idx_dim(2), 3, 2, bias=False), nn.ReLU(),
+            nn.Conv2d(idx_dim(2), idx_dim(1), 3, 1, bias=True), nn.ReLU(),
+            NnnReshape(-1),  # [?, 26, 8, 8] -> [?, 1664]
+            nn.Linear(1664, mid_dim), nn.ReLU(),
+        )
+
+    def forward(self, state):
+        return self.net(state)
+
+
+class EncoderSAC(nn.Module):  # actor and twin critic read the feature of one ConvEncoder 2020-09-09
+    def __init__(self, state_dim, action_dim, mid_dim):
+        super().__init__()
+        self.log_std_min = -20
+        self.log_std_max = 2
+        self.constant_log_sqrt_2pi = np.log(np.sqrt(2 * np.pi))
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+        self.enc_s = ConvEncoder(state_dim, mid_dim)
+
+        self.act_mid = nn.Sequential(
+            nn.Linear(mid_dim, mid_dim), nn.ReLU(),
+            DenseNet(mid_dim),
+        )
+        self.act_mean = nn.Linear(mid_dim * 4, action_dim)  # the output layer dim of DenseNet is 'mid_dim * 4'
+        self.act_std_log = nn.Linear(mid_dim * 4, action_dim)
+
+        self.cri_mid = nn.Sequential(
+            nn.Linear(mid_dim + action_dim, mid_dim), nn.ReLU(),
+            DenseNet(mid_dim),
+        )
+        self.cri_q1 = nn.Linear(mid_dim * 4, 1)
+        self.cri_q2 = nn.Linear(mid_dim * 4, 1)
+
+        layer_norm(self.act_mean, std=0.01)  # output layer for action
+
+    def actor_parameters(self):  # the encoder is not in it
+        return [param for net in (self.act_mid, self.act_mean, self.act_std_log) for param in net.parameters()]
+
+    def critic_parameters(self):  # the encoder is updated by critic_loss
+        return [param for net in (self.enc_s, self.cri_mid, self.cri_q1, self.cri_q2) for param in net.parameters()]
+
+    def forward(self, state, noise_std=0.0):  # actor, in fact, noise_std is a boolean
+        x = self.act_mid(self.enc_s(state))
+        a_mean = self.act_mean(x)  # NOTICE! it is a_mean without .tanh()
+
+        if noise_std != 0.0:
+            a_std_log = self.act_std_log(x).clamp(self.log_std_min, self.log_std_max)
+            a_std = a_std_log.exp()
+            a_mean = torch.normal(a_mean, a_std)  # NOTICE! it needs .tanh()
+        return a_mean.tanh()
+
+    def get__a__log_prob(self, feature):  # actor, feature = self.enc_s(state)
+        x = self.act_mid(feature)
+        a_mean = self.act_mean(x)  # NOTICE! it needs a_mean.tanh()
+        a_std_log = self.act_std_log(x).clamp(self.log_std_min, self.log_std_max)
+        a_std = a_std_log.exp()
+
+        """add noise to action in stochastic policy"""
+        a_noise = a_mean + a_std * torch.randn_like(a_mean, requires_grad=True, device=self.device)
+        a_delta = ((a_noise - a_mean) / a_std).pow(2) * 0.5
+        log_prob_noise = -(a_delta + a_std_log + self.constant_log_sqrt_2pi)
+
+        a_noise_tanh = a_noise.tanh()
+        log_prob = log_prob_noise - (-a_noise_tanh.pow(2) + 1.000001).log()
+        return a_noise_tanh, log_prob.sum(1, keepdim=True)
+
+    def get__q1_q2(self, feature, action):  # critic, feature = self.enc_s(state)
+        x = self.cri_mid(torch.cat((feature, action), dim=1))
+        return self.cri_q1(x), self.cri_q2(x)
+
+
 class InterSPG(nn.Module):  # class AgentIntelAC for SAC (SPG means stochastic policy gradient)
     def __init__(self, state_dim, action_dim, mid_dim):
         super().__init__()
@@ -274,7 +366,7 @@ class InterSPG(nn.Module):  # class AgentIntelAC for SAC (SPG means stochastic p
 
         # encoder
         self.enc_s = nn.Sequential(
-            NnnReshape(*state_dim),  # -> [?, 2, 96, 96]
+            PixelState(*state_dim),  # uint8 [?, k*96*96] -> float [?, k, 96, 96]
             nn.Conv2d(state_dim[0], idx_dim(0), 3, 2, bias=True),  # todo CarRacing-v0
             nn.Conv2d(idx_dim(0), idx_dim(1), 4, 2, bias=False), nn.ReLU(),
             nn.Conv2d(idx_dim(1), idx_dim(2), 3, 2, bias=False), nn.ReLU(),
@@ -415,7 +507,7 @@ class InterGAE(nn.Module):
             return int(16 * 1.6487 ** i)
 
         self.enc_s = nn.Sequential(
-            NnnReshape(*state_dim),  # -> [?, 2, 96, 96]
+            PixelState(*state_dim),  # uint8 [?, k*96*96] -> float [?, k, 96, 96]
             nn.Conv2d(state_dim[0], idx_dim(0), 3, 2, bias=True),  # todo CarRacing-v0
             nn.Conv2d(idx_dim(0), idx_dim(1), 4, 2, bias=False), nn.ReLU(),
             nn.Conv2d(idx_dim(1), idx_dim(2), 3, 2, bias=False), nn.ReLU(),
@@ -525,6 +617,7 @@ class AgentGAE(AgentPPO):
         # not need to use critic target network
 
         self.criterion = nn.SmoothL1Loss()
+        self.chunk_memory = 2 ** 28  # bytes, for the full-rollout pass in chunks, see get_chunk_size()
 
     def update_parameters(self, buffer, _max_step, batch_size, repeat_times):
         """Differences between AgentGAE and AgentPPO are:
@@ -554,12 +647,8 @@ class AgentGAE(AgentPPO):
         # all__new_v = self.cri(all_state).detach_()  # all new value
         # all__new_v = torch.add(*self.cri(all_state)).detach_() * 0.5  # TwinCritic # OOM
 
-        with torch.no_grad():
-            b_size = 128
-            b__len = all_state.size()[0]
-            all__new_v = [torch.add(*self.cri(all_state[i:i + b_size])) * 0.5
-                          for i in range(0, b__len, b_size)]
-            all__new_v = torch.cat(all__new_v, dim=0)
+        chunk_size = get_chunk_size(self.cri, self.cri, (all_state,), self.chunk_memory)
+        all__new_v = torch.add(*get_output_in_chunks(self.cri, (all_state,), chunk_size)) * 0.5  # TwinCritic
 
         '''compute old_v (old policy value), adv_v (advantage value) 
         refer: Generalization Advantage Estimate. ICLR 2016. 
@@ -654,6 +743,7 @@ class AgentInterGAE(AgentPPO):
         self.cri_target = self.act_target.get__q1_q2
 
         self.criterion = nn.SmoothL1Loss()
+        self.chunk_memory = 2 ** 28  # bytes, for the full-rollout pass in chunks, see get_chunk_size()
 
     def update_parameters(self, buffer, _max_step, batch_size, repeat_times):
         self.act.train()
@@ -676,14 +766,8 @@ class AgentInterGAE(AgentPPO):
         # with torch.no_grad():
         # all__new_v = self.cri(all_state).detach_()  # all new value
         # all__new_v = torch.min(*self.cri(all_state)).detach_()  # TwinCritic
-        with torch.no_grad():
-            b_size = 128
-            # all__new_v = torch.cat([torch.min(*self.cri(all_state[i:i + b_size]))
-            #                         for i in range(0, all_state.size()[0], b_size)], dim=0)
-            all__new_v = torch.cat(
-                [torch.min(*self.cri_target(all_state[i:i + b_size]))
-                 for i in range(0, all_state.size()[0], b_size)],
-                dim=0)  # todo target
+        chunk_size = get_chunk_size(self.act_target, self.cri_target, (all_state,), self.chunk_memory)
+        all__new_v = torch.min(*get_output_in_chunks(self.cri_target, (all_state,), chunk_size))  # todo target
 
         '''compute old_v (old policy value), adv_v (advantage value) 
         refer: Generalization Advantage Estimate. ICLR 2016. 
@@ -1010,15 +1094,233 @@ class AgentInterSAC(AgentBasicAC):  # Integrated Soft Actor-Critic Methods
         return loss_a_avg, loss_c_avg
 
 
+class AgentEncoderSAC(AgentBasicAC):  # SAC for pixel-level state with a shared ConvEncoder 2020-09-09
+    def __init__(self, state_dim, action_dim, net_dim):
+        """AgentDeepSAC encodes the pixel state 5 times in a gradient step:
+        act_target(next_s), cri_target(next_s), cri(state), act(state), cri(state) for policy gradient.
+        AgentEncoderSAC encodes 2 times: act_target.enc_s(next_s) for target, act.enc_s(state) for the others.
+        Gradient routing: the encoder is updated by critic_loss only, actor_loss uses the detached feature.
+        """
+        super(AgentBasicAC, self).__init__()
+        self.learning_rate = 2e-4
+        self.device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+
+        '''network'''
+        self.act = EncoderSAC(state_dim, action_dim, net_dim).to(self.device)
+        self.act.train()
+        self.cri = self.act  # actor and critic share the encoder
+
+        self.act_optimizer = torch.optim.Adam(self.act.actor_parameters(), lr=self.learning_rate)
+        self.cri_optimizer = torch.optim.Adam(self.act.critic_parameters(), lr=self.learning_rate)
+
+        self.act_target = EncoderSAC(state_dim, action_dim, net_dim).to(self.device)
+        self.act_target.eval()
+        self.act_target.load_state_dict(self.act.state_dict())
+
+        self.criterion = nn.SmoothL1Loss()
+
+        '''training record'''
+        self.state = None  # env.reset()
+        self.reward_sum = 0.0
+        self.step = 0
+        self.update_counter = 0
+
+        '''extension: auto-alpha for maximum entropy'''
+        self.log_alpha = torch.zeros(1, requires_grad=True, device=self.device)
+        self.alpha = self.log_alpha.exp()
+        self.alpha_optimizer = torch.optim.Adam((self.log_alpha,), lr=self.learning_rate)
+        self.target_entropy = -np.log(1.0 / action_dim) * 0.98
+        '''extension: auto learning rate of actor'''
+        self.trust_rho = TrustRho()
+
+        '''constant'''
+        self.explore_rate = 1.0  # explore rate when update_buffer(), 1.0 is better than 0.5
+        self.explore_noise = True  # stochastic policy choose noise_std by itself.
+        self.update_freq = 2 ** 7  # delay update frequency, for hard target update
+
+    def update_parameters(self, buffer, max_step, batch_size, repeat_times):
+        update_freq = self.update_freq * repeat_times  # delay update frequency, for soft target update
+        self.act.train()
+
+        loss_a_sum = 0.0
+        loss_c_sum = 0.0
+        rho = self.trust_rho.rho
+
+        k = 1.0 + buffer.now_len / buffer.max_len
+        batch_size_ = int(batch_size * k)
+        update_times = int(max_step * k)
+
+        for i in range(update_times * repeat_times):
+            with torch.no_grad():
+                reward, mask, state, action, next_s = buffer.random_sample(batch_size_, self.device)
+
+                next_feature = self.act_target.enc_s(next_s)  # encode next_s once for target
+                next_a_noise, next_log_prob = self.act_target.get__a__log_prob(next_feature)
+                next_q_target = torch.add(*self.act_target.get__q1_q2(next_feature, next_a_noise)) * 0.5
+                next_q_target = next_q_target - next_log_prob * self.alpha  # SAC, alpha
+                q_target = reward + mask * next_q_target
+            '''critic_loss'''
+            feature = self.act.enc_s(state)  # encode state once, for critic, actor and alpha
+            q1_value, q2_value = self.act.get__q1_q2(feature, action)  # CriticTwin
+            critic_loss = self.criterion(q1_value, q_target) + self.criterion(q2_value, q_target)
+            loss_c_tmp = critic_loss.item() * 0.5  # CriticTwin
+            loss_c_sum += loss_c_tmp
+            rho = self.trust_rho.update_rho(loss_c_tmp)
+
+            self.cri_optimizer.zero_grad()
+            critic_loss.backward()
+            self.cri_optimizer.step()
+
+            '''actor_loss'''
+            if i % repeat_times == 0 and rho > 2 ** -8:  # (self.rho>0.001) ~= (self.critic_loss<2.6)
+                feature = feature.detach()  # actor_loss does not update the encoder
+                actions_noise, log_prob = self.act.get__a__log_prob(feature)  # policy gradient
+                # auto alpha
+                alpha_loss = -(self.log_alpha * (log_prob - self.target_entropy).detach()).mean()
+                self.alpha_optimizer.zero_grad()
+                alpha_loss.backward()
+                self.alpha_optimizer.step()
+
+                # policy gradient
+                self.alpha = self.log_alpha.exp()
+                q_eval_pg = torch.min(*self.act.get__q1_q2(feature, actions_noise))  # policy gradient
+
+                actor_loss = (-q_eval_pg + log_prob * self.alpha).mean()  # policy gradient
+                loss_a_sum += actor_loss.item()
+
+                self.act_optimizer.zero_grad()
+                actor_loss.backward()  # the grad of critic head is cleared by cri_optimizer.zero_grad()
+                self.act_optimizer.step()
+
+            """target update"""
+            soft_target_update(self.act_target, self.act)  # soft target update
+
+            self.update_counter += 1
+            if self.update_counter >= update_freq:
+                self.update_counter = 0
+                self.act_optimizer.param_groups[0]['lr'] = self.learning_rate * rho
+
+        loss_a_avg = loss_a_sum / update_times
+        loss_c_avg = loss_c_sum / (update_times * repeat_times)
+        return loss_a_avg, loss_c_avg
+
+
 """run"""
 
 
-def fix_car_racing_v0(env):  # plan todo CarRacing-v0
-    env.old_step = env.step
-    """
+"""pixel pipeline: uint8 end to end, batch of envs"""
+
+
+def get_pixel_frame(rgb):  # uint8 (..., 96, 96, 3) -> uint8 (..., 96, 96), works for a batch of frames
+    frame = rgb[..., 1].copy()  # show green
+    # frame[..., 86:, :24] = 0  # shield speed
+    frame[..., 86:, 24:36] = rgb[..., 86:, 24:36, 2]  # show red
+    frame[..., 86:, 72:] = rgb[..., 86:, 72:, 0]  # show blue
+    return frame
+
+
+def get_road_sum(frame):  # fix CarRacing-v0 bug: env.prev_road
+    return frame[..., 56:64, 32:64].sum(axis=(-2, -1), dtype=np.int64)
+
+
+def get_outside(frame):  # fix CarRacing-v0 bug: outside
+    return frame[..., 60:80, 38:58].mean(axis=(-2, -1)) > 192
+
+
+class FrameStack:  # k-frame stacking on a uint8 ring buffer, the stacked state is a view (no copy) 2020-09-09
+    def __init__(self, env_num, stack_num, frame_shape=(96, 96), buf_len=2 ** 6):
+        """The stacked state of push() is buf[:, p-k:p]. When the ring buffer is full,
+        copy the last (k-1) frames to the head, so the copy is (k-1)/buf_len frame per step.
+        A stacked state is valid until the next buf_len push(). Copy it before keeping it longer.
+        """
+        self.stack_num = stack_num
+        self.buf = np.empty((env_num, stack_num - 1 + buf_len) + tuple(frame_shape), dtype=np.uint8)
+        self.p = stack_num  # the next frame is written in buf[:, p]
+
+    def reset(self, frames, env_ids=None):  # fill the stack of env_ids (None: all envs) with the first frame
+        env_ids = slice(None) if env_ids is None else env_ids
+        self.buf[env_ids, self.p - self.stack_num:self.p] = frames[:, None]
+        return self.buf[:, self.p - self.stack_num:self.p]
+
+    def push(self, frames):
+        k = self.stack_num
+        if self.p == self.buf.shape[1]:
+            self.buf[:, :k - 1] = self.buf[:, self.p - k + 1:self.p]
+            self.p = k - 1
+        self.buf[:, self.p] = frames
+        self.p += 1
+        return self.buf[:, self.p - k:self.p]
+
+
+class CarRacingBatch:  # env_num CarRacing-v0, the pixel pipeline runs on the batch at once
+    def __init__(self, env_num, stack_num=2, skip_steps=16):
+        """gym steps each env (Box2D), the frame processing and reward fix run over the batch.
+        states: uint8 (env_num, stack_num, 96, 96), a view of FrameStack, convert it to float in PixelState
+        skip_steps: the steps of zoom-in animation after env.reset()
+        """
+        import gym
+        self.envs = [gym.make('CarRacing-v0') for _ in range(env_num)]
+        self.env_num = env_num
+        self.skip_steps = skip_steps
+        self.rgb = np.empty((env_num, 96, 96, 3), dtype=np.uint8)
+        self.stack = FrameStack(env_num, stack_num)
+        self.prev_road = np.zeros(env_num, dtype=np.int64)
+
+    def reset_env(self, i):  # reset env i, return its rgb frame
+        env = self.envs[i]
+        env.reset()
+        old_action = np.array((0, 1.0, 0.0), dtype=np.float32)
+        for _ in range(self.skip_steps):
+            env.step(old_action)
+        return env.step(old_action)[0]
+
+    def reset_vec(self, env_ids=None):
+        env_ids = range(self.env_num) if env_ids is None else env_ids
+        env_ids = np.array(env_ids, dtype=np.int64)
+        for i in env_ids:
+            self.rgb[i] = self.reset_env(i)
+        frames = get_pixel_frame(self.rgb[env_ids])
+        self.prev_road[env_ids] = get_road_sum(frames)
+        return self.stack.reset(frames, env_ids)
+
+    def step_vec(self, actions):  # actions (env_num, 3) in (-1, 1)
+        actions = np.array(actions, dtype=np.float32)
+        actions[:, 1:] = (actions[:, 1:] + 1) / 2  # fix action_space.low
+        rewards = np.empty(self.env_num, dtype=np.float32)
+        dones = np.empty(self.env_num, dtype=np.bool_)
+        for i, env in enumerate(self.envs):
+            try:
+                self.rgb[i], rewards[i], dones[i], _ = env.step(actions[i])
+            except Exception as error:
+                print(f"| CarRacing-v0 Error b'stack underflow'?: {error}")
+                rewards[i] = 0
+                dones[i] = True
+
+        frames = get_pixel_frame(self.rgb)
+        road_sum = get_road_sum(frames)
+        rewards += (road_sum - self.prev_road) / 2048.0
+        self.prev_road = road_sum
+
+        is_outside = get_outside(frames)
+        rewards[is_outside] -= 4.0
+        dones |= is_outside
+
+        states = self.stack.push(frames)
+        if dones.any():  # the next_state of a done env is the reset state, mask == 0 ignores it.
+            states = self.reset_vec(np.where(dones)[0])
+        return states, rewards, dones, {}
+
+
+def fix_car_racing_v0(env, stack_num=1, skip_steps=16):  # plan todo CarRacing-v0
+    """gym single-env API of the pixel pipeline, state: uint8 (stack_num * 96 * 96, )
+    The state is copied from FrameStack, because the buffer keeps a reference of it (4x smaller than float32).
     comment 'car_racing.py' line 233-234: print('Track generation ...
     comment 'car_racing.py' line 308-309: print("retry to generate track ...
     """
+    import gym
+    env.old_step = env.step
+    env.stack = FrameStack(1, stack_num)
+    env.observation_space = gym.spaces.Box(0, 255, (stack_num, 96, 96), dtype=np.uint8)
 
     def decorator_step(env_step):
         def new_env_step(action):
@@ -1026,33 +1328,24 @@ def fix_car_racing_v0(env):  # plan todo CarRacing-v0
                 action = action.copy()
                 action[1:] = (action[1:] + 1) / 2  # fix action_space.low
                 state3, reward, done, info = env_step(action)
-                state = state3[:, :, 1]  # show green
-                # state[86:, :24] = 0  # shield speed
-                state[86:, 24:36] = state3[86:, 24:36, 2]  # show red
-                state[86:, 72:] = state3[86:, 72:, 0]  # show blue
+                frame = get_pixel_frame(state3)
 
-                prev_road = state[56:64, 32:64].sum().astype(np.int)  # fix CarRacing-v0 bug: env.prev_road
+                prev_road = get_road_sum(frame)
                 reward += (prev_road - env.prev_road) / 2048.0
                 env.prev_road = prev_road
 
-                if state[60:80, 38:58].mean() > 192:  # fix CarRacing-v0 bug: outside
+                if get_outside(frame):
                     reward -= 4.0
                     done = True
-                state = state.astype(np.float32) / 128.0 - 1
-
-                # state2 = np.stack((env.prev_state, state)).flatten()
-                # state2 = np.stack((env.prev_state, state)).flatten()
-                # env.prev_state = state
+                state = env.stack.push(frame[None])[0]
             except Exception as error:
                 print(f"| CarRacing-v0 Error b'stack underflow'?: {error}")
-                # state2 = np.stack((env.prev_state, env.prev_state)).flatten()
-                state = np.zeros(96 * 96, dtype=np.float32)
+                state = env.stack.buf[0, env.stack.p - stack_num:env.stack.p]
                 reward = 0
                 done = True
                 info = None
             # env.render()
-            # return state2, reward, done, info
-            return state.flatten(), reward, done, info
+            return state.flatten(), reward, done, info  # flatten() copies it
 
         return new_env_step
 
@@ -1062,17 +1355,12 @@ def fix_car_racing_v0(env):  # plan todo CarRacing-v0
         def new_env_reset():
             env_reset()
             old_action = np.array((0, 1.0, 0.0), dtype=np.float32)
-            for _ in range(16):
+            for _ in range(skip_steps):
                 env.old_step(old_action)
                 # env.render()
-            # env.prev_state = env.old_step(old_action)[0][:, :, 1]
-            # env.prev_road = env.prev_state[56:64, 32:64].sum().astype(np.int)  # fix CarRacing-v0 bug: env.prev_road
-            # new_action = np.array((0, 1.0, -1.0), dtype=np.float32)
-            # state2 = env.step(new_action)[0]
-            # return state2
-            state = env.old_step(old_action)[0][:, :, 0]
-            env.prev_road = state[56:64, 32:64].sum().astype(np.int)  # fix CarRacing-v0 bug: env.prev_road
-            state = state.astype(np.float32) / 128.0 - 1
+            frame = get_pixel_frame(env.old_step(old_action)[0])
+            env.prev_road = get_road_sum(frame)
+            state = env.stack.reset(frame[None])[0]
             return state.flatten()
 
         return new_env_reset
@@ -1154,8 +1442,7 @@ def test_car_racing():
         # action = env.action_space.sample()
         state, reward, done, _ = env.step(action)
         # env.render
-        show = state.reshape((2, 96, 96))
-        show = ((show[0] + 1.0) * 128).astype(np.uint8)
+        show = state.reshape(state_dim)[-1]  # uint8, the last frame of the stacked state
         cv2.imshow('', show)
         cv2.waitKey(1)
         if done:
@@ -381,12 +381,10 @@ def build_gym_env(env_name, is_print=True):
         env = gym.make(env_name)
         env = fix_car_racing_v0(env)
         state_dim, action_dim, max_action, target_reward, is_discrete = get_env_info(env, is_print)
-        assert len(state_dim)
-        # state_dim = (2, state_dim[0], state_dim[1])  # two consecutive frame (96, 96)
-        state_dim = (1, state_dim[0], state_dim[1])  # two consecutive frame (96, 96)
+        assert len(state_dim) == 3  # (stack_num, 96, 96), uint8 pixel state
     elif env_name == 'MultiWalker':
         from multiwalker_base import MultiWalkerEnv, multi_to_single_walker_decorator
-        env = MultiWalkerEnv()
+        env = MultiWalkerEnv(perf_mode=True)
         env = multi_to_single_walker_decorator(env)
 
         state_dim = sum([box.shape[0] for box in env.observation_space])
@@ -1740,6 +1740,46 @@ def initial_exploration(env, memo, max_step, action_max, reward_scale, gamma, ac
     return rewards, steps
 
 
+def get_chunk_size(net, func, tensors, memory_budget=2 ** 28):  # 2020-09-13
+    """the largest chunk size (2 ** n) of a full-rollout pass `func(*tensors)` that keeps the activation memory
+    under memory_budget (bytes). It measures the outputs of the leaf modules of net in a pass of a small probe chunk.
+    """
+    max_memo = tensors[0].shape[0]
+    probe_size = min(2 ** 4, max_memo)
+    probe_bytes = [0, ]
+
+    def add_output_bytes(_module, _input, output):
+        output = output if isinstance(output, tuple) else (output,)
+        probe_bytes[0] += sum([item.numel() * item.element_size() for item in output if isinstance(item, torch.Tensor)])
+
+    handles = [module.register_forward_hook(add_output_bytes)
+               for module in net.modules() if len(list(module.children())) == 0]
+    with torch.no_grad():
+        func(*[tensor[:probe_size] for tensor in tensors])
+    [handle.remove() for handle in handles]
+
+    chunk_size = int(memory_budget * probe_size / max(probe_bytes[0], 1))
+    chunk_size = 2 ** int(np.log2(chunk_size)) if chunk_size >= 1 else 1
+    return min(chunk_size, max_memo)
+
+
+def get_output_in_chunks(func, tensors, chunk_size):  # 2020-09-13, full-rollout pass of on-policy agents
+    """the same as func(*tensors) under torch.no_grad(), but func runs on the chunks of tensors (len(tensor) == max_memo)
+    and each output streams into a tensor that is allocated once. So the peak memory is bounded by chunk_size.
+    """
+    max_memo = tensors[0].shape[0]
+    outputs = None
+    with torch.no_grad():
+        for i in range(0, max_memo, chunk_size):
+            output = func(*[tensor[i:i + chunk_size] for tensor in tensors])
+            output = output if isinstance(output, tuple) else (output,)
+            if outputs is None:
+                outputs = [item.new_empty((max_memo,) + item.shape[1:]) for item in output]
+            for item_all, item in zip(outputs, output):
+                item_all[i:i + item.shape[0]] = item
+    return outputs[0] if len(outputs) == 1 else tuple(outputs)
+
+
 def soft_target_update(target, online, tau=5e-3):
     for target_param, param in zip(target.parameters(), online.parameters()):
         target_param.data.copy_(tau * param.data + (1.0 - tau) * target_param.data)
@@ -21,6 +21,8 @@ MOTORS_TORQUE = 80
 SPEED_HIP = 4
 SPEED_KNEE = 6
 LIDAR_RANGE = 160 / SCALE
+LIDAR_DX = [math.sin(1.5 * i / 10.0) * LIDAR_RANGE for i in range(10)]  # the rays of lidar, perf_mode
+LIDAR_DY = [-math.cos(1.5 * i / 10.0) * LIDAR_RANGE for i in range(10)]
 
 INITIAL_RANDOM = 5
 
@@ -253,6 +255,38 @@ class BipedalWalker(Agent):
 
         return state
 
+    def get_observation_into(self, out):  # perf_mode: write the 24 obs of get_observation() in out
+        pos = self.hull.position
+        vel = self.hull.linearVelocity
+        x, y = pos[0], pos[1]
+
+        ray_cast = self.world.RayCast
+        for lidar, dx, dy in zip(self.lidar, LIDAR_DX, LIDAR_DY):
+            lidar.fraction = 1.0
+            lidar.p1 = pos
+            lidar.p2 = (x + dx, y + dy)
+            ray_cast(lidar, lidar.p1, lidar.p2)
+
+        joints = self.joints
+        out[:14] = (
+            self.hull.angle,
+            2.0 * self.hull.angularVelocity / FPS,
+            0.3 * vel.x * (VIEWPORT_W / SCALE) / FPS,
+            0.3 * vel.y * (VIEWPORT_H / SCALE) / FPS,
+            joints[0].angle,
+            joints[0].speed / SPEED_HIP,
+            joints[1].angle + 1.0,
+            joints[1].speed / SPEED_KNEE,
+            1.0 if self.legs[1].ground_contact else 0.0,
+            joints[2].angle,
+            joints[2].speed / SPEED_HIP,
+            joints[3].angle + 1.0,
+            joints[3].speed / SPEED_KNEE,
+            1.0 if self.legs[3].ground_contact else 0.0,
+        )
+        out[14:24] = [lidar.fraction for lidar in self.lidar]
+        return x, y
+
     @property
     def observation_space(self):
         # 24 original obs (joints, etc), 2 displacement obs for each neighboring walker, 3 for package, 1 ID
@@ -271,8 +305,15 @@ class MultiWalkerEnv:
 
     def __init__(self, n_walkers=3, position_noise=1e-3, angle_noise=1e-3, reward_mech='local',
                  forward_reward=1.0, fall_reward=-100.0, drop_reward=-100.0, terminate_on_fall=True,
-                 one_hot=False):
+                 one_hot=False, perf_mode=False, terrain_pool_size=2 ** 3):
         # reward_mech is 'global' for cooperative game (same reward for every agent)
+        """perf_mode: step() returns (obs, rewards, done, info) with
+        obs: a preallocated array (n_walkers, obs_dim), it is overwritten by the next step(), copy it to keep it.
+        rewards: array (n_walkers, ), done: bool.
+        reset() reuses a pool of terrain_pool_size terrains, and rebuilds the Box2D terrain only when it changes.
+        """
+        self.perf_mode = perf_mode
+        self.terrain_pool_size = terrain_pool_size
 
         self.n_walkers = n_walkers
         self.position_noise = position_noise
@@ -318,6 +359,21 @@ class MultiWalkerEnv:
 
         self.terrain_length = int(TERRAIN_LENGTH * self.n_walkers * 1 / 8.)
 
+        '''perf_mode'''
+        self.terrain_pool = list()
+        self.terrain_idx = -1
+        obs_dim = self.observation_space[0].shape[0]
+        self.obs_array = np.zeros((self.n_walkers, obs_dim))  # 24 walker obs, 4 neighbor obs, 3 package obs, ID
+        if self.one_hot:
+            self.obs_array[:, 31:] = np.eye(MAX_AGENTS)[:self.n_walkers]
+        else:
+            self.obs_array[:, 31] = np.arange(self.n_walkers) / self.n_walkers
+        self.nobs_mean = np.zeros((self.n_walkers, 7))  # the neighbor and package obs before adding noise
+        self.nobs_std = np.full((self.n_walkers, 7), self.position_noise)
+        self.nobs_std[0, 0:2] = 0.0  # no neighbor (for edge walkers), obs is 0.0 without noise
+        self.nobs_std[-1, 2:4] = 0.0
+        self.nobs_std[:, 6] = self.angle_noise
+
         self.reset()
 
     @property
@@ -336,15 +392,50 @@ class MultiWalkerEnv:
         if not self.terrain:
             return
         self.world.contactListener = None
-        for t in self.terrain:
-            self.world.DestroyBody(t)
-        self.terrain = []
+        if not self.perf_mode:  # perf_mode: _reset_terrain() keeps or rebuilds the terrain
+            self._destroy_terrain()
         self.world.DestroyBody(self.package)
         self.package = None
 
         for walker in self.walkers:
             walker._destroy()
 
+    def _destroy_terrain(self):
+        for t in self.terrain if self.terrain else ():
+            self.world.DestroyBody(t)
+        self.terrain = []
+
+    def _reset_terrain(self):  # perf_mode: reuse a pool of terrains
+        if len(self.terrain_pool) < self.terrain_pool_size:
+            self._destroy_terrain()
+            self._generate_terrain(self.hardcore)
+            self.terrain_pool.append(self._get_terrain_spec())
+            self.terrain_idx = len(self.terrain_pool) - 1
+        else:
+            terrain_idx = self.np_random.randint(self.terrain_pool_size)
+            if terrain_idx != self.terrain_idx:  # keep the Box2D bodies of the same terrain
+                self._destroy_terrain()
+                self._build_terrain(self.terrain_pool[terrain_idx])
+                self.terrain_idx = terrain_idx
+
+    def _get_terrain_spec(self):  # the static bodies of terrain, for _build_terrain()
+        body_list = list()
+        for t in self.terrain:
+            fixture = t.fixtures[0]
+            body_list.append((isinstance(fixture.shape, edgeShape), [tuple(v) for v in fixture.shape.vertices],
+                              fixture.friction, fixture.filterData.categoryBits, t.color1, t.color2))
+        return body_list, self.terrain_x, self.terrain_y, self.terrain_poly
+
+    def _build_terrain(self, terrain_spec):
+        body_list, self.terrain_x, self.terrain_y, self.terrain_poly = terrain_spec
+        self.terrain = []
+        for is_edge, vertices, friction, category_bits, color1, color2 in body_list:
+            shape = edgeShape(vertices=vertices) if is_edge else polygonShape(vertices=vertices)
+            t = self.world.CreateStaticBody(fixtures=fixtureDef(
+                shape=shape, friction=friction, categoryBits=category_bits))
+            t.color1, t.color2 = color1, color2
+            self.terrain.append(t)
+
     def close(self):
         pass
 
@@ -363,8 +454,13 @@ class MultiWalkerEnv:
         H = VIEWPORT_H / SCALE
 
         self._generate_package()
-        self._generate_terrain(self.hardcore)
-        self._generate_clouds()
+        if self.perf_mode:
+            self._reset_terrain()
+            if not hasattr(self, 'cloud_poly'):  # clouds are only for render()
+                self._generate_clouds()
+        else:
+            self._generate_terrain(self.hardcore)
+            self._generate_clouds()
 
         self.drawlist = copy.copy(self.terrain)
 
@@ -384,8 +480,8 @@ class MultiWalkerEnv:
             self.walkers[i].apply_action(act_vec[i])
 
         self.world.Step(1.0 / FPS, 6 * 30, 2 * 30)
-
-        obs = [walker.get_observation() for walker in self.walkers]
+        if self.perf_mode:
+            return self.get_step_return()
 
         xpos = np.zeros(self.n_walkers)
         obs = []
@@ -448,6 +544,49 @@ class MultiWalkerEnv:
             return obs, rewards, [done] * self.n_walkers, {}
         return obs, [rewards.mean()] * self.n_walkers, [done] * self.n_walkers, {}
 
+    def get_step_return(self):  # perf_mode: the obs of all walkers in one preallocated array
+        n = self.n_walkers
+        obs = self.obs_array
+        xy = np.array([walker.get_observation_into(obs[i]) for i, walker in enumerate(self.walkers)])
+        xs, ys = xy[:, 0], xy[:, 1]
+
+        package = self.package
+        nobs = self.nobs_mean
+        nobs[1:, 0] = (xs[:-1] - xs[1:]) / self.package_length  # left neighbor
+        nobs[1:, 1] = (ys[:-1] - ys[1:]) / self.package_length
+        nobs[:-1, 2] = (xs[1:] - xs[:-1]) / self.package_length  # right neighbor
+        nobs[:-1, 3] = (ys[1:] - ys[:-1]) / self.package_length
+        nobs[:, 4] = (package.position.x - xs) / self.package_length
+        nobs[:, 5] = (package.position.y - ys) / self.package_length
+        nobs[:, 6] = package.angle
+        obs[:, 24:31] = np.random.normal(nobs, self.nobs_std)
+
+        # shaping = 130 * pos[0] / SCALE
+        shaping = -5.0 * np.abs(obs[:, 0])
+        rewards = shaping - self.prev_shaping
+        self.prev_shaping = shaping
+
+        package_shaping = self.forward_reward * 130 * package.position.x / SCALE
+        rewards += (package_shaping - self.prev_package_shaping)
+        self.prev_package_shaping = package_shaping
+
+        self.scroll = xs.mean() - VIEWPORT_W / SCALE / 5 - (n - 1) * WALKER_SEPERATION * TERRAIN_STEP
+
+        done = False
+        x = xs[-1]  # the same as step(), it checks the position of the last walker
+        if self.game_over or x < 0:
+            rewards += self.drop_reward
+            done = True
+        if x > (self.terrain_length - TERRAIN_GRASS) * TERRAIN_STEP:
+            done = True
+        rewards += self.fall_reward * self.fallen_walkers
+        if self.terminate_on_fall and self.fallen_walkers.any():
+            done = True
+
+        if self.reward_mech != 'local':
+            rewards[:] = rewards.mean()
+        return obs, rewards, done, {}
+
     def render(self, mode='human', close=False):
         if close:
             if self.viewer is not None:
@@ -749,6 +888,28 @@ def modify_multi_to_single_walker_env(env):
     return env
 
 
+def multi_to_single_walker_decorator(env):  # MultiWalkerEnv(perf_mode=True) for single agent, without dict
+    assert env.perf_mode
+
+    def decorator_step(env_step):
+        def new_env_step(action):
+            obs, rewards, done, info = env_step(action.clip(-1, 1))
+            return obs.flatten(), rewards.sum(), done, info  # flatten() copies the preallocated obs
+
+        return new_env_step
+
+    env.step = decorator_step(env.step)
+
+    def decorator_reset(env_reset):
+        def new_env_reset():
+            return env_reset().flatten()
+
+        return new_env_reset
+
+    env.reset = decorator_reset(env.reset)
+    return env
+
+
 """run"""
 
 
@@ -813,7 +974,7 @@ def run_demo__multi_walker():
 
 def run_continuous_action(gpu_id=None):  # fail
     # import AgentZoo as Zoo
-    from AgentRun import *
+    from AgentRun import Arguments, train_agent
     import beta1 as Zoo  # params-share
 
     """online policy"""  # plan to check args.max_total_step